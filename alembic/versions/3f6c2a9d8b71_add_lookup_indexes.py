@@ -0,0 +1,54 @@
+"""add indexes for hot lookup paths
+
+Revision ID: 3f6c2a9d8b71
+Revises: b94bebcda5c1
+Create Date: 2026-10-19 10:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '3f6c2a9d8b71'
+down_revision: Union[str, None] = 'b94bebcda5c1'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# (имя, таблица, колонки, условие частичного индекса)
+INDEXES = [
+    ('ix_tokens_parent_token_id', 'tokens', ['parent_token_id'], 'parent_token_id IS NOT NULL'),
+    ('ix_tokens_account_id_type', 'tokens', ['account_id', 'token_type'], 'account_id IS NOT NULL'),
+    ('ix_tokens_created_at_id', 'tokens', ['created_at', 'id'], None),
+    ('ix_tokens_active_expires_at', 'tokens', ['expires_at'], "status = 'active' AND expires_at IS NOT NULL"),
+    ('ix_token_history_user_created', 'token_history', ['user_id', 'created_at'], None),
+    ('ix_token_history_token_id', 'token_history', ['token_id'], None),
+    ('ix_child_tokens_master_token_id', 'child_tokens', ['master_token_id'], None),
+    ('ix_users_telegram_id', 'users', ['telegram_id'], None),
+    ('ix_token_object_access_token_object', 'token_object_access', ['token_id', 'object_id'], None),
+]
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # CREATE INDEX CONCURRENTLY нельзя выполнять внутри транзакции,
+    # зато он не блокирует запись в таблицы на работающей БД
+    with op.get_context().autocommit_block():
+        for name, table, columns, where in INDEXES:
+            op.create_index(
+                name,
+                table,
+                columns,
+                postgresql_concurrently=True,
+                postgresql_where=sa.text(where) if where else None,
+                if_not_exists=True,
+            )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.get_context().autocommit_block():
+        for name, table, _, _ in reversed(INDEXES):
+            op.drop_index(name, table_name=table, postgresql_concurrently=True, if_exists=True)
@@ -0,0 +1,38 @@
+"""add tokens short id expression index for compact callback data
+
+Revision ID: 7a1e4c0b2d95
+Revises: 3f6c2a9d8b71
+Create Date: 2026-10-19 11:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '7a1e4c0b2d95'
+down_revision: Union[str, None] = '3f6c2a9d8b71'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # Индекс по выражению вместо хранимой колонки: без перезаписи tokens под ACCESS EXCLUSIVE.
+    # Неуникальный: коллизия 48-битного префикса не должна отклонять вставку токена
+    with op.get_context().autocommit_block():
+        op.create_index(
+            'ix_tokens_short_id',
+            'tokens',
+            [sa.text('substr(md5(token), 1, 12)')],
+            postgresql_concurrently=True,
+            if_not_exists=True,
+        )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_tokens_short_id', table_name='tokens', postgresql_concurrently=True, if_exists=True)
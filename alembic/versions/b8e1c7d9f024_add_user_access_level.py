@@ -0,0 +1,33 @@
+"""add users.access_level
+
+Revision ID: b8e1c7d9f024
+Revises: a6d2f8b4c113
+Create Date: 2026-10-19 20:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b8e1c7d9f024'
+down_revision: Union[str, None] = 'a6d2f8b4c113'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+access_level = sa.Enum('none', 'user', 'admin', name='accesslevel')
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    access_level.create(op.get_bind(), checkfirst=True)
+    # Существующие пользователи сохраняют доступ
+    op.add_column('users', sa.Column('access_level', access_level, nullable=False, server_default='user'))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column('users', 'access_level')
+    access_level.drop(op.get_bind(), checkfirst=True)
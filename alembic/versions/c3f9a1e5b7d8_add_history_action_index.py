@@ -0,0 +1,34 @@
+"""add token_history (user_id, action, created_at) index for filtered /history
+
+Revision ID: c3f9a1e5b7d8
+Revises: b8e1c7d9f024
+Create Date: 2026-10-19 21:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c3f9a1e5b7d8'
+down_revision: Union[str, None] = 'b8e1c7d9f024'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # token_history партиционирована: индекс создается на родителе и всех партициях
+    op.create_index(
+        'ix_token_history_user_action_created',
+        'token_history',
+        ['user_id', 'action', 'created_at'],
+        if_not_exists=True,
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_token_history_user_action_created', table_name='token_history', if_exists=True)
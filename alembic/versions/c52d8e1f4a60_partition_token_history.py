@@ -0,0 +1,122 @@
+"""partition token_history by month
+
+Revision ID: c52d8e1f4a60
+Revises: 7a1e4c0b2d95
+Create Date: 2026-10-19 12:00:00.000000
+
+"""
+import datetime
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c52d8e1f4a60'
+down_revision: Union[str, None] = '7a1e4c0b2d95'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+COLUMNS = ['id', 'token_id', 'user_id', 'master_token_id', 'child_token_id', 'action', 'created_at', 'details']
+# С запасом: DEFAULT-партиции нет, а обслуживание партиций может не успеть к смене месяца
+PARTITIONS_AHEAD = 6
+
+
+def _add_months(month: datetime.date, months: int) -> datetime.date:
+    index = month.year * 12 + month.month - 1 + months
+    return datetime.date(index // 12, index % 12 + 1, 1)
+
+
+def _common_columns(table: str) -> list:
+    existing = {c['name'] for c in sa.inspect(op.get_bind()).get_columns(table)}
+    return [c for c in COLUMNS if c in existing]
+
+
+def _drop_history_indexes() -> None:
+    op.execute('DROP INDEX IF EXISTS ix_token_history_user_created')
+    op.execute('DROP INDEX IF EXISTS ix_token_history_token_id')
+
+
+def _create_history_indexes() -> None:
+    op.create_index('ix_token_history_user_created', 'token_history', ['user_id', 'created_at'])
+    op.create_index('ix_token_history_token_id', 'token_history', ['token_id'])
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # Переносим старую таблицу в сторону, освобождая имена таблицы и индексов
+    op.rename_table('token_history', 'token_history_old')
+    op.execute('ALTER INDEX IF EXISTS token_history_pkey RENAME TO token_history_old_pkey')
+    _drop_history_indexes()
+
+    op.execute("""
+        CREATE TABLE token_history (
+            id INTEGER NOT NULL,
+            token_id INTEGER REFERENCES tokens (id),
+            user_id INTEGER REFERENCES users (id),
+            master_token_id INTEGER REFERENCES master_tokens (id),
+            child_token_id INTEGER REFERENCES child_tokens (id),
+            action VARCHAR NOT NULL,
+            created_at TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT (now() AT TIME ZONE 'utc'),
+            details JSON,
+            PRIMARY KEY (id, created_at)
+        ) PARTITION BY RANGE (created_at)
+    """)
+    # Продолжаем нумерацию id из последовательности старой таблицы
+    op.execute('ALTER SEQUENCE IF EXISTS token_history_id_seq OWNED BY token_history.id')
+    op.execute("ALTER TABLE token_history ALTER COLUMN id SET DEFAULT nextval('token_history_id_seq')")
+
+    # Партиции: от самого старого месяца в данных до текущего + PARTITIONS_AHEAD
+    today = datetime.datetime.utcnow().date().replace(day=1)
+    common = _common_columns('token_history_old')
+    oldest = None
+    if 'created_at' in common:
+        oldest = op.get_bind().scalar(sa.text('SELECT min(created_at) FROM token_history_old'))
+    month = oldest.date().replace(day=1) if oldest else today
+    month = min(month, today)
+    last = _add_months(today, PARTITIONS_AHEAD)
+    while month <= last:
+        op.execute(
+            f"CREATE TABLE token_history_{month:%Y_%m} PARTITION OF token_history "
+            f"FOR VALUES FROM ('{month.isoformat()}') TO ('{_add_months(month, 1).isoformat()}')"
+        )
+        month = _add_months(month, 1)
+
+    # Копируем данные; записи без даты относим к текущему моменту
+    columns = [c for c in common if c != 'created_at']
+    select_list = ', '.join(columns + ["coalesce(created_at, now() AT TIME ZONE 'utc')" if 'created_at' in common else "now() AT TIME ZONE 'utc'"])
+    op.execute(
+        f"INSERT INTO token_history ({', '.join(columns + ['created_at'])}) "
+        f"SELECT {select_list} FROM token_history_old"
+    )
+    _create_history_indexes()
+    op.drop_table('token_history_old')
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.rename_table('token_history', 'token_history_partitioned')
+    op.execute('ALTER INDEX IF EXISTS token_history_pkey RENAME TO token_history_partitioned_pkey')
+    _drop_history_indexes()
+    # autoincrement=False: используем существующую последовательность token_history_id_seq
+    op.create_table('token_history',
+    sa.Column('id', sa.Integer(), nullable=False, autoincrement=False),
+    sa.Column('token_id', sa.Integer(), sa.ForeignKey('tokens.id'), nullable=True),
+    sa.Column('user_id', sa.Integer(), sa.ForeignKey('users.id'), nullable=True),
+    sa.Column('master_token_id', sa.Integer(), sa.ForeignKey('master_tokens.id'), nullable=True),
+    sa.Column('child_token_id', sa.Integer(), sa.ForeignKey('child_tokens.id'), nullable=True),
+    sa.Column('action', sa.String(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=True),
+    sa.Column('details', sa.JSON(), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.execute('ALTER SEQUENCE IF EXISTS token_history_id_seq OWNED BY token_history.id')
+    op.execute("ALTER TABLE token_history ALTER COLUMN id SET DEFAULT nextval('token_history_id_seq')")
+    op.execute(
+        f"INSERT INTO token_history ({', '.join(COLUMNS)}) "
+        f"SELECT {', '.join(COLUMNS)} FROM token_history_partitioned"
+    )
+    _create_history_indexes()
+    # Партиции удаляются вместе с родительской таблицей
+    op.execute('DROP TABLE token_history_partitioned')
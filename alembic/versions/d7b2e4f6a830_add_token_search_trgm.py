@@ -0,0 +1,47 @@
+"""add pg_trgm GIN indexes for inline token search
+
+Revision ID: d7b2e4f6a830
+Revises: c3f9a1e5b7d8
+Create Date: 2026-10-19 22:00:00.000000
+
+"""
+from typing import Sequence, Union
+import logging
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd7b2e4f6a830'
+down_revision: Union[str, None] = 'c3f9a1e5b7d8'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+logger = logging.getLogger("alembic.runtime.migration")
+
+TRGM_INDEXES = [
+    ("ix_tokens_token_trgm", "tokens", "token gin_trgm_ops"),
+    ("ix_tokens_label_trgm", "tokens", "(token_metadata ->> 'label') gin_trgm_ops"),
+    ("ix_wialon_accounts_username_trgm", "wialon_accounts", "username gin_trgm_ops"),
+]
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    with op.get_context().autocommit_block():
+        try:
+            op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        except Exception as e:
+            # Без прав на расширение поиск работает через ILIKE без индексов (app.token_search)
+            logger.warning(f"pg_trgm is not available, skipping trigram indexes: {e}")
+            return
+        for name, table, expression in TRGM_INDEXES:
+            op.execute(f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {table} USING gin ({expression})')
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.get_context().autocommit_block():
+        for name, _, _ in TRGM_INDEXES:
+            op.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {name}')
@@ -0,0 +1,36 @@
+"""make tokens.created_at NOT NULL for keyset pagination
+
+Revision ID: e2a8c6d4f197
+Revises: d7b2e4f6a830
+Create Date: 2026-10-20 10:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e2a8c6d4f197'
+down_revision: Union[str, None] = 'd7b2e4f6a830'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # Курсор /my_tokens строится по (created_at, id): строки с NULL не попадали ни на одну страницу.
+    # Время создания таких токенов неизвестно; now() оставляет их первыми, как при DESC NULLS FIRST
+    op.execute("UPDATE tokens SET created_at = now() AT TIME ZONE 'utc' WHERE created_at IS NULL")
+    op.alter_column('tokens', 'created_at', server_default=sa.text("(now() AT TIME ZONE 'utc')"))
+    # Проверенный CHECK позволяет SET NOT NULL обойтись без повторного сканирования под ACCESS EXCLUSIVE
+    op.execute('ALTER TABLE tokens ADD CONSTRAINT tokens_created_at_not_null CHECK (created_at IS NOT NULL) NOT VALID')
+    op.execute('ALTER TABLE tokens VALIDATE CONSTRAINT tokens_created_at_not_null')
+    op.alter_column('tokens', 'created_at', nullable=False)
+    op.execute('ALTER TABLE tokens DROP CONSTRAINT tokens_created_at_not_null')
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.alter_column('tokens', 'created_at', nullable=True, server_default=None)
@@ -0,0 +1,261 @@
+"""consolidate master_tokens/child_tokens into tokens
+
+Revision ID: e4b7a9c3d210
+Revises: c52d8e1f4a60
+Create Date: 2026-10-19 15:00:00.000000
+
+Переносит master_tokens/child_tokens в единую таблицу tokens (список смежности),
+добавляет материализованный путь tokens.path ('/<id корня>/.../<id>/'),
+поддерживаемый триггерами, и заменяет старые таблицы представлениями
+совместимости. Исходные данные остаются в *_legacy до ручного удаления.
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e4b7a9c3d210'
+down_revision: Union[str, None] = 'c52d8e1f4a60'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+BATCH_SIZE = 5000
+
+PATH_TRIGGERS = [
+    """
+    CREATE OR REPLACE FUNCTION tokens_set_path() RETURNS trigger AS $$
+    DECLARE
+        parent_path varchar;
+    BEGIN
+        IF NEW.parent_token_id IS NULL THEN
+            NEW.path := '/' || NEW.id || '/';
+            RETURN NEW;
+        END IF;
+        SELECT path INTO parent_path FROM tokens WHERE id = NEW.parent_token_id;
+        IF parent_path LIKE '%/' || NEW.id || '/%' THEN
+            RAISE EXCEPTION 'token % cannot be a descendant of itself', NEW.id;
+        END IF;
+        NEW.path := parent_path || NEW.id || '/';
+        RETURN NEW;
+    END
+    $$ LANGUAGE plpgsql
+    """,
+    """
+    CREATE OR REPLACE FUNCTION tokens_move_subtree() RETURNS trigger AS $$
+    BEGIN
+        UPDATE tokens SET path = NEW.path || substr(path, length(OLD.path) + 1)
+        WHERE path LIKE OLD.path || '%' AND id <> NEW.id;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql
+    """,
+    """
+    CREATE TRIGGER tokens_set_path BEFORE INSERT OR UPDATE OF parent_token_id ON tokens
+    FOR EACH ROW EXECUTE FUNCTION tokens_set_path()
+    """,
+    """
+    CREATE TRIGGER tokens_move_subtree AFTER UPDATE OF parent_token_id ON tokens
+    FOR EACH ROW WHEN (OLD.path IS DISTINCT FROM NEW.path) EXECUTE FUNCTION tokens_move_subtree()
+    """,
+]
+
+CREATION_METHOD = (
+    "CASE WHEN upper(CAST({column} AS text)) IN ('LOGIN', 'API', 'MANUAL') "
+    "THEN CAST(upper(CAST({column} AS text)) AS tokencreationmethod) "
+    "ELSE CAST('MANUAL' AS tokencreationmethod) END"
+)
+
+
+def _columns(table: str) -> set:
+    return {c['name'] for c in sa.inspect(op.get_bind()).get_columns(table)}
+
+
+def _column(alias: str, columns: set, name: str, default: str = 'NULL') -> str:
+    return f'{alias}.{name}' if name in columns else default
+
+
+def _batched(statement: str, table: str) -> None:
+    """Выполнить INSERT ... SELECT пачками по диапазонам id исходной таблицы (каждая пачка - своя транзакция)."""
+    bind = op.get_bind()
+    low, high = bind.execute(sa.text(f'SELECT min(id), max(id) FROM {table}')).one()
+    if low is None:
+        return
+    for start in range(low - 1, high, BATCH_SIZE):
+        bind.execute(sa.text(statement), {'low': start, 'high': start + BATCH_SIZE})
+
+
+def _backfill_paths() -> None:
+    """Проставить path существующим токенам уровень за уровнем, пачками."""
+    bind = op.get_bind()
+    while True:
+        result = bind.execute(sa.text("""
+            UPDATE tokens t SET path = coalesce(p.parent_path, '/') || t.id || '/'
+            FROM (
+                SELECT c.id, pp.path AS parent_path
+                FROM tokens c
+                LEFT JOIN tokens pp ON pp.id = c.parent_token_id
+                WHERE c.path IS NULL AND (c.parent_token_id IS NULL OR pp.path IS NOT NULL)
+                ORDER BY c.id
+                LIMIT :batch
+            ) p
+            WHERE t.id = p.id
+        """), {'batch': BATCH_SIZE})
+        if not result.rowcount:
+            break
+
+
+def _backfill_legacy_tokens(inspector) -> None:
+    masters = _columns('master_tokens')
+    account_join = ''
+    account_id = 'NULL'
+    if 'credentials_id' in masters and inspector.has_table('wialon_credentials'):
+        op.execute("""
+            INSERT INTO wialon_accounts (username, encrypted_password, last_used, created_at)
+            SELECT DISTINCT ON (username) username, encrypted_password, last_used, created_at
+            FROM wialon_credentials
+            ORDER BY username, last_used DESC NULLS LAST
+            ON CONFLICT (username) DO NOTHING
+        """)
+        account_join = (
+            'LEFT JOIN wialon_credentials wc ON wc.id = m.credentials_id '
+            'LEFT JOIN wialon_accounts a ON a.username = wc.username'
+        )
+        account_id = 'a.id'
+
+    _batched(f"""
+        INSERT INTO tokens (token, token_type, creation_method, account_id, status, expires_at,
+                            created_at, access_rights, token_metadata)
+        SELECT m.token, CAST('MASTER' AS tokentype),
+               {CREATION_METHOD.format(column=_column('m', masters, 'creation_method'))},
+               {account_id}, coalesce({_column('m', masters, 'status')}, 'active'), {_column('m', masters, 'expires_at')},
+               coalesce({_column('m', masters, 'created_at')}, now() AT TIME ZONE 'utc'),
+               {_column('m', masters, 'access_rights')},
+               json_build_object('legacy_master_token_id', m.id)
+        FROM master_tokens m
+        {account_join}
+        WHERE m.id > :low AND m.id <= :high
+        ORDER BY m.id
+        ON CONFLICT (token) DO NOTHING
+    """, 'master_tokens')
+
+    children = _columns('child_tokens')
+    _batched(f"""
+        INSERT INTO tokens (token, token_type, creation_method, parent_token_id, status, expires_at,
+                            created_at, last_used, access_rights, token_metadata)
+        SELECT c.token, CAST('CHILD' AS tokentype),
+               {CREATION_METHOD.format(column=_column('c', children, 'creation_method'))},
+               p.id, coalesce({_column('c', children, 'status')}, 'active'), {_column('c', children, 'expires_at')},
+               coalesce({_column('c', children, 'created_at')}, now() AT TIME ZONE 'utc'),
+               {_column('c', children, 'last_used_at')}, {_column('c', children, 'access_rights')},
+               json_build_object('legacy_child_token_id', c.id, 'duration', {_column('c', children, 'duration')})
+        FROM child_tokens c
+        JOIN master_tokens m ON m.id = c.master_token_id
+        JOIN tokens p ON p.token = m.token
+        WHERE c.id > :low AND c.id <= :high
+        ORDER BY c.id
+        ON CONFLICT (token) DO NOTHING
+    """, 'child_tokens')
+
+
+def _repoint_foreign_key(table: str, column: str, old_target: str, new_target: str) -> None:
+    """Перевести FK table.column с old_target на new_target (значения пересчитываются по строке токена)."""
+    inspector = sa.inspect(op.get_bind())
+    for fk in inspector.get_foreign_keys(table):
+        if fk['referred_table'] == old_target and fk['constrained_columns'] == [column]:
+            op.drop_constraint(fk['name'], table, type_='foreignkey')
+    op.execute(f"""
+        UPDATE {table} x SET {column} = n.id
+        FROM {old_target} o JOIN {new_target} n ON n.token = o.token
+        WHERE x.{column} = o.id
+    """)
+    name = f'{table}_{column}_fkey'
+    op.execute(f'ALTER TABLE {table} ADD CONSTRAINT {name} FOREIGN KEY ({column}) REFERENCES {new_target} (id) NOT VALID')
+    op.execute(f'ALTER TABLE {table} VALIDATE CONSTRAINT {name}')
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('tokens', sa.Column('path', sa.String(), nullable=True))
+    for statement in PATH_TRIGGERS:
+        op.execute(statement)
+
+    inspector = sa.inspect(op.get_bind())
+    has_legacy = inspector.has_table('master_tokens') and inspector.has_table('child_tokens')
+
+    # Пачки коммитятся по отдельности, чтобы не держать длинную транзакцию на tokens
+    with op.get_context().autocommit_block():
+        _backfill_paths()
+        if has_legacy:
+            _backfill_legacy_tokens(inspector)
+
+    if has_legacy:
+        # История: строки, привязанные только к старым таблицам, переводим на tokens
+        history = _columns('token_history')
+        for column, legacy in (('master_token_id', 'master_tokens'), ('child_token_id', 'child_tokens')):
+            if column in history:
+                op.execute(f"""
+                    UPDATE token_history h SET token_id = t.id
+                    FROM {legacy} o JOIN tokens t ON t.token = o.token
+                    WHERE h.token_id IS NULL AND h.{column} = o.id
+                """)
+        _repoint_foreign_key('token_object_access', 'token_id', 'master_tokens', 'tokens')
+
+        op.rename_table('child_tokens', 'child_tokens_legacy')
+        op.rename_table('master_tokens', 'master_tokens_legacy')
+
+    op.execute('ALTER TABLE token_history DROP COLUMN IF EXISTS master_token_id')
+    op.execute('ALTER TABLE token_history DROP COLUMN IF EXISTS child_token_id')
+
+    # Представления совместимости для внешних отчетов и ручных запросов
+    op.execute("""
+        CREATE VIEW master_tokens AS
+        SELECT id, token, account_id, creation_method, status, expires_at, created_at, access_rights
+        FROM tokens
+        WHERE token_type = 'MASTER'
+    """)
+    op.execute("""
+        CREATE VIEW child_tokens AS
+        SELECT id, parent_token_id AS master_token_id, token, status, creation_method,
+               last_used AS last_used_at, created_at, expires_at,
+               CASE WHEN token_metadata->>'duration' ~ '^[0-9]+$'
+                    THEN CAST(token_metadata->>'duration' AS integer) END AS duration,
+               access_rights
+        FROM tokens
+        WHERE token_type = 'CHILD'
+    """)
+
+    with op.get_context().autocommit_block():
+        op.create_index(
+            'ix_tokens_path', 'tokens', ['path'],
+            postgresql_ops={'path': 'text_pattern_ops'},
+            postgresql_concurrently=True,
+            if_not_exists=True
+        )
+
+
+def downgrade() -> None:
+    """Downgrade schema.
+
+    Токены, перенесенные из старых таблиц, остаются в tokens.
+    """
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_tokens_path', table_name='tokens', postgresql_concurrently=True, if_exists=True)
+
+    op.execute('DROP VIEW IF EXISTS child_tokens')
+    op.execute('DROP VIEW IF EXISTS master_tokens')
+
+    inspector = sa.inspect(op.get_bind())
+    if inspector.has_table('master_tokens_legacy'):
+        op.rename_table('master_tokens_legacy', 'master_tokens')
+        op.rename_table('child_tokens_legacy', 'child_tokens')
+        _repoint_foreign_key('token_object_access', 'token_id', 'tokens', 'master_tokens')
+    op.add_column('token_history', sa.Column('master_token_id', sa.Integer(), sa.ForeignKey('master_tokens.id'), nullable=True))
+    op.add_column('token_history', sa.Column('child_token_id', sa.Integer(), sa.ForeignKey('child_tokens.id'), nullable=True))
+
+    op.execute('DROP TRIGGER IF EXISTS tokens_move_subtree ON tokens')
+    op.execute('DROP TRIGGER IF EXISTS tokens_set_path ON tokens')
+    op.execute('DROP FUNCTION IF EXISTS tokens_move_subtree()')
+    op.execute('DROP FUNCTION IF EXISTS tokens_set_path()')
+    op.drop_column('tokens', 'path')
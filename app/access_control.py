@@ -1,27 +1,100 @@
-import functools
-from sqlalchemy.orm import Session
+"""
+Контроль доступа к боту.
+
+Уровень доступа пользователя определяется один раз на апдейт в AccessMiddleware:
+- Telegram ID из ALLOWED_USERS (разбирается один раз при импорте) - admin;
+- иначе users.access_level по users.telegram_id (асинхронный запрос, результат
+  кэшируется на ACCESS_CACHE_TTL, отсутствие доступа - на ACCESS_NEGATIVE_TTL).
+Уровень кладется в data["access_level"] обработчика. Изменения users.access_level
+вступают в силу не позже чем через ACCESS_CACHE_TTL (отказ - ACCESS_NEGATIVE_TTL).
+"""
+import logging
+import os
+
+from aiogram import BaseMiddleware
+from aiogram.types import Update
+from sqlalchemy import select
+
+from app.cache import LRUCache
+from app.database import AsyncSessionLocal
 from app.models import User, AccessLevel
+from app.utils import get_allowed_user_ids
+
+logger = logging.getLogger(__name__)
+
+ACCESS_CACHE_TTL = float(os.getenv("ACCESS_CACHE_TTL", "300"))
+ACCESS_NEGATIVE_TTL = float(os.getenv("ACCESS_NEGATIVE_TTL", "30"))
+ACCESS_CACHE_SIZE = int(os.getenv("ACCESS_CACHE_SIZE", "10000"))
+
+ACCESS_DENIED_TEXT = "Доступ запрещен. Обратитесь к администратору."
+
+ALLOWED_USER_IDS = frozenset(get_allowed_user_ids())
+
+_levels = LRUCache(maxsize=ACCESS_CACHE_SIZE, ttl=ACCESS_CACHE_TTL)
+_denied = LRUCache(maxsize=ACCESS_CACHE_SIZE, ttl=ACCESS_NEGATIVE_TTL)
+_metrics = {
+    "checks": 0,
+    "db_lookups": 0,
+    "denied": 0,
+    "denied_by_event": {}
+}
+
+async def get_access_level(telegram_id: int, session_factory=AsyncSessionLocal) -> AccessLevel:
+    """Уровень доступа пользователя (allowlist, затем кэш, затем БД)."""
+    _metrics["checks"] += 1
+    if telegram_id in ALLOWED_USER_IDS:
+        return AccessLevel.admin
+    level = _levels.get(telegram_id)
+    if level is not None:
+        return level
+    if _denied.get(telegram_id) is not None:
+        return AccessLevel.none
+    _metrics["db_lookups"] += 1
+    async with session_factory() as session:
+        level = await session.scalar(
+            select(User.access_level).where(User.telegram_id == str(telegram_id)).order_by(User.id).limit(1)
+        )
+    if level is None or level == AccessLevel.none:
+        _denied.set(telegram_id, True)
+        return AccessLevel.none
+    _levels.set(telegram_id, level)
+    return level
+
+async def _deny(event) -> None:
+    _metrics["denied"] += 1
+    event_type = event.event_type if isinstance(event, Update) else type(event).__name__
+    _metrics["denied_by_event"][event_type] = _metrics["denied_by_event"].get(event_type, 0) + 1
+    target = event.event if isinstance(event, Update) else event
+    try:
+        if getattr(target, "message_id", None) is not None and hasattr(target, "reply"):
+            await target.reply(ACCESS_DENIED_TEXT)
+        elif hasattr(target, "answer") and getattr(target, "data", None) is not None:
+            await target.answer(ACCESS_DENIED_TEXT, show_alert=True)
+    except Exception as e:
+        logger.debug(f"Cannot notify user about denied access: {e}")
+
+class AccessMiddleware(BaseMiddleware):
+    """Пропускает апдейт только пользователям с уровнем не ниже min_level."""
+
+    def __init__(self, min_level: AccessLevel = AccessLevel.user):
+        self.min_level = min_level
+
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        if user is None:
+            return await handler(event, data)
+        level = await get_access_level(user.id)
+        data["access_level"] = level
+        if level < self.min_level:
+            await _deny(event)
+            return None
+        return await handler(event, data)
 
-def access_required(session_factory, min_level=AccessLevel.user):
-    """
-    Decorator for Telegram bot handlers to restrict access by user_id.
-    session_factory: function returning a new SQLAlchemy session
-    min_level: minimal access level required (enum)
-    """
-    def decorator(handler):
-        @functools.wraps(handler)
-        async def wrapper(event, *args, **kwargs):
-            user_id = getattr(event.from_user, 'id', None) or getattr(event, 'from_user', None)
-            if user_id is None:
-                return
-            session: Session = session_factory()
-            try:
-                user = session.query(User).filter(User.id == user_id).first()
-                if not user or user.access_level < min_level:
-                    # Optionally send a message to the user here
-                    return
-            finally:
-                session.close()
-            return await handler(event, *args, **kwargs)
-        return wrapper
-    return decorator
+def access_stats() -> dict:
+    """Метрики контроля доступа: проверки, запросы в БД, отказы, состояние кэшей."""
+    return {
+        **_metrics,
+        "allowlist_size": len(ALLOWED_USER_IDS),
+        "cache": _levels.stats(),
+        "negative_cache": _denied.stats()
+    }
@@ -1,7 +1,7 @@
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
-from app.db_utils import add_token_history, get_user_by_username, save_token_chain, get_password_by_login
+from app.db_utils import add_token_history, get_user_by_username, save_token_chain, get_password_by_login, get_account_password
 from app.wialon_api import check_token, create_token, get_available_objects
-from app.models import MasterToken, User, WialonAccount, Token, TokenType
+from app.models import User, WialonAccount, Token, TokenType
 import datetime
 import json
 
@@ -10,19 +10,29 @@ from aiogram import Bot, Dispatcher, types
 from aiogram.enums import ParseMode
 from aiogram.filters import Command, StateFilter
 from aiogram.fsm.context import FSMContext
-from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.types import FSInputFile
-from app.scraper import wialon_login_and_get_url, make_api_request
-from app.utils import logger, get_env_variable, get_bool_env_variable, is_user_allowed, encrypt_password, decrypt_password
+from app.scraper import wialon_login_and_get_url, make_api_request, close_http_session
+from app.utils import logger, get_env_variable, get_bool_env_variable, encrypt_password, decrypt_password
 from app.database import AsyncSessionLocal, check_db_connection
-from app.db_utils import create_or_update_user, get_all_user_tokens, get_user_by_username
+from app.history_writer import history_writer
+from app.history_partitions import history_maintenance_loop, prepare_history_partitions
+from app.token_sweeper import token_sweeper_loop
+from app.fsm_storage import DBStorage, FSMFlushMiddleware, fsm_eviction_loop
+from app.secret_cache import secret_sweep_loop
+from app.webhook import update_queue, WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_SECRET
+from app.jobs import job_runner, JobContext
+from app.access_control import AccessMiddleware
+from app.send_scheduler import send_scheduler
+from app.db_utils import create_or_update_user, get_all_user_tokens, get_user_by_username, get_tokens_page
 from app.bot_utils import (
-    choose_check_mode, get_tor_choice_keyboard, get_manual_token_keyboard, get_confirm_delete_all_keyboard, get_connection_choice_keyboard, get_saved_creds_connection_keyboard,
-    handle_check_token_manual, handle_token_input, handle_check_specific_token, handle_check_mode_choice
+    choose_check_mode, get_tor_choice_keyboard, get_manual_token_keyboard, get_confirm_delete_all_keyboard, get_connection_choice_keyboard, get_saved_creds_connection_keyboard, get_tokens_page_keyboard,
+    handle_check_token_manual, handle_token_input, handle_check_mode_choice
 )
 from app.handlers_login import router as login_router
 from app.handlers_history import router as history_router
 from app.handlers_delete import router as delete_router
+from app.handlers_export import router as export_router
+from app.handlers_inline import router as inline_router
 from app.states import GetTokenStates, CustomTokenStates  # Обновлен импорт
 from sqlalchemy import select
 from aiogram.fsm.state import State, StatesGroup
@@ -30,7 +40,14 @@ from sqlalchemy.orm import selectinload
 
 # Получаем токен бота из переменных окружения
 bot = Bot(token=get_env_variable("BOT_TOKEN"))
-dp = Dispatcher(storage=MemoryStorage())
+# Все отправки и правки сообщений проходят через лимиты Telegram (app.send_scheduler)
+bot.session.middleware(send_scheduler)
+fsm_storage = DBStorage()
+dp = Dispatcher(storage=fsm_storage)
+# Уровень доступа проверяется один раз на апдейт для всех обработчиков и роутеров
+dp.update.outer_middleware(AccessMiddleware())
+# Изменения FSM за время обработки апдейта записываются в БД одним запросом
+dp.update.outer_middleware(FSMFlushMiddleware(fsm_storage))
 
 # --- Регистрация нового handler для логина ---
 dp.include_router(login_router)
@@ -41,6 +58,12 @@ dp.include_router(history_router)
 # --- Регистрация нового handler для удаления токенов ---
 dp.include_router(delete_router)
 
+# --- Регистрация handler для экспорта токенов ---
+dp.include_router(export_router)
+
+# --- Регистрация handler для inline-поиска токенов ---
+dp.include_router(inline_router)
+
 class TokenCreateStates(StatesGroup):
     choose_login = State()
     choose_master = State()
@@ -53,10 +76,6 @@ class TokenCreateStates(StatesGroup):
 @dp.message(Command(commands=['start', 'help']))
 async def start_command(message: types.Message):
     """Обработчик команды /start и /help."""
-    if not is_user_allowed(message.from_user.id):
-        await message.reply("Доступ запрещен. Обратитесь к администратору.")
-        return
-
     help_text = """
 🤖 Wialon Token Bot
 
@@ -66,6 +85,7 @@ async def start_command(message: types.Message):
 /token_update - Обновить существующий токен
 /check_token - Проверить Access Token и получить данные сессии
 /my_tokens - Показать все ваши токены
+/export_tokens - Экспорт токенов (CSV/XLSX/JSONL)
 /help - Показать это сообщение
     """
     await message.reply(help_text, parse_mode=ParseMode.HTML)
@@ -179,14 +199,14 @@ async def token_create_choose_duration(callback_query: types.CallbackQuery, stat
         await state.set_state(TokenCreateStates.duration_manual)
         return
     await state.update_data(duration=int(duration))
-    await create_token_api(callback_query.message, state)
+    await create_token_api(callback_query.message, state, callback_query.from_user.id)
 
 @dp.message(TokenCreateStates.duration_manual)
 async def token_create_duration_manual(message: types.Message, state: FSMContext):
     try:
         duration = int(message.text.strip())
         await state.update_data(duration=duration)
-        await create_token_api(message, state)
+        await create_token_api(message, state, message.from_user.id)
     except Exception:
         await message.reply("Некорректная длительность. Введите число в секундах:")
 
@@ -197,84 +217,96 @@ def parse_uacl(uacl: str) -> int:
     return int(uacl, 0)
 
 # --- Исправленный create_token_api ---
-async def create_token_api(message, state):
+async def create_token_api(message, state, user_id: int):
+    """Поставить создание токена через API в фоновую задачу (данные берутся из FSM, user_id - владелец задачи)."""
     data = await state.get_data()
-    master_token = data.get("master_token")
-    uacl = data.get("uacl", "0xFFFFFFFF")
-    duration = data.get("duration", 0)
-    username = data.get("username")
-    use_tor = data.get("use_tor", True)
+    await state.clear()
+    status_message = await message.reply("🔄 Создаем токен через API...")
+    await job_runner.submit(
+        "create_token_api", status_message, _create_token_api_job, user_id=user_id,
+        master_token=data.get("master_token"),
+        uacl=data.get("uacl", "0xFFFFFFFF"),
+        duration=data.get("duration", 0),
+        username=data.get("username"),
+        use_tor=data.get("use_tor", True)
+    )
+
+async def _create_token_api_job(ctx: JobContext, master_token: str, uacl: str, duration: int, username: str, use_tor: bool) -> dict:
+    """Фоновая задача: token/login мастер-токеном, token/update и сохранение нового токена."""
     fl_value = parse_uacl(uacl)
     logger.info(f"[create_token_api] Старт создания токена через API: master_token={master_token[:8]}..., uacl={uacl}, fl={fl_value}, duration={duration}, username={username}, use_tor={use_tor}")
-    try:
-        wialon_api_url = get_env_variable("WIALON_API_URL", "https://hst-api.wialon.com/wialon/ajax.html")
-        # 1. Логин через token/login
-        login_params = {
-            "svc": "token/login",
-            "params": json.dumps({"token": master_token, "fl": 7})
-        }
-        logger.info(f"[create_token_api] login_params: {login_params}")
-        login_result = await make_api_request(wialon_api_url, login_params, use_tor=use_tor)
-        logger.info(f"[create_token_api] login_result: {login_result}")
-        if "error" in login_result:
-            await message.reply(f"Ошибка авторизации: {login_result.get('error')} {login_result.get('reason', '')}")
-            logger.error(f"[create_token_api] Ошибка авторизации: {login_result}")
-            await state.clear()
-            return
-        session_id = login_result.get("eid")
-        user_id = login_result.get("user", {}).get("id")
-        if not session_id or not user_id:
-            await message.reply("❌ Не удалось получить ID сессии или пользователя")
-            logger.error(f"[create_token_api] Нет session_id или user_id: {login_result}")
-            await state.clear()
-            return
-        # 2. Создание токена через token/update
-        params = {
-            "callMode": "create",
-            "userId": int(user_id),
-            "h": "TOKEN",
-            "app": "Wialon Hosting Custom Token",
-            "at": 0,
-            "dur": int(duration),
-            "fl": fl_value,
-            "p": "{}",
-            "items": []
-        }
-        logger.info(f"[create_token_api] create_params: {params}")
-        create_params = {
-            "svc": "token/update",
-            "params": json.dumps(params),
-            "sid": session_id
-        }
-        logger.info(f"[create_token_api] create_params (final): {create_params}")
-        create_result = await make_api_request(wialon_api_url, create_params, use_tor=use_tor)
-        logger.info(f"[create_token_api] create_result: {create_result}")
-        if "error" in create_result:
-            await message.reply(f"❌ Ошибка создания токена: {create_result.get('reason', create_result.get('error'))}")
-            logger.error(f"[create_token_api] Ошибка создания токена: {create_result}")
-            await state.clear()
-            return
-        new_token = create_result.get("h")
-        if not new_token:
-            await message.reply("❌ Не удалось создать токен")
-            logger.error(f"[create_token_api] Не удалось получить новый токен из ответа: {create_result}")
-            await state.clear()
-            return
-        # Сохраняем новый токен в базу, привязываем к логину/мастер-токену
-        async with AsyncSessionLocal() as session:
-            account = await session.scalar(select(WialonAccount).where(WialonAccount.username == username))
-            from app.db_utils import add_token
-            await add_token(session, account.id, new_token, parent_token=master_token)
-        await state.update_data(last_created_token=new_token)
-        await message.reply(
-            f"✅ Токен успешно создан: <code>{new_token}</code>\nПроверьте его через /check_token",
-            parse_mode="HTML"
-        )
-        logger.info(f"[create_token_api] Токен успешно создан: {new_token}")
-    except Exception as e:
-        logger.error(f"[create_token_api] Ошибка при создании токена: {e}")
-        await message.reply(f"❌ Ошибка при создании токена: {e}")
-    await state.clear()
+    wialon_api_url = get_env_variable("WIALON_API_URL", "https://hst-api.wialon.com/wialon/ajax.html")
+    # 1. Логин через token/login
+    await ctx.progress("🔐 Авторизация мастер-токеном...", force=True)
+    login_params = {
+        "svc": "token/login",
+        "params": json.dumps({"token": master_token, "fl": 7})
+    }
+    logger.info(f"[create_token_api] login_params: {login_params}")
+    login_result = await make_api_request(wialon_api_url, login_params, use_tor=use_tor)
+    logger.info(f"[create_token_api] login_result: {login_result}")
+    if "error" in login_result:
+        await ctx.finish(f"Ошибка авторизации: {login_result.get('error')} {login_result.get('reason', '')}")
+        logger.error(f"[create_token_api] Ошибка авторизации: {login_result}")
+        return {"ok": False, "error": login_result.get("error")}
+    session_id = login_result.get("eid")
+    user_id = login_result.get("user", {}).get("id")
+    if not session_id or not user_id:
+        await ctx.finish("❌ Не удалось получить ID сессии или пользователя")
+        logger.error(f"[create_token_api] Нет session_id или user_id: {login_result}")
+        return {"ok": False}
+    # 2. Создание токена через token/update
+    await ctx.progress("🛠 Создаем токен...", force=True)
+    params = {
+        "callMode": "create",
+        "userId": int(user_id),
+        "h": "TOKEN",
+        "app": "Wialon Hosting Custom Token",
+        "at": 0,
+        "dur": int(duration),
+        "fl": fl_value,
+        "p": "{}",
+        "items": []
+    }
+    logger.info(f"[create_token_api] create_params: {params}")
+    create_params = {
+        "svc": "token/update",
+        "params": json.dumps(params),
+        "sid": session_id
+    }
+    logger.info(f"[create_token_api] create_params (final): {create_params}")
+    create_result = await make_api_request(wialon_api_url, create_params, use_tor=use_tor)
+    logger.info(f"[create_token_api] create_result: {create_result}")
+    if "error" in create_result:
+        await ctx.finish(f"❌ Ошибка создания токена: {create_result.get('reason', create_result.get('error'))}")
+        logger.error(f"[create_token_api] Ошибка создания токена: {create_result}")
+        return {"ok": False, "error": create_result.get("error")}
+    new_token = create_result.get("h")
+    if not new_token:
+        await ctx.finish("❌ Не удалось создать токен")
+        logger.error(f"[create_token_api] Не удалось получить новый токен из ответа: {create_result}")
+        return {"ok": False}
+    # Сохраняем новый токен в базу, привязываем к логину/мастер-токену
+    await ctx.progress("💾 Сохраняем токен...", force=True)
+    async with AsyncSessionLocal() as session:
+        account = await session.scalar(select(WialonAccount).where(WialonAccount.username == username))
+        from app.db_utils import add_token
+        await add_token(session, account.id, new_token, parent_token=master_token)
+    await ctx.finish(
+        f"✅ Токен успешно создан: <code>{new_token}</code>\nПроверьте его через /check_token",
+        parse_mode="HTML"
+    )
+    logger.info(f"[create_token_api] Токен успешно создан: {new_token}")
+    return {"ok": True, "token_prefix": new_token[:8]}
+
+@dp.callback_query(lambda c: c.data.startswith("job_cancel:"))
+async def job_cancel_callback(callback_query: types.CallbackQuery):
+    """Отмена фоновой задачи кнопкой под статусным сообщением."""
+    job_id = int(callback_query.data.split(":", 1)[1])
+    if await job_runner.cancel(job_id, user_id=callback_query.from_user.id):
+        await callback_query.answer("Задача отменяется...")
+    else:
+        await callback_query.answer("Задача уже завершена или недоступна", show_alert=True)
 
 @dp.callback_query(lambda c: c.data == "check_token_by_value")
 async def check_token_by_value(callback_query: types.CallbackQuery, state: FSMContext):
@@ -448,79 +480,82 @@ async def process_saved_creds_connection(callback_query: types.CallbackQuery, st
         f"🔄 Получаем токен для <b>{credentials['username']}</b> {'через Tor' if use_tor else 'напрямую'}...",
         parse_mode=ParseMode.HTML
     )
-    
+    await job_runner.submit(
+        "get_token_saved_creds", status_message, _saved_creds_token_job, user_id=callback_query.from_user.id,
+        telegram_user_id=callback_query.from_user.id, credentials=credentials, use_tor=use_tor
+    )
+
+async def _saved_creds_token_job(ctx: JobContext, telegram_user_id: int, credentials: dict, use_tor: bool) -> dict:
+    """Фоновая задача: логин в Wialon с сохраненными данными и сохранение токена."""
+    logger.info(f"[process_saved_creds_connection] Начало получения токена для user_id={telegram_user_id}, username={credentials['username']}, use_tor={use_tor}")
+    # Получаем URL Wialon из переменных окружения
     try:
-        logger.info(f"[process_saved_creds_connection] Начало получения токена для user_id={callback_query.from_user.id}, username={credentials['username']}, use_tor={use_tor}")
-        # Получаем URL Wialon из переменных окружения
-        try:
-            wialon_url = get_env_variable("WIALON_BASE_URL")
-        except Exception as e:
-            logger.warning(f"[process_saved_creds_connection] Не удалось получить WIALON_BASE_URL: {e}")
-            wialon_url = "https://hosting.wialon.com/login.html?duration=0"
-            logger.info(f"[process_saved_creds_connection] Используется дефолтный URL: {wialon_url}")
-            
-        # Запускаем процесс авторизации с сохраненными данными
-        result = await wialon_login_and_get_url(
-            credentials['username'], 
-            credentials['password'], 
-            wialon_url,
-            use_tor=use_tor
-        )
-        logger.info(f"[process_saved_creds_connection] Ответ от wialon_login_and_get_url: {str(result)[:300]}")
-        
-        # Проверяем, что получили строку (старый формат) или словарь (новый формат)
-        if isinstance(result, dict):
-            token = result.get("token", "")
-            full_url = result.get("url", "")
-        else:
-            # Обратная совместимость
-            token = extract_token_from_url(result)
-            full_url = result
-        logger.info(f"[process_saved_creds_connection] Извлечён токен: {token[:8]}... (длина {len(token)})")
-        
-        if token:
-            async with AsyncSessionLocal() as session:
-                await add_token(session, callback_query.from_user.id, token)
-            
-            # Сохраняем информацию о токене
-            token_info = {
-                "user_name": credentials['username'],
-                "created_at": int(time.time()),
-                "created_via": "saved_credentials",
-                "token_metadata": {
-                    "username": credentials['username'],
-                    "password": credentials['password'],
-                    "host": wialon_url
-                }
-            }
-            async with AsyncSessionLocal() as session:
-                await update_token_info(session, callback_query.from_user.id, token, token_info)
-            
-            # Формируем текст сообщения
-            url_info = f"\n\n🌐 <b>URL:</b>\n<code>{full_url}</code>" if full_url else ""
-            
-            await status_message.edit_text(
-                f"✅ Токен успешно получен и сохранен!\n\n"
-                f"🔑 <code>{token}</code>"
-                f"{url_info}",
-                parse_mode=ParseMode.HTML
-            )
-            logger.info(f"[process_saved_creds_connection] Токен успешно сохранён для user_id={callback_query.from_user.id}")
-        else:
-            # В случае, если токен не был извлечен
-            url_display = full_url if isinstance(full_url, str) else str(result)
-            logger.warning(f"[process_saved_creds_connection] Не удалось извлечь токен. Ответ: {str(result)[:300]}")
-            await status_message.edit_text(
-                f"⚠️ Не удалось извлечь токен из полученного результата.\n\n"
-                f"Результат: <code>{url_display}</code>",
-                parse_mode=ParseMode.HTML
-            )
+        wialon_url = get_env_variable("WIALON_BASE_URL")
     except Exception as e:
-        logger.error(f"[process_saved_creds_connection] Ошибка при получении токена: {e}", exc_info=True)
-        await status_message.edit_text(
-            f"❌ Ошибка при получении токена: {str(e)}",
+        logger.warning(f"[process_saved_creds_connection] Не удалось получить WIALON_BASE_URL: {e}")
+        wialon_url = "https://hosting.wialon.com/login.html?duration=0"
+        logger.info(f"[process_saved_creds_connection] Используется дефолтный URL: {wialon_url}")
+
+    # Запускаем процесс авторизации с сохраненными данными
+    await ctx.progress(f"🔐 Вход в Wialon для <b>{credentials['username']}</b>...", parse_mode=ParseMode.HTML, force=True)
+    result = await wialon_login_and_get_url(
+        credentials['username'],
+        credentials['password'],
+        wialon_url,
+        use_tor=use_tor
+    )
+    logger.info(f"[process_saved_creds_connection] Ответ от wialon_login_and_get_url: {str(result)[:300]}")
+
+    # Проверяем, что получили строку (старый формат) или словарь (новый формат)
+    if isinstance(result, dict):
+        token = result.get("token", "")
+        full_url = result.get("url", "")
+    else:
+        # Обратная совместимость
+        token = extract_token_from_url(result)
+        full_url = result
+    logger.info(f"[process_saved_creds_connection] Извлечён токен: {token[:8]}... (длина {len(token)})")
+
+    if not token:
+        # В случае, если токен не был извлечен
+        url_display = full_url if isinstance(full_url, str) else str(result)
+        logger.warning(f"[process_saved_creds_connection] Не удалось извлечь токен. Ответ: {str(result)[:300]}")
+        await ctx.finish(
+            f"⚠️ Не удалось извлечь токен из полученного результата.\n\n"
+            f"Результат: <code>{url_display}</code>",
             parse_mode=ParseMode.HTML
         )
+        return {"ok": False}
+
+    await ctx.progress("💾 Сохраняем токен...", force=True)
+    async with AsyncSessionLocal() as session:
+        await add_token(session, telegram_user_id, token)
+
+    # Сохраняем информацию о токене
+    token_info = {
+        "user_name": credentials['username'],
+        "created_at": int(time.time()),
+        "created_via": "saved_credentials",
+        "token_metadata": {
+            "username": credentials['username'],
+            "password": credentials['password'],
+            "host": wialon_url
+        }
+    }
+    async with AsyncSessionLocal() as session:
+        await update_token_info(session, telegram_user_id, token, token_info)
+
+    # Формируем текст сообщения
+    url_info = f"\n\n🌐 <b>URL:</b>\n<code>{full_url}</code>" if full_url else ""
+
+    await ctx.finish(
+        f"✅ Токен успешно получен и сохранен!\n\n"
+        f"🔑 <code>{token}</code>"
+        f"{url_info}",
+        parse_mode=ParseMode.HTML
+    )
+    logger.info(f"[process_saved_creds_connection] Токен успешно сохранён для user_id={telegram_user_id}")
+    return {"ok": True, "username": credentials['username'], "token_prefix": token[:8]}
 
 async def check_token_process(message: types.Message, token: str, use_tor: bool = None, state: FSMContext = None):
     """
@@ -551,10 +586,63 @@ async def check_token_process(message: types.Message, token: str, use_tor: bool
     except Exception as e:
         await status_msg.edit_text(f"❌ Ошибка при проверке токена: {str(e)}")
 
+async def _start_background_tasks() -> list:
+    # Партиция текущего месяца должна существовать до первой записи истории
+    await prepare_history_partitions()
+    await history_writer.start()
+    await job_runner.start(bot)
+    return [
+        asyncio.create_task(history_maintenance_loop()),
+        asyncio.create_task(token_sweeper_loop(bot)),
+        asyncio.create_task(fsm_eviction_loop(fsm_storage)),
+        asyncio.create_task(secret_sweep_loop())
+    ]
+
+async def _stop_background_tasks(tasks: list) -> None:
+    for task in tasks:
+        task.cancel()
+    await job_runner.stop()
+    await fsm_storage.flush()
+    await close_http_session()
+    # Гарантированно сбрасываем накопленную историю перед выходом
+    await history_writer.stop()
+
 async def start_telegram_bot():
-    """Запускает Telegram бота."""
+    """Запускает Telegram бота (long polling)."""
     logger.info("Starting Telegram bot...")
-    await dp.start_polling(bot)
+    tasks = await _start_background_tasks()
+    try:
+        # Сессию закрываем сами: при остановке задачи еще правят свои статусные сообщения
+        await dp.start_polling(bot, close_bot_session=False)
+    finally:
+        await _stop_background_tasks(tasks)
+        await bot.session.close()
+
+_webhook_tasks = []
+
+async def start_webhook_bot():
+    """Запускает бота в режиме webhook: воркеры очереди апдейтов и регистрация webhook в Telegram."""
+    if not WEBHOOK_SECRET:
+        # Без секрета любой, кто достучится до эндпоинта, может подделать апдейт от имени администратора
+        raise RuntimeError("WEBHOOK_SECRET must be set when BOT_MODE=webhook")
+    logger.info("Starting Telegram bot in webhook mode...")
+    _webhook_tasks[:] = await _start_background_tasks()
+    await update_queue.start(bot, dp)
+    if WEBHOOK_URL:
+        await bot.set_webhook(
+            WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=dp.resolve_used_update_types()
+        )
+    else:
+        logger.warning("WEBHOOK_URL is not set, webhook must be registered manually")
+
+async def stop_webhook_bot():
+    """Дообрабатывает принятые апдейты и останавливает фоновые задачи."""
+    await update_queue.stop()
+    await _stop_background_tasks(_webhook_tasks)
+    _webhook_tasks.clear()
+    await bot.session.close()
 
 async def main():
     """Основная функция для запуска бота."""
@@ -610,12 +698,8 @@ async def delete_login_command(message: types.Message):
 @dp.message(Command(commands=['token_create_custom']))
 async def token_create_custom_command(message: types.Message, state: FSMContext):
     """Начать процесс создания кастомного токена с выбором прав и срока действия."""
-    if not is_user_allowed(message.from_user.id):
-        await message.reply("Доступ запрещен. Обратитесь к администратору.")
-        return
-
     async with AsyncSessionLocal() as session:
-        user_tokens = await get_all_user_tokens(session)
+        user_tokens = await get_all_user_tokens(session, limit=5)
 
     buttons = []
     # Добавляем кнопку для ручного ввода
@@ -627,7 +711,7 @@ async def token_create_custom_command(message: types.Message, state: FSMContext)
     ])
 
     if user_tokens:
-        for i, token_data in enumerate(user_tokens[:5]):
+        for i, token_data in enumerate(user_tokens):
             token = token_data["token"]
             user_info = f" ({token_data['user_name']})" if token_data.get('user_name') else ""
             buttons.insert(i, [
@@ -898,7 +982,7 @@ async def process_saved_account_choice(callback_query: types.CallbackQuery, stat
             await callback_query.message.edit_text("❌ Ошибка: логин не найден в базе.")
             logger.debug(f"[process_saved_account_choice] account not found for username={username}")
             return
-        password = decrypt_password(account.encrypted_password)
+        password = await get_account_password(account)
         logger.debug(f"[process_saved_account_choice] password={'***' if password else None}")
         # Ищем мастер-токены для этого аккаунта
         tokens = await session.execute(select(Token).where(Token.account_id == account.id, Token.token_type == TokenType.MASTER))
@@ -1075,68 +1159,68 @@ async def get_token_connection_mode(callback_query: types.CallbackQuery, state:
     
     # Определяем, использовать ли Tor
     use_tor = callback_query.data.split(":")[1] == "yes"
-    await state.update_data(use_tor=use_tor)
     
     # Отображаем сообщение о процессе
     status_message = await callback_query.message.edit_text(
         f"🔄 Получаем токен для <b>{username}</b> {'через Tor' if use_tor else 'напрямую'}...",
         parse_mode=ParseMode.HTML
     )
-    
-    try:
-        # Получаем URL Wialon из переменных окружения
-        wialon_url = get_env_variable("WIALON_BASE_URL")
-        
-        # Запускаем процесс авторизации
-        result = await wialon_login_and_get_url(
-            username, 
-            password, 
-            wialon_url,
-            use_tor=use_tor
-        )
-        
-        if not result or not result.get('token') or not isinstance(result["token"], str) or len(result["token"]) < 20 or "Error" in result["token"]:
-            error_msg = result.get("error") or result.get("token") or "Не удалось получить токен."
-            screenshot = result.get("screenshot")
-            msg = f"❌ Ошибка входа в Wialon: {error_msg}"
-            if screenshot:
-                msg += f"\nСкриншот: {screenshot}"
-            await status_message.edit_text(msg)
-            logger.error(f"[get_token_connection_mode] невалидный токен: {error_msg}")
-            return
-        
-        token = result['token']
-        
-        # Сохраняем только мастер-токен (child-токены только через API!)
-        async with AsyncSessionLocal() as session:
-            await save_token_chain(
-                session,
-                username=username,  # логин Wialon
-                password=password,  # пароль Wialon
-                master_token=token,  # это мастер-токен!
-                creation_method="LOGIN",
-                token_metadata={
-                    'connection_type': 'tor' if use_tor else 'direct',
-                    'user_agent': result.get('user', {}).get('au'),
-                    'company': result.get('user', {}).get('crt')
-                }
-            )
-        
-        # Отправляем сообщение об успехе
-        await status_message.edit_text(
-            f"✅ Токен успешно получен и сохранён!\n\n"
-            f"🔑 Токен: <code>{token}</code>",
-            parse_mode=ParseMode.HTML
-        )
-        
-    except Exception as e:
-        logger.error(f"Ошибка при получении токена: {str(e)}")
-        await status_message.edit_text(
-            f"❌ Произошла ошибка: {str(e)}",
-            parse_mode=ParseMode.HTML
+    # Логин через браузер выполняется в фоновой задаче, учетные данные передаются в нее
+    await state.clear()
+    await job_runner.submit(
+        "get_token", status_message, _get_token_job, user_id=callback_query.from_user.id,
+        username=username, password=password, use_tor=use_tor
+    )
+
+async def _get_token_job(ctx: JobContext, username: str, password: str, use_tor: bool) -> dict:
+    """Фоновая задача: логин в Wialon через браузер и сохранение мастер-токена."""
+    # Получаем URL Wialon из переменных окружения
+    wialon_url = get_env_variable("WIALON_BASE_URL")
+
+    # Запускаем процесс авторизации
+    await ctx.progress(f"🔐 Вход в Wialon для <b>{username}</b>...", parse_mode=ParseMode.HTML, force=True)
+    result = await wialon_login_and_get_url(
+        username,
+        password,
+        wialon_url,
+        use_tor=use_tor
+    )
+
+    if not result or not result.get('token') or not isinstance(result["token"], str) or len(result["token"]) < 20 or "Error" in result["token"]:
+        error_msg = result.get("error") or result.get("token") or "Не удалось получить токен."
+        screenshot = result.get("screenshot")
+        msg = f"❌ Ошибка входа в Wialon: {error_msg}"
+        if screenshot:
+            msg += f"\nСкриншот: {screenshot}"
+        await ctx.finish(msg)
+        logger.error(f"[get_token_connection_mode] невалидный токен: {error_msg}")
+        return {"ok": False, "error": str(error_msg)}
+
+    token = result['token']
+
+    # Сохраняем только мастер-токен (child-токены только через API!)
+    await ctx.progress("💾 Сохраняем токен...", force=True)
+    async with AsyncSessionLocal() as session:
+        await save_token_chain(
+            session,
+            username=username,  # логин Wialon
+            password=password,  # пароль Wialon
+            master_token=token,  # это мастер-токен!
+            creation_method="LOGIN",
+            token_metadata={
+                'connection_type': 'tor' if use_tor else 'direct',
+                'user_agent': result.get('user', {}).get('au'),
+                'company': result.get('user', {}).get('crt')
+            }
         )
-    finally:
-        await state.clear()
+
+    # Отправляем сообщение об успехе
+    await ctx.finish(
+        f"✅ Токен успешно получен и сохранён!\n\n"
+        f"🔑 Токен: <code>{token}</code>",
+        parse_mode=ParseMode.HTML
+    )
+    return {"ok": True, "username": username, "token_prefix": token[:8]}
 
 async def process_token_duration(message: types.Message, state: FSMContext):
     try:
@@ -1215,35 +1299,52 @@ async def check_token_choose(callback_query: types.CallbackQuery, state: FSMCont
         await callback_query.message.edit_text(f"❌ Ошибка при проверке токена: {str(e)}")
     await state.clear()
 
+def render_tokens_page(tokens: list) -> str:
+    """Сформировать текст одной страницы /my_tokens."""
+    lines = []
+    for t in tokens:
+        created_str = (
+            datetime.datetime.fromisoformat(t["created_at"]).strftime('%Y-%m-%d %H:%M:%S')
+            if t.get("created_at") else "N/A"
+        )
+        line = (
+            f"👤 <b>Логин:</b> {t.get('username', 'N/A')}\n"
+            f"🔑 <b>Тип:</b> {t['type']}\n"
+            f"🕒 <b>Создан:</b> {created_str}\n"
+            f"⚙️ <b>Способ создания:</b> {t['creation_method']}\n"
+            f"<code>{t['token'][:8]}...{t['token'][-4:]}</code>"
+        )
+        if t.get("parent_token"):
+            line += f"\n🔗 <b>Мастер-токен:</b> {t['parent_token'][:8]}...{t['parent_token'][-4:]}"
+        lines.append(line)
+    text = "\n\n".join(lines)
+    return f"Ваши токены:\n\n{text}"
+
 @dp.message(Command(commands=['my_tokens']))
 async def my_tokens_command(message: types.Message):
     async with AsyncSessionLocal() as session:
-        tokens = await session.execute(select(Token).order_by(Token.created_at.desc()))
-        tokens = tokens.scalars().all()
-        if not tokens:
-            await message.reply("У вас нет сохранённых токенов.")
-            return
-        lines = []
-        for t in tokens:
-            account = None
-            if t.account_id:
-                account = await session.get(WialonAccount, t.account_id)
-            parent_token = None
-            if t.parent_token_id:
-                parent_token = await session.get(Token, t.parent_token_id)
-            created_str = (
-                datetime.datetime.fromtimestamp(t.created_at.timestamp()).strftime('%Y-%m-%d %H:%M:%S')
-                if t.created_at else "N/A"
-            )
-            line = (
-                f"👤 <b>Логин:</b> {account.username if account else 'N/A'}\n"
-                f"🔑 <b>Тип:</b> {t.token_type.value}\n"
-                f"🕒 <b>Создан:</b> {created_str}\n"
-                f"⚙️ <b>Способ создания:</b> {t.creation_method}\n"
-                f"<code>{t.token[:8]}...{t.token[-4:]}</code>"
-            )
-            if parent_token:
-                line += f"\n🔗 <b>Мастер-токен:</b> {parent_token.token[:8]}...{parent_token.token[-4:]}"
-            lines.append(line)
-        text = "\n\n".join(lines)
-        await message.reply(f"Ваши токены:\n\n{text}", parse_mode=ParseMode.HTML)
+        page = await get_tokens_page(session)
+    if not page["tokens"]:
+        await message.reply("У вас нет сохранённых токенов.")
+        return
+    await message.reply(
+        render_tokens_page(page["tokens"]),
+        reply_markup=get_tokens_page_keyboard(page["prev_cursor"], page["next_cursor"]),
+        parse_mode=ParseMode.HTML
+    )
+
+@dp.callback_query(lambda c: c.data.startswith("my_tokens:"))
+async def my_tokens_page_callback(callback_query: types.CallbackQuery):
+    """Переход на соседнюю страницу /my_tokens по курсору из callback_data."""
+    await callback_query.answer()
+    _, direction, cursor = callback_query.data.split(":", 2)
+    async with AsyncSessionLocal() as session:
+        page = await get_tokens_page(session, cursor=cursor, direction="prev" if direction == "p" else "next")
+    if not page["tokens"]:
+        await callback_query.message.edit_text("Больше токенов нет.")
+        return
+    await callback_query.message.edit_text(
+        render_tokens_page(page["tokens"]),
+        reply_markup=get_tokens_page_keyboard(page["prev_cursor"], page["next_cursor"]),
+        parse_mode=ParseMode.HTML
+    )
@@ -5,7 +5,6 @@ from app.states import GetTokenStates
 from app.utils import get_bool_env_variable
 from app.states import GetTokenStates
 from app.database import AsyncSessionLocal
-from app.db_utils import get_all_user_tokens
 from app.utils import logger
 from aiogram.enums import ParseMode
 
@@ -56,6 +55,15 @@ def get_saved_creds_connection_keyboard() -> InlineKeyboardMarkup:
     ]
     return types.InlineKeyboardMarkup(inline_keyboard=buttons)
 
+def get_tokens_page_keyboard(prev_cursor: str = None, next_cursor: str = None) -> InlineKeyboardMarkup:
+    """Клавиатура навигации по страницам /my_tokens. Курсоры передаются в callback_data."""
+    row = []
+    if prev_cursor:
+        row.append(types.InlineKeyboardButton(text="⬅️ Назад", callback_data=f"my_tokens:p:{prev_cursor}"))
+    if next_cursor:
+        row.append(types.InlineKeyboardButton(text="Далее ➡️", callback_data=f"my_tokens:n:{next_cursor}"))
+    return types.InlineKeyboardMarkup(inline_keyboard=[row] if row else [])
+
 async def choose_check_mode(message: types.Message, state: FSMContext):
     """
     Показывает пользователю выбор режима проверки токена (через Tor или напрямую).
@@ -93,22 +101,6 @@ async def handle_token_input(message, state, choose_check_mode_func):
     await state.update_data(token=token)
     await choose_check_mode_func(message, state)
 
-async def handle_check_specific_token(callback_query, state, choose_check_mode_func):
-    await callback_query.answer()
-    token_prefix = callback_query.data.split(":")[1]
-    async with AsyncSessionLocal() as session:
-        user_tokens = await get_all_user_tokens(session)
-    full_token = None
-    for token_data in user_tokens:
-        if token_data["token"].startswith(token_prefix):
-            full_token = token_data["token"]
-            break
-    if not full_token:
-        await callback_query.message.reply("❌ Токен не найден. Возможно, он был удален.")
-        return
-    await state.update_data(token=full_token)
-    await choose_check_mode_func(callback_query.message, state)
-
 async def handle_check_mode_choice(callback_query, state, check_token_process_func):
     await callback_query.answer()
     use_tor = callback_query.data.split(":")[1] == "yes"
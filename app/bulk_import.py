@@ -0,0 +1,267 @@
+"""
+Массовый импорт учетных записей Wialon и токенов из CSV/JSONL.
+
+Записи читаются потоково и обрабатываются пачками: пароли шифруются
+пачкой вне event loop, строки загружаются через COPY во временные
+staging-таблицы и сливаются в wialon_accounts/tokens через ON CONFLICT.
+
+Поля записи: username, password, master_token, child_token,
+access_rights, expires_at (ISO 8601), label.
+
+Запуск:
+    python -m app.bulk_import accounts.csv
+    python -m app.bulk_import tokens.jsonl --batch-size 2000
+"""
+import argparse
+import asyncio
+import csv
+import datetime
+import io
+import itertools
+import json
+import logging
+import os
+import time
+from typing import AsyncIterator, Iterable, Iterator, Optional, Union
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.database import AsyncSessionLocal, engine
+from app.models import Token, TokenType, TokenCreationMethod
+from app.secret_cache import secret_cache
+from app.utils import encrypt_password
+
+logger = logging.getLogger(__name__)
+
+IMPORT_BATCH_SIZE = int(os.getenv("IMPORT_BATCH_SIZE", "5000"))
+# Сколько записей читать из файла за один заход в поток
+READ_CHUNK_RECORDS = 1000
+MAX_REPORTED_REJECTS = 100
+
+# Имена enum-типов PostgreSQL для колонок tokens (text в enum неявно не приводится)
+TOKEN_TYPE_ENUM = Token.__table__.c.token_type.type.name
+CREATION_METHOD_ENUM = Token.__table__.c.creation_method.type.name
+
+_STAGING_DDL = (
+    "CREATE TEMP TABLE IF NOT EXISTS import_accounts ("
+    " username text, encrypted_password text"
+    ") ON COMMIT DELETE ROWS",
+    "CREATE TEMP TABLE IF NOT EXISTS import_tokens ("
+    " token text, token_type text, parent_token text, username text,"
+    " access_rights text, expires_at timestamp, token_metadata text"
+    ") ON COMMIT DELETE ROWS",
+)
+
+_MERGE_ACCOUNTS = text("""
+    INSERT INTO wialon_accounts (username, encrypted_password, last_used, created_at)
+    SELECT DISTINCT ON (username) username, encrypted_password, now() AT TIME ZONE 'utc', now() AT TIME ZONE 'utc'
+    FROM import_accounts
+    ORDER BY username
+    ON CONFLICT (username) DO UPDATE
+    SET encrypted_password = EXCLUDED.encrypted_password, last_used = EXCLUDED.last_used
+""")
+
+_MERGE_MASTER_TOKENS = text("""
+    INSERT INTO tokens (token, token_type, creation_method, account_id, access_rights,
+                        expires_at, status, created_at, token_metadata)
+    SELECT DISTINCT ON (s.token) s.token, CAST(s.token_type AS {token_type}), CAST(:creation_method AS {creation_method}), a.id, s.access_rights,
+           s.expires_at, 'active', now() AT TIME ZONE 'utc', s.token_metadata::json
+    FROM import_tokens s
+    LEFT JOIN wialon_accounts a ON a.username = s.username
+    WHERE s.token_type = :staged_type
+    ORDER BY s.token
+    ON CONFLICT (token) DO NOTHING
+""".format(token_type=TOKEN_TYPE_ENUM, creation_method=CREATION_METHOD_ENUM))
+
+_MERGE_CHILD_TOKENS = text("""
+    INSERT INTO tokens (token, token_type, creation_method, parent_token_id, access_rights,
+                        expires_at, status, created_at, token_metadata)
+    SELECT DISTINCT ON (s.token) s.token, CAST(s.token_type AS {token_type}), CAST(:creation_method AS {creation_method}), p.id, s.access_rights,
+           s.expires_at, 'active', now() AT TIME ZONE 'utc', s.token_metadata::json
+    FROM import_tokens s
+    JOIN tokens p ON p.token = s.parent_token
+    WHERE s.token_type = :staged_type
+    ORDER BY s.token
+    ON CONFLICT (token) DO NOTHING
+""".format(token_type=TOKEN_TYPE_ENUM, creation_method=CREATION_METHOD_ENUM))
+
+def iter_records(source: io.TextIOBase, fmt: str) -> Iterator[tuple]:
+    """Потоково читать записи из CSV или JSONL. Возвращает пары (номер строки, dict или ошибка)."""
+    if fmt == "csv":
+        reader = csv.DictReader(source)
+        for record in reader:
+            yield reader.line_num, record
+    elif fmt == "jsonl":
+        for line_num, line in enumerate(source, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                yield line_num, f"invalid JSON: {e}"
+                continue
+            yield line_num, record if isinstance(record, dict) else "record is not an object"
+    else:
+        raise ValueError(f"Unsupported import format: {fmt}")
+
+async def _records_off_loop(records: Union[Iterable[tuple], AsyncIterator[tuple]]) -> AsyncIterator[tuple]:
+    """
+    Перебрать записи, читая и разбирая файл в отдельном потоке (кусками по READ_CHUNK_RECORDS):
+    чтение загруженного файла, вытесненного на диск, не блокирует event loop.
+    """
+    if hasattr(records, "__aiter__"):
+        async for item in records:
+            yield item
+        return
+    iterator = iter(records)
+    while True:
+        chunk = await asyncio.to_thread(lambda: list(itertools.islice(iterator, READ_CHUNK_RECORDS)))
+        if not chunk:
+            return
+        for item in chunk:
+            yield item
+
+def detect_format(filename: str) -> str:
+    """Определить формат по расширению файла."""
+    return "jsonl" if filename.lower().endswith((".jsonl", ".ndjson", ".json")) else "csv"
+
+def _clean(record: dict, field: str) -> Optional[str]:
+    value = record.get(field)
+    if value is None:
+        return None
+    value = str(value).strip()
+    return value or None
+
+def _validate(record) -> tuple:
+    """Проверить запись. Возвращает (нормализованная запись, None) или (None, причина отказа)."""
+    if isinstance(record, str):
+        return None, record
+    row = {field: _clean(record, field) for field in (
+        "username", "password", "master_token", "child_token", "access_rights", "expires_at", "label"
+    )}
+    if not (row["username"] or row["master_token"]):
+        return None, "neither username nor master_token given"
+    if row["password"] and not row["username"]:
+        return None, "password without username"
+    if row["username"] and not row["password"] and not row["master_token"]:
+        return None, "username without password or master_token"
+    if row["child_token"] and not row["master_token"]:
+        return None, "child_token without master_token"
+    if row["expires_at"]:
+        try:
+            row["expires_at"] = datetime.datetime.fromisoformat(row["expires_at"])
+        except ValueError:
+            return None, f"invalid expires_at: {row['expires_at']}"
+    return row, None
+
+def _encrypt_batch(passwords: dict) -> dict:
+    """Зашифровать пароли пачкой (выполняется в отдельном потоке)."""
+    return {username: encrypt_password(password) for username, password in passwords.items()}
+
+async def _load_batch(session: AsyncSession, batch: list, report: dict) -> None:
+    passwords = {row["username"]: row["password"] for row in batch if row["password"]}
+    encrypted = await asyncio.to_thread(_encrypt_batch, passwords)
+
+    accounts = [(username, value) for username, value in encrypted.items() if value]
+    tokens = []
+    for row in batch:
+        metadata = json.dumps({"label": row["label"], "imported": True}) if row["label"] else json.dumps({"imported": True})
+        if row["master_token"]:
+            tokens.append((row["master_token"], TokenType.MASTER.name, None, row["username"],
+                           row["access_rights"], None if row["child_token"] else row["expires_at"], metadata))
+        if row["child_token"]:
+            tokens.append((row["child_token"], TokenType.CHILD.name, row["master_token"], None,
+                           row["access_rights"], row["expires_at"], metadata))
+
+    connection = await session.connection()
+    for ddl in _STAGING_DDL:
+        await connection.execute(text(ddl))
+    raw = (await connection.get_raw_connection()).driver_connection
+    if accounts:
+        await raw.copy_records_to_table(
+            "import_accounts", records=accounts, columns=["username", "encrypted_password"]
+        )
+    if tokens:
+        await raw.copy_records_to_table(
+            "import_tokens",
+            records=tokens,
+            columns=["token", "token_type", "parent_token", "username", "access_rights", "expires_at", "token_metadata"]
+        )
+
+    report["accounts"] += (await session.execute(_MERGE_ACCOUNTS)).rowcount if accounts else 0
+    method = TokenCreationMethod.MANUAL.name
+    masters = (await session.execute(_MERGE_MASTER_TOKENS, {"staged_type": TokenType.MASTER.name, "creation_method": method})).rowcount
+    children = (await session.execute(_MERGE_CHILD_TOKENS, {"staged_type": TokenType.CHILD.name, "creation_method": method})).rowcount
+    # Повторы токена внутри пачки сливаются DISTINCT ON и не считаются пропущенными
+    duplicates = sum(
+        len(staged) - len({token[0] for token in staged})
+        for staged in ([t for t in tokens if t[1] == token_type.name] for token_type in TokenType)
+    )
+    report["tokens"] += masters + children
+    report["duplicate_tokens"] += duplicates
+    report["skipped_tokens"] += len(tokens) - duplicates - masters - children
+    await session.commit()
+    secret_cache.invalidate(*(username for username, _ in accounts))
+
+async def import_records(records: Iterable[tuple], batch_size: int = IMPORT_BATCH_SIZE) -> dict:
+    """
+    Импортировать записи пачками.
+
+    Args:
+        records: Пары (номер строки, запись) из iter_records (читаются в отдельном потоке)
+        batch_size: Размер пачки
+
+    Returns:
+        dict: Отчет - прочитано строк, создано/обновлено аккаунтов, добавлено и пропущено токенов
+              (уже существуют или нет мастер-токена), повторы токенов внутри пачки,
+              отклоненные строки, скорость строк/сек
+    """
+    report = {
+        "rows": 0,
+        "accounts": 0,
+        "tokens": 0,
+        "skipped_tokens": 0,
+        "duplicate_tokens": 0,
+        "rejected": 0,
+        "rejected_rows": []
+    }
+    started = time.perf_counter()
+    batch = []
+    async with AsyncSessionLocal() as session:
+        async for line_num, record in _records_off_loop(records):
+            report["rows"] += 1
+            row, error = _validate(record)
+            if error:
+                report["rejected"] += 1
+                if len(report["rejected_rows"]) < MAX_REPORTED_REJECTS:
+                    report["rejected_rows"].append({"line": line_num, "reason": error})
+                continue
+            batch.append(row)
+            if len(batch) >= batch_size:
+                await _load_batch(session, batch, report)
+                batch = []
+                logger.info(f"Imported {report['rows']} rows ({report['rows'] / (time.perf_counter() - started):.0f} rows/s)")
+        if batch:
+            await _load_batch(session, batch, report)
+
+    elapsed = time.perf_counter() - started
+    report["seconds"] = round(elapsed, 3)
+    report["rows_per_second"] = round(report["rows"] / elapsed, 1) if elapsed else 0.0
+    return report
+
+async def _main() -> None:
+    parser = argparse.ArgumentParser(description="Массовый импорт учетных записей и токенов Wialon")
+    parser.add_argument("path", help="Файл CSV или JSONL")
+    parser.add_argument("--format", choices=["csv", "jsonl"], help="Формат файла (по умолчанию - по расширению)")
+    parser.add_argument("--batch-size", type=int, default=IMPORT_BATCH_SIZE)
+    args = parser.parse_args()
+
+    with open(args.path, newline="", encoding="utf-8") as source:
+        report = await import_records(iter_records(source, args.format or detect_format(args.path)), args.batch_size)
+    await engine.dispose()
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+if __name__ == "__main__":
+    asyncio.run(_main())
@@ -0,0 +1,78 @@
+"""
+Выполнение CPU-емких криптоопераций вне event loop.
+
+bcrypt и Fernet выполняются в отдельном ограниченном пуле потоков
+(bcrypt отпускает GIL на время хэширования, поэтому потоки работают параллельно).
+Число одновременно ожидающих операций ограничено семафором, чтобы всплеск
+регистраций не выстраивал неограниченную очередь.
+"""
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from passlib.hash import bcrypt
+
+from app.metrics import Histogram
+from app.utils import encrypt_password, decrypt_password
+
+CRYPTO_WORKERS = int(os.getenv("CRYPTO_WORKERS", str(min(4, os.cpu_count() or 1))))
+CRYPTO_MAX_PENDING = int(os.getenv("CRYPTO_MAX_PENDING", "64"))
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+
+_executor = ThreadPoolExecutor(max_workers=CRYPTO_WORKERS, thread_name_prefix="crypto")
+_pending = None
+_hasher = bcrypt.using(rounds=BCRYPT_ROUNDS)
+
+# Задержки: ожидание слота и свободного потока (общая) и выполнение (по операциям)
+wait_ms = Histogram()
+run_ms = {}
+
+def _semaphore() -> asyncio.Semaphore:
+    global _pending
+    if _pending is None:
+        _pending = asyncio.Semaphore(CRYPTO_MAX_PENDING)
+    return _pending
+
+def _timed(operation: str, func, queued: float):
+    def wrapper(*args):
+        started = time.perf_counter()
+        wait_ms.observe((started - queued) * 1000)
+        try:
+            return func(*args)
+        finally:
+            run_ms.setdefault(operation, Histogram()).observe((time.perf_counter() - started) * 1000)
+    return wrapper
+
+async def run_crypto(operation: str, func, *args):
+    """Выполнить func(*args) в пуле криптоопераций, учитывая задержки под именем operation."""
+    queued = time.perf_counter()
+    async with _semaphore():
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_executor, _timed(operation, func, queued), *args)
+
+async def hash_password(password: str) -> str:
+    """bcrypt-хэш пароля (стоимость BCRYPT_ROUNDS)."""
+    return await run_crypto("bcrypt_hash", _hasher.hash, password)
+
+async def verify_password(password: str, hashed: str) -> bool:
+    """Проверить пароль по bcrypt-хэшу."""
+    return await run_crypto("bcrypt_verify", bcrypt.verify, password, hashed)
+
+async def encrypt_password_async(password: str) -> str:
+    """encrypt_password в пуле криптоопераций."""
+    return await run_crypto("encrypt", encrypt_password, password)
+
+async def decrypt_password_async(encrypted_password: str) -> str:
+    """decrypt_password в пуле криптоопераций."""
+    return await run_crypto("decrypt", decrypt_password, encrypted_password)
+
+def crypto_stats() -> dict:
+    """Метрики пула: настройки, ожидание слота и время выполнения по операциям."""
+    return {
+        "workers": CRYPTO_WORKERS,
+        "max_pending": CRYPTO_MAX_PENDING,
+        "bcrypt_rounds": BCRYPT_ROUNDS,
+        "wait_ms": wait_ms.snapshot(),
+        "run_ms": {operation: histogram.snapshot() for operation, histogram in run_ms.items()}
+    }
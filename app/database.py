@@ -1,7 +1,15 @@
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 from app.models import Base
+from app.metrics import Histogram
+import contextvars
+import logging
 import os
+import time
+
+logger = logging.getLogger(__name__)
 
 # Настройки подключения к БД из переменных окружения
 DB_HOST = os.getenv("DB_HOST", "db")  # используем имя сервиса из docker-compose
@@ -10,17 +18,91 @@ DB_NAME = os.getenv("DB_NAME", "wialon_db")
 DB_USER = os.getenv("DB_USER", "wialon")
 DB_PASSWORD = os.getenv("DB_PASSWORD", "wialonpass")
 
-DATABASE_URL = f"postgresql+asyncpg://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
+# Настройки пула соединений
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))  # Сколько ждать свободное соединение, сек
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))  # Пересоздавать соединения старше N сек
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() in ("1", "true", "yes")
+# Кэш подготовленных выражений asyncpg (0 - выключить, нужно для pgbouncer в режиме transaction)
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "100"))
+DB_SLOW_CHECKOUT_MS = float(os.getenv("DB_SLOW_CHECKOUT_MS", "100"))
+
+DATABASE_URL = (
+    f"postgresql+asyncpg://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
+    f"?prepared_statement_cache_size={DB_STATEMENT_CACHE_SIZE}"
+)
+
+checkout_wait_ms = Histogram()
+connect_ms = Histogram()
+_pool_counters = {"checkouts": 0, "slow_checkouts": 0, "timeouts": 0, "errors": 0}
+# Время установки новых соединений внутри текущего checkout (вычитается из ожидания)
+_connect_spent = contextvars.ContextVar("connect_spent", default=0.0)
+
+class InstrumentedAsyncPool(AsyncAdaptedQueuePool):
+    """Пул соединений, замеряющий время ожидания соединения и время подключения отдельно."""
+
+    def _create_connection(self):
+        started = time.perf_counter()
+        try:
+            return super()._create_connection()
+        finally:
+            spent = time.perf_counter() - started
+            connect_ms.observe(spent * 1000)
+            _connect_spent.set(_connect_spent.get() + spent)
+
+    def _do_get(self):
+        token = _connect_spent.set(0.0)
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        except PoolTimeoutError:
+            _pool_counters["timeouts"] += 1
+            raise
+        except Exception:
+            # Ошибка подключения к БД, а не исчерпание пула
+            _pool_counters["errors"] += 1
+            raise
+        finally:
+            waited_ms = (time.perf_counter() - started - _connect_spent.get()) * 1000
+            _connect_spent.reset(token)
+            checkout_wait_ms.observe(waited_ms)
+            _pool_counters["checkouts"] += 1
+            if waited_ms >= DB_SLOW_CHECKOUT_MS:
+                _pool_counters["slow_checkouts"] += 1
+                logger.warning(
+                    f"Slow DB connection checkout: {waited_ms:.1f} ms "
+                    f"(in use {self.checkedout()}, overflow {max(self.overflow(), 0)}/{self._max_overflow})"
+                )
 
 # Создаем асинхронный движок
 engine = create_async_engine(
     DATABASE_URL,
     echo=False,  # Установите True для отладки SQL запросов
     future=True,
-    pool_size=5,
-    max_overflow=10
+    poolclass=InstrumentedAsyncPool,
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_timeout=DB_POOL_TIMEOUT,
+    pool_recycle=DB_POOL_RECYCLE,
+    pool_pre_ping=DB_POOL_PRE_PING,
+    connect_args={"statement_cache_size": DB_STATEMENT_CACHE_SIZE}
 )
 
+def pool_stats() -> dict:
+    """Состояние пула соединений, гистограммы ожидания соединения и подключения для метрик."""
+    pool = engine.sync_engine.pool
+    return {
+        "size": pool.size(),
+        "max_overflow": DB_MAX_OVERFLOW,
+        "in_use": pool.checkedout(),
+        "idle": pool.checkedin(),
+        "overflow": max(pool.overflow(), 0),
+        **_pool_counters,
+        "checkout_wait_ms": checkout_wait_ms.snapshot(),
+        "connect_ms": connect_ms.snapshot()
+    }
+
 # Создаем фабрику сессий
 AsyncSessionLocal = sessionmaker(
     bind=engine,
@@ -39,6 +121,9 @@ async def init_db():
             await conn.run_sync(Base.metadata.drop_all)
         # Создаем таблицы заново (create_all не тронет существующие)
         await conn.run_sync(Base.metadata.create_all)
+        # token_history партиционирована: без партиций в нее нельзя писать
+        from app.history_partitions import ensure_history_partitions
+        await ensure_history_partitions(conn)
 
 async def get_session() -> AsyncSession:
     """Получение сессии БД"""
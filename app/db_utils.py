@@ -1,13 +1,18 @@
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
-from app.models import User, MasterToken, TokenHistory, ChildToken, Object, TokenObjectAccess, SavedCredentials, WialonAccount, Token, TokenType, TokenCreationMethod
+from app.models import User, TokenHistory, Object, TokenObjectAccess, SavedCredentials, WialonAccount, Token, TokenType, TokenCreationMethod
 from sqlalchemy.exc import NoResultFound
-from passlib.hash import bcrypt
 from app.utils import encrypt_password, decrypt_password
+from app.cache import LRUCache
+from app.history_writer import history_writer
+from app.crypto_pool import hash_password, decrypt_password_async
+from app.secret_cache import secret_cache
 import logging
 import datetime
-from sqlalchemy import select, update
-from sqlalchemy.orm import selectinload
+import hashlib
+import os
+from sqlalchemy import select, update, tuple_, text, bindparam, func, and_, union, literal_column, DateTime, String
+from sqlalchemy.orm import selectinload, aliased
 import json
 
 logger = logging.getLogger(__name__)
@@ -38,6 +43,9 @@ async def create_or_update_user(
         User: Объект пользователя
     """
     try:
+        # Хэшируем до обращения к БД: bcrypt выполняется в пуле потоков, не блокируя event loop
+        hashed_password = await hash_password(wialon_password) if wialon_password else None
+
         # Ищем пользователя по Telegram ID
         user = await session.scalar(
             select(User).where(User.telegram_id == telegram_id)
@@ -49,7 +57,7 @@ async def create_or_update_user(
                 telegram_id=telegram_id,
                 telegram_username=username,
                 wialon_username=wialon_username,
-                wialon_password=bcrypt.hash(wialon_password) if wialon_password else None
+                wialon_password=hashed_password
             )
             session.add(user)
         else:
@@ -59,7 +67,7 @@ async def create_or_update_user(
             if wialon_username:
                 user.wialon_username = wialon_username
             if wialon_password:
-                user.wialon_password = bcrypt.hash(wialon_password)
+                user.wialon_password = hashed_password
         
         await session.commit()
         return user
@@ -74,8 +82,8 @@ async def get_user_by_telegram_id(session: AsyncSession, telegram_id: str):
     return result.scalars().first()
 
 async def create_or_update_user_by_telegram(session: AsyncSession, telegram_id: str, username: str, password: str):
+    hashed_password = await hash_password(password)
     user = await get_user_by_telegram_id(session, telegram_id)
-    hashed_password = bcrypt.hash(password)
     if user:
         user.username = username
         user.hashed_password = hashed_password
@@ -85,47 +93,379 @@ async def create_or_update_user_by_telegram(session: AsyncSession, telegram_id:
     await session.commit()
     return user
 
-async def get_all_user_tokens(session: AsyncSession) -> list:
-    """Получить все токены из истории с группировкой."""
-    try:
-        # Получаем все токены
-        tokens = await session.scalars(
-            select(Token).order_by(Token.created_at.desc())
+def _token_listing_query():
+    """Базовый запрос списка токенов: одна выборка с join аккаунта и родителя, только нужные колонки."""
+    parent = aliased(Token)
+    return (
+        select(
+            Token.id,
+            Token.token,
+            Token.short_id,
+            Token.token_type,
+            Token.creation_method,
+            Token.created_at,
+            Token.expires_at,
+            Token.status,
+            Token.token_metadata,
+            WialonAccount.username,
+            parent.token.label("parent_token"),
         )
-        
-        result = []
-        for token in tokens:
-            token_info = {
-                "token": token.token,
-                "type": token.token_type.value,
-                "creation_method": token.creation_method.value,
-                "created_at": token.created_at.isoformat(),
-                "status": token.status
-            }
-            
-            # Добавляем информацию об аккаунте, если есть
-            if token.account_id:
-                account = await session.get(WialonAccount, token.account_id)
-                if account:
-                    token_info["username"] = account.username
-            
-            # Для дочерних токенов добавляем родительский
-            if token.parent_token_id:
-                parent = await session.get(Token, token.parent_token_id)
-                if parent:
-                    token_info["parent_token"] = parent.token
-            
-            # Добавляем дополнительную информацию из метаданных токена
-            if token.token_metadata:
-                token_info.update(token.token_metadata)
-            
-            result.append(token_info)
-        
-        return result
+        .outerjoin(WialonAccount, WialonAccount.id == Token.account_id)
+        .outerjoin(parent, parent.id == Token.parent_token_id)
+    )
+
+def _token_row_to_dict(row) -> dict:
+    """Преобразовать строку из _token_listing_query в словарь, совместимый с прежним форматом."""
+    token_info = {
+        "token": row.token,
+        "short_id": row.short_id,
+        "type": row.token_type.value,
+        "creation_method": row.creation_method.value,
+        "created_at": row.created_at.isoformat() if row.created_at else None,
+        "status": row.status
+    }
+    if row.username:
+        token_info["username"] = row.username
+    if row.parent_token:
+        token_info["parent_token"] = row.parent_token
+    # Добавляем дополнительную информацию из метаданных токена
+    if row.token_metadata:
+        token_info.update(row.token_metadata)
+    return token_info
+
+async def get_all_user_tokens(
+    session: AsyncSession,
+    username: str = None,
+    account_id: int = None,
+    token_type: TokenType = None,
+    limit: int = None
+) -> list:
+    """
+    Получить токены одним запросом с фильтрацией на стороне БД.
+
+    Args:
+        session: Сессия SQLAlchemy
+        username: Логин Wialon, к аккаунту которого привязан токен
+        account_id: ID аккаунта Wialon
+        token_type: Тип токена (master/child)
+        limit: Максимальное количество токенов
+
+    Returns:
+        list: Список словарей с информацией о токенах (новые сверху)
+    """
+    try:
+        query = _token_listing_query()
+        if username is not None:
+            query = query.where(WialonAccount.username == username)
+        if account_id is not None:
+            query = query.where(Token.account_id == account_id)
+        if token_type is not None:
+            query = query.where(Token.token_type == TokenType(token_type))
+        query = query.order_by(Token.created_at.desc(), Token.id.desc())
+        if limit is not None:
+            query = query.limit(limit)
+
+        result = await session.execute(query)
+        return [_token_row_to_dict(row) for row in result]
     except Exception as e:
         logger.error(f"Error getting all tokens: {e}")
         return []
 
+EXPORT_CHUNK_SIZE = int(os.getenv("EXPORT_CHUNK_SIZE", "2000"))
+
+async def stream_tokens(
+    session: AsyncSession,
+    status: str = None,
+    created_from: datetime.datetime = None,
+    created_to: datetime.datetime = None,
+    chunk_size: int = EXPORT_CHUNK_SIZE
+):
+    """
+    Потоково выбрать токены через серверный курсор (для экспорта).
+
+    Args:
+        session: Сессия SQLAlchemy
+        status: Статус токена (active/expired/...)
+        created_from: Нижняя граница created_at (включительно)
+        created_to: Верхняя граница created_at (не включительно)
+        chunk_size: Сколько строк забирать с сервера за раз
+
+    Yields:
+        list: Пачки строк _token_listing_query (старые сверху)
+    """
+    query = _token_listing_query()
+    if status is not None:
+        query = query.where(Token.status == status)
+    if created_from is not None:
+        query = query.where(Token.created_at >= created_from)
+    if created_to is not None:
+        query = query.where(Token.created_at < created_to)
+    query = query.order_by(Token.created_at, Token.id).execution_options(yield_per=chunk_size)
+    result = await session.stream(query)
+    async for partition in result.partitions(chunk_size):
+        yield partition
+
+def _like_pattern(value: str) -> str:
+    escaped = value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return f"%{escaped}%"
+
+async def search_tokens(session: AsyncSession, query: str, limit: int = 20, ranked: bool = True) -> list:
+    """
+    Найти токены по фрагменту токена, метке (token_metadata.label) или логину аккаунта.
+
+    Args:
+        session: Сессия SQLAlchemy
+        query: Искомый фрагмент (без учета регистра)
+        limit: Максимальное количество результатов
+        ranked: Сортировать по similarity() из pg_trgm (иначе - новые сверху)
+
+    Returns:
+        list: Строки _token_listing_query
+    """
+    pattern = _like_pattern(query)
+    # Литерал, а не параметр: выражение должно совпадать с индексом ix_tokens_label_trgm
+    label = literal_column("(tokens.token_metadata ->> 'label')", type_=String)
+    # OR по трем полям (одно из них - в другой таблице) индексы не использует, поэтому
+    # кандидаты выбираются тремя запросами, каждый по своему GIN-индексу gin_trgm_ops
+    # (миграция d7b2e4f6a830) и со своим LIMIT, и объединяются через UNION
+    branches = (
+        (select(Token.id).where(Token.token.ilike(pattern, escape="\\")), Token.token),
+        (select(Token.id).where(label.ilike(pattern, escape="\\")), label),
+        (
+            select(Token.id)
+            .join(WialonAccount, WialonAccount.id == Token.account_id)
+            .where(WialonAccount.username.ilike(pattern, escape="\\")),
+            WialonAccount.username
+        ),
+    )
+    # Внутри ветки оставляем лучшие совпадения, чтобы LIMIT не отбросил их до ранжирования
+    candidates = union(*(
+        branch.order_by(func.similarity(column, query).desc() if ranked else Token.created_at.desc()).limit(limit)
+        for branch, column in branches
+    )).subquery()
+    statement = _token_listing_query().where(Token.id.in_(select(candidates.c.id)))
+    if ranked:
+        rank = func.greatest(
+            func.similarity(Token.token, query),
+            func.similarity(func.coalesce(label, ""), query),
+            func.similarity(func.coalesce(WialonAccount.username, ""), query)
+        )
+        statement = statement.order_by(rank.desc(), Token.created_at.desc())
+    else:
+        statement = statement.order_by(Token.created_at.desc())
+    return (await session.execute(statement.limit(limit))).all()
+
+SHORT_ID_LENGTH = 12
+# Горячие short_id -> токен; соответствие неизменно, поэтому TTL не нужен
+_short_id_cache = LRUCache(maxsize=int(os.getenv("SHORT_ID_CACHE_SIZE", "512")))
+
+def token_short_id(token: str) -> str:
+    """Короткий идентификатор токена для callback_data. Совпадает с выражением Token.short_id."""
+    return hashlib.md5(token.encode()).hexdigest()[:SHORT_ID_LENGTH]
+
+async def resolve_token_short_id(session: AsyncSession, short_id: str) -> str:
+    """
+    Найти полный токен по short_id (LRU-кэш, затем индексный поиск).
+
+    short_id не уникален: при коллизии префикса md5 токен нельзя определить
+    однозначно, поэтому возвращается None (как для удаленного токена).
+    """
+    token = _short_id_cache.get(short_id)
+    if token is not None:
+        return token
+    tokens = (await session.scalars(select(Token.token).where(Token.short_id == short_id).limit(2))).all()
+    if len(tokens) > 1:
+        logger.warning(f"[resolve_token_short_id] short_id collision: {short_id}")
+        return None
+    if tokens:
+        _short_id_cache.set(short_id, tokens[0])
+        return tokens[0]
+    return None
+
+def forget_token_short_id(token: str) -> None:
+    """Убрать токен из кэша short_id (после удаления токена)."""
+    _short_id_cache.pop(token_short_id(token))
+
+TOKENS_PAGE_SIZE = 10
+_CURSOR_EPOCH = datetime.datetime(1970, 1, 1)
+
+def _to_base36(value: int) -> str:
+    digits = "0123456789abcdefghijklmnopqrstuvwxyz"
+    result = ""
+    while True:
+        value, rem = divmod(value, 36)
+        result = digits[rem] + result
+        if not value:
+            return result
+
+def encode_token_cursor(created_at: datetime.datetime, token_id: int) -> str:
+    """Компактный курсор для callback_data: микросекунды created_at и id в base36."""
+    micros = (created_at - _CURSOR_EPOCH) // datetime.timedelta(microseconds=1)
+    return f"{_to_base36(micros)}.{_to_base36(token_id)}"
+
+def decode_token_cursor(cursor: str) -> tuple:
+    """Разобрать курсор, созданный encode_token_cursor. Возвращает (created_at, id)."""
+    micros, token_id = cursor.split(".", 1)
+    return _CURSOR_EPOCH + datetime.timedelta(microseconds=int(micros, 36)), int(token_id, 36)
+
+async def get_tokens_page(
+    session: AsyncSession,
+    cursor: str = None,
+    direction: str = "next",
+    limit: int = TOKENS_PAGE_SIZE,
+    username: str = None
+) -> dict:
+    """
+    Получить одну страницу токенов с keyset-пагинацией по (created_at, id).
+
+    Args:
+        session: Сессия SQLAlchemy
+        cursor: Курсор границы страницы (None - первая страница)
+        direction: "next" - более старые токены после курсора, "prev" - более новые до курсора
+        limit: Размер страницы
+        username: Логин Wialon для фильтрации
+
+    Returns:
+        dict: {"tokens": [...], "prev_cursor": str|None, "next_cursor": str|None}
+    """
+    query = _token_listing_query()
+    if username is not None:
+        query = query.where(WialonAccount.username == username)
+
+    key = tuple_(Token.created_at, Token.id)
+    backwards = cursor is not None and direction == "prev"
+    if cursor is not None:
+        created_at, token_id = decode_token_cursor(cursor)
+        query = query.where(key > (created_at, token_id) if backwards else key < (created_at, token_id))
+    if backwards:
+        query = query.order_by(Token.created_at.asc(), Token.id.asc())
+    else:
+        query = query.order_by(Token.created_at.desc(), Token.id.desc())
+
+    # Берем на одну строку больше, чтобы узнать, есть ли следующая страница
+    rows = (await session.execute(query.limit(limit + 1))).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if backwards:
+        rows.reverse()
+
+    if not rows:
+        return {"tokens": [], "prev_cursor": None, "next_cursor": None}
+
+    first = encode_token_cursor(rows[0].created_at, rows[0].id)
+    last = encode_token_cursor(rows[-1].created_at, rows[-1].id)
+    if backwards:
+        prev_cursor = first if has_more else None
+        next_cursor = last
+    else:
+        prev_cursor = first if cursor is not None else None
+        next_cursor = last if has_more else None
+
+    return {
+        "tokens": [_token_row_to_dict(row) for row in rows],
+        "prev_cursor": prev_cursor,
+        "next_cursor": next_cursor
+    }
+
+HISTORY_PAGE_SIZE = 10
+# Сводка по действиям за период: (user_id, token_id, since, until) -> {action: count}
+_history_summary_cache = LRUCache(
+    maxsize=int(os.getenv("HISTORY_SUMMARY_CACHE_SIZE", "1024")),
+    ttl=float(os.getenv("HISTORY_SUMMARY_CACHE_TTL", "60"))
+)
+
+def _history_filters(query, user_id: int, since: datetime.datetime, until: datetime.datetime, action: str = None, token_id: int = None):
+    # Ограничение по created_at отсекает лишние партиции token_history
+    query = query.where(TokenHistory.user_id == user_id, TokenHistory.created_at >= since, TokenHistory.created_at < until)
+    if action is not None:
+        query = query.where(TokenHistory.action == action)
+    if token_id is not None:
+        query = query.where(TokenHistory.token_id == token_id)
+    return query
+
+async def get_history_page(
+    session: AsyncSession,
+    user_id: int,
+    since: datetime.datetime,
+    until: datetime.datetime,
+    cursor: str = None,
+    direction: str = "next",
+    limit: int = HISTORY_PAGE_SIZE,
+    action: str = None,
+    token_id: int = None
+) -> dict:
+    """
+    Страница истории операций пользователя с keyset-пагинацией по (created_at, id).
+
+    Args:
+        session: Сессия SQLAlchemy
+        user_id: ID пользователя (users.id)
+        since: Начало периода (включительно)
+        until: Конец периода (не включительно)
+        cursor: Курсор границы страницы (None - первая страница, самые новые записи)
+        direction: "next" - более старые записи, "prev" - более новые
+        limit: Размер страницы
+        action: Фильтр по действию
+        token_id: Фильтр по токену
+
+    Returns:
+        dict: {"items": [(TokenHistory, token)], "prev_cursor": str|None, "next_cursor": str|None}
+    """
+    query = _history_filters(
+        select(TokenHistory, Token.token).outerjoin(Token, Token.id == TokenHistory.token_id),
+        user_id, since, until, action, token_id
+    )
+    key = tuple_(TokenHistory.created_at, TokenHistory.id)
+    backwards = cursor is not None and direction == "prev"
+    if cursor is not None:
+        created_at, history_id = decode_token_cursor(cursor)
+        query = query.where(key > (created_at, history_id) if backwards else key < (created_at, history_id))
+    if backwards:
+        query = query.order_by(TokenHistory.created_at.asc(), TokenHistory.id.asc())
+    else:
+        query = query.order_by(TokenHistory.created_at.desc(), TokenHistory.id.desc())
+
+    rows = (await session.execute(query.limit(limit + 1))).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if backwards:
+        rows.reverse()
+    if not rows:
+        return {"items": [], "prev_cursor": None, "next_cursor": None}
+
+    first = encode_token_cursor(rows[0][0].created_at, rows[0][0].id)
+    last = encode_token_cursor(rows[-1][0].created_at, rows[-1][0].id)
+    if backwards:
+        prev_cursor, next_cursor = (first if has_more else None), last
+    else:
+        prev_cursor, next_cursor = (first if cursor is not None else None), (last if has_more else None)
+    return {"items": [(row[0], row[1]) for row in rows], "prev_cursor": prev_cursor, "next_cursor": next_cursor}
+
+async def get_history_summary(
+    session: AsyncSession,
+    user_id: int,
+    since: datetime.datetime,
+    until: datetime.datetime,
+    token_id: int = None
+) -> dict:
+    """Количество операций по действиям за период (кэшируется на HISTORY_SUMMARY_CACHE_TTL)."""
+    key = (user_id, token_id, since, until)
+    summary = _history_summary_cache.get(key)
+    if summary is not None:
+        return summary
+    query = _history_filters(
+        select(TokenHistory.action, func.count()), user_id, since, until, token_id=token_id
+    ).group_by(TokenHistory.action)
+    summary = {action: count for action, count in (await session.execute(query)).all()}
+    _history_summary_cache.set(key, summary)
+    return summary
+
+async def resolve_history_token(session: AsyncSession, value: str) -> int:
+    """ID токена по полному значению или short_id (для фильтра истории)."""
+    return await session.scalar(
+        select(Token.id).where((Token.token == value) | (Token.short_id == value)).limit(1)
+    )
+
 async def add_token_history(session: AsyncSession, token_data: dict) -> None:
     """Добавить запись в историю токенов."""
     user_id = None
@@ -153,47 +493,43 @@ async def add_token_history(session: AsyncSession, token_data: dict) -> None:
             )
             session.add(token_obj)
             await session.commit()
+            invalidate_token_info(token_str)
         token_id = token_obj.id
 
-    token_history = TokenHistory(
-        user_id=user_id or 1,  # Используем 1 как дефолтный ID для системных операций
+    await history_writer.record(
+        user_id=user_id,  # None - системная операция (users.id = 1 может не существовать)
         token_id=token_id,
-        master_token_id=token_data.get("master_token_id"),
-        child_token_id=token_data.get("child_token_id"),
         action=token_data.get("action", "create"),
-        created_at=datetime.datetime.now(),
         details=token_data if isinstance(token_data, dict) else {"data": str(token_data)}
     )
-    session.add(token_history)
-    await session.commit()
 
 async def get_all_logins(session: AsyncSession) -> list[str]:
     """Получить список всех сохраненных логинов."""
-    query = select(SavedCredentials.login)
+    query = select(WialonAccount.username).order_by(WialonAccount.username)
     result = await session.execute(query)
     return [row[0] for row in result.all()]
 
+async def get_account_password(account: WialonAccount) -> str:
+    """Расшифрованный пароль аккаунта (через кэш секретов с коротким TTL)."""
+    password = secret_cache.get(account.username)
+    if password is None and account.encrypted_password:
+        password = await decrypt_password_async(account.encrypted_password)
+        # None - пароль не расшифровался (например, другой ключ); такой результат не кэшируем
+        if password:
+            secret_cache.set(account.username, password)
+    return password
+
 async def get_password_by_login(session: AsyncSession, login: str) -> str:
     """Получить пароль для указанного логина."""
-    query = select(SavedCredentials).where(SavedCredentials.login == login)
-    result = await session.execute(query)
-    credentials = result.scalar_one_or_none()
-    return credentials.password if credentials else None
+    password = secret_cache.get(login)
+    if password is not None:
+        return password
+    account = await session.scalar(select(WialonAccount).where(WialonAccount.username == login))
+    return await get_account_password(account) if account else None
 
 async def save_credentials(session: AsyncSession, login: str, password: str) -> None:
     """Сохранить учетные данные."""
-    # Сначала создаем или получаем пользователя
-    user = await create_or_update_user(session, login, password)
-    
-    # Теперь сохраняем учетные данные
-    credentials = SavedCredentials(
-        user_id=user.id,
-        login=login,
-        password=password,
-        created_at=datetime.datetime.now()
-    )
-    session.add(credentials)
-    await session.commit()
+    await save_wialon_credentials(session, login, password)
 
 async def save_wialon_credentials(
     session: AsyncSession,
@@ -218,6 +554,7 @@ async def save_wialon_credentials(
             )
             session.add(account)
         await session.commit()
+        secret_cache.invalidate(username)
         logger.debug(f"[save_wialon_credentials] SUCCESS: {account}")
         return account
     except Exception as e:
@@ -225,6 +562,50 @@ async def save_wialon_credentials(
         await session.rollback()
         raise
 
+# Имена enum-типов PostgreSQL для колонок tokens (text в enum неявно не приводится)
+_TOKEN_TYPE_ENUM = Token.__table__.c.token_type.type.name
+_CREATION_METHOD_ENUM = Token.__table__.c.creation_method.type.name
+
+# Вся цепочка (аккаунт -> мастер-токен -> дочерний токен) за один запрос.
+# Мастер-токен создается только если его еще нет; дочерний вставляется без
+# ON CONFLICT, чтобы дубликат, как и раньше, приводил к IntegrityError.
+_SAVE_TOKEN_CHAIN = text(f"""
+    WITH account AS (
+        INSERT INTO wialon_accounts (username, encrypted_password, created_at, last_used)
+        SELECT CAST(:username AS varchar), CAST(:encrypted_password AS varchar), :now, :now
+        WHERE CAST(:encrypted_password AS varchar) IS NOT NULL
+        ON CONFLICT (username) DO UPDATE
+        SET encrypted_password = EXCLUDED.encrypted_password, last_used = EXCLUDED.last_used
+        RETURNING id
+    ), new_master AS (
+        INSERT INTO tokens (token, token_type, creation_method, account_id, access_rights, status, created_at)
+        SELECT CAST(:master_token AS varchar), CAST('MASTER' AS {_TOKEN_TYPE_ENUM}),
+               CAST(:master_method AS {_CREATION_METHOD_ENUM}), (SELECT id FROM account),
+               CAST(:access_rights AS varchar), 'active', :now
+        WHERE CAST(:master_token AS varchar) IS NOT NULL
+        ON CONFLICT (token) DO NOTHING
+        RETURNING id
+    ), master AS (
+        SELECT id FROM new_master
+        UNION ALL
+        SELECT id FROM tokens
+        WHERE token = CAST(:master_token AS varchar) AND NOT EXISTS (SELECT 1 FROM new_master)
+    ), child AS (
+        INSERT INTO tokens (token, token_type, creation_method, parent_token_id, access_rights,
+                            expires_at, status, created_at, token_metadata)
+        SELECT CAST(:child_token AS varchar), CAST('CHILD' AS {_TOKEN_TYPE_ENUM}),
+               CAST(:child_method AS {_CREATION_METHOD_ENUM}), master.id,
+               CAST(:access_rights AS varchar), :expires_at, 'active', :now, CAST(:child_metadata AS json)
+        FROM master
+        WHERE CAST(:child_token AS varchar) IS NOT NULL
+        RETURNING id
+    )
+    SELECT (SELECT id FROM master) AS master_id, (SELECT id FROM child) AS child_id
+""").bindparams(
+    bindparam("now", type_=DateTime()),
+    bindparam("expires_at", type_=DateTime())
+)
+
 async def save_token_chain(
     session: AsyncSession,
     username: str = None,
@@ -237,99 +618,51 @@ async def save_token_chain(
     expires_at: datetime.datetime = None,
     token_metadata: dict = None
 ) -> bool:
-    """Сохранить цепочку токенов"""
+    """Сохранить цепочку токенов (один запрос и один commit)"""
+    logger.debug("[save_token_chain] username=%s, password=%s, master_token=%s, child_token=%s, creation_method=%s, access_rights=%s, duration=%s, expires_at=%s, token_metadata=%s", username, '***' if password else None, master_token, child_token, creation_method, access_rights, duration, expires_at, token_metadata)
+    if child_token and not master_token:
+        raise ValueError("Нельзя сохранить дочерний токен без мастер-токена! Передайте master_token.")
+    has_account = bool(username and password)
     try:
-        logger.debug("[save_token_chain] username=%s, password=%s, master_token=%s, child_token=%s, creation_method=%s, access_rights=%s, duration=%s, expires_at=%s, token_metadata=%s", username, '***' if password else None, master_token, child_token, creation_method, access_rights, duration, expires_at, token_metadata)
-        # Если есть учетные данные - сохраняем их
-        account = None
-        if username and password:
-            logger.debug("[save_token_chain] Before save_wialon_credentials")
-            account = await save_wialon_credentials(session, username, password)
-            logger.debug("[save_token_chain] After save_wialon_credentials: account=%s", account)
-        
-        # Если есть мастер-токен - сохраняем его
-        parent_token = None
-        if master_token:
-            logger.debug("[save_token_chain] Before session.scalar(master_token)")
-            parent_token = await session.scalar(
-                select(Token).where(Token.token == master_token)
-            )
-            logger.debug("[save_token_chain] After session.scalar(master_token): parent_token=%s", parent_token)
-            if not parent_token:
-                parent_token = Token(
-                    token=master_token,
-                    token_type=TokenType.MASTER,
-                    creation_method=TokenCreationMethod.LOGIN if account else TokenCreationMethod.MANUAL,
-                    account_id=account.id if account else None,
-                    access_rights=str(access_rights) if access_rights else None
-                )
-                session.add(parent_token)
-                await session.flush()  # Гарантируем, что у master_token есть id
-                logger.debug("[save_token_chain] After session.flush (master_token)")
-        
-        # Если есть дочерний токен - сохраняем его и привязываем к мастер-токену
-        child = None
-        if child_token:
-            logger.debug("[save_token_chain] Before Token(child_token)")
-            if not parent_token:
-                raise ValueError("Нельзя сохранить дочерний токен без мастер-токена! Передайте master_token.")
-            child = Token(
-                token=child_token,
-                token_type=TokenType.CHILD,
-                creation_method=TokenCreationMethod[creation_method.upper()],
-                parent_token_id=parent_token.id,
-                access_rights=str(access_rights) if access_rights else None,
-                expires_at=expires_at,
-                token_metadata={
-                    "duration": duration,
-                    **(token_metadata or {})
-                }
-            )
-            session.add(child)
-            await session.flush()  # Гарантируем, что у child есть id
-            logger.debug("[save_token_chain] After Token(child_token): child=%s", child)
-        
-        # Сохраняем историю
-        if child:
-            logger.debug("[save_token_chain] Before TokenHistory (child)")
-            history = TokenHistory(
-                token_id=child.id,
-                action="create",
-                details={
-                    "creation_method": creation_method,
-                    "username": username if username else None,
-                    "access_rights": access_rights,
-                    "duration": duration,
-                    **(token_metadata or {})
-                }
-            )
-            session.add(history)
-            logger.debug("[save_token_chain] After TokenHistory: history=%s", history)
-        elif parent_token:
-            logger.debug("[save_token_chain] Before TokenHistory (master)")
-            history = TokenHistory(
-                token_id=parent_token.id,
-                action="create",
-                details={
-                    "creation_method": creation_method,
-                    "username": username if username else None,
-                    "access_rights": access_rights,
-                    "duration": duration,
-                    **(token_metadata or {})
-                }
-            )
-            session.add(history)
-            logger.debug("[save_token_chain] After TokenHistory: history=%s", history)
-        
-        logger.debug("[save_token_chain] Before session.commit")
+        row = (await session.execute(_SAVE_TOKEN_CHAIN, {
+            "username": username,
+            "encrypted_password": encrypt_password(password) if has_account else None,
+            "master_token": master_token,
+            "master_method": (TokenCreationMethod.LOGIN if has_account else TokenCreationMethod.MANUAL).name,
+            "child_token": child_token,
+            "child_method": TokenCreationMethod[creation_method.upper()].name,
+            "access_rights": str(access_rights) if access_rights else None,
+            "expires_at": expires_at,
+            "child_metadata": json.dumps({"duration": duration, **(token_metadata or {})}, default=str),
+            "now": datetime.datetime.utcnow()
+        })).one()
+        if child_token and row.child_id is None:
+            # Мастер-токен вставлен параллельной транзакцией после начала нашего запроса
+            raise RuntimeError(f"Master token for child {child_token[:8]}... is not visible yet, retry")
         await session.commit()
-        logger.debug("[save_token_chain] After session.commit")
-        return True
-        
     except Exception as e:
         logger.error(f"Error saving token chain: {e}")
         await session.rollback()
         raise
+    invalidate_token_info(master_token, child_token)
+    if has_account:
+        secret_cache.invalidate(username)
+
+    # Сохраняем историю (фоновая запись)
+    history_token_id = row.child_id or row.master_id
+    if history_token_id:
+        await history_writer.record(
+            token_id=history_token_id,
+            action="create",
+            details={
+                "creation_method": creation_method,
+                "username": username if username else None,
+                "access_rights": access_rights,
+                "duration": duration,
+                **(token_metadata or {})
+            }
+        )
+    return True
 
 async def save_master_token(
     session: AsyncSession,
@@ -376,9 +709,12 @@ async def save_master_token(
             expires_at=expires_at
         )
         session.add(token_record)
-        await session.flush()  # Гарантируем, что у token_record есть id
+        await session.commit()
+        invalidate_token_info(token)
+        if account:
+            secret_cache.invalidate(username)
         # Добавляем запись в историю
-        history = TokenHistory(
+        await history_writer.record(
             token_id=token_record.id,
             action="create",
             details={
@@ -386,8 +722,6 @@ async def save_master_token(
                 "username": username if username else None
             }
         )
-        session.add(history)
-        await session.commit()
         return token_record
 
     except Exception as e:
@@ -435,9 +769,11 @@ async def save_child_token(
             token_metadata={"duration": duration} if duration else None
         )
         session.add(child)
+        await session.commit()
+        invalidate_token_info(child_token, master_token)
         
         # Добавляем запись в историю
-        history = TokenHistory(
+        await history_writer.record(
             token_id=child.id,
             action="create",
             details={
@@ -445,9 +781,6 @@ async def save_child_token(
                 "creation_method": creation_method.value
             }
         )
-        session.add(history)
-        
-        await session.commit()
         return child
 
     except Exception as e:
@@ -455,52 +788,72 @@ async def save_child_token(
         await session.rollback()
         raise
 
+# Собранная информация о токене: token -> (token_id, info)
+_token_info_cache = LRUCache(
+    maxsize=int(os.getenv("TOKEN_INFO_CACHE_SIZE", "2048")),
+    ttl=float(os.getenv("TOKEN_INFO_CACHE_TTL", "300"))
+)
+
+def invalidate_token_info(*tokens: str) -> None:
+    """Сбросить кэш get_token_info для указанных токенов (после их изменения)."""
+    for token in tokens:
+        if token:
+            _token_info_cache.pop(token)
+            # Новый токен с тем же short_id делает закэшированное соответствие неоднозначным
+            _short_id_cache.pop(token_short_id(token))
+
+def cache_stats() -> dict:
+    """Статистика in-process кэшей db_utils для метрик."""
+    return {
+        "token_info": _token_info_cache.stats(),
+        "short_id": _short_id_cache.stats(),
+        "secrets": secret_cache.stats(),
+        "history_summary": _history_summary_cache.stats()
+    }
+
 async def get_token_info(session: AsyncSession, token: str) -> dict:
-    """Получить информацию о токене"""
+    """Получить информацию о токене (read-through кэш, при промахе - один запрос с join)"""
     try:
-        token_record = await session.scalar(
-            select(Token).where(Token.token == token)
-        )
-        
-        if not token_record:
-            return None
+        cached = _token_info_cache.get(token)
+        if cached is None:
+            row = (await session.execute(
+                _token_listing_query()
+                .add_columns(Token.access_rights)
+                .where(Token.token == token)
+            )).first()
             
-        info = {
-            "token": token_record.token,
-            "type": token_record.token_type.value,
-            "creation_method": token_record.creation_method.value,
-            "status": token_record.status,
-            "created_at": token_record.created_at,
-            "expires_at": token_record.expires_at,
-            "access_rights": token_record.access_rights
-        }
-        
-        # Добавляем информацию о родительском токене
-        if token_record.parent_token_id:
-            parent = await session.get(Token, token_record.parent_token_id)
-            if parent:
-                info["parent_token"] = parent.token
-        
-        # Добавляем информацию об аккаунте
-        if token_record.account_id:
-            account = await session.get(WialonAccount, token_record.account_id)
-            if account:
-                info["username"] = account.username
-        
-        # Добавляем дополнительную информацию из метаданных токена
-        if token_record.token_metadata:
-            info.update(token_record.token_metadata)
+            if not row:
+                return None
+                
+            info = {
+                "token": row.token,
+                "type": row.token_type.value,
+                "creation_method": row.creation_method.value,
+                "status": row.status,
+                "created_at": row.created_at,
+                "expires_at": row.expires_at,
+                "access_rights": row.access_rights
+            }
+            # Информация о родительском токене и аккаунте
+            if row.parent_token:
+                info["parent_token"] = row.parent_token
+            if row.username:
+                info["username"] = row.username
+            # Добавляем дополнительную информацию из метаданных токена
+            if row.token_metadata:
+                info.update(row.token_metadata)
+            cached = (row.id, info)
+            _token_info_cache.set(token, cached)
         
-        # Логируем проверку
-        history = TokenHistory(
-            token_id=token_record.id,
+        token_id, info = cached
+        # Логируем проверку (фоновая запись, чтение остается чтением)
+        await history_writer.record(
+            token_id=token_id,
             action="check",
             details={"found_in_db": True}
         )
-        session.add(history)
-        await session.commit()
         
-        return info
+        return dict(info)
         
     except Exception as e:
         logger.error(f"Error getting token info: {e}")
@@ -523,15 +876,14 @@ async def update_token_status(
             
         token_record.status = status
         token_record.last_used = datetime.datetime.utcnow()
+        await session.commit()
+        invalidate_token_info(token)
         
-        history = TokenHistory(
+        await history_writer.record(
             token_id=token_record.id,
             action="update",
             details=details
         )
-        session.add(history)
-        
-        await session.commit()
         return True
         
     except Exception as e:
@@ -539,62 +891,121 @@ async def update_token_status(
         await session.rollback()
         return False
 
+TOKEN_TREE_MAX_DEPTH = 32  # Максимальная глубина дерева в ответе
+
+def _path_depth(path):
+    """Число уровней в материализованном пути '/1/5/9/' (SQL-выражение)."""
+    return func.length(path) - func.length(func.replace(path, "/", "")) - 1
+
 async def get_account_tokens(
     session: AsyncSession,
-    username: str
+    username: str,
+    max_depth: int = None,
+    status: str = None
 ) -> dict:
-    """Получить все токены для учетной записи"""
+    """
+    Получить дерево токенов учетной записи одним запросом по материализованному пути.
+
+    Args:
+        session: Сессия SQLAlchemy
+        username: Логин Wialon
+        max_depth: Сколько уровней дочерних токенов загружать (None - все)
+        status: Загружать только токены с этим статусом (поддеревья других токенов отсекаются)
+
+    Returns:
+        dict: {"username", "master_tokens": [...], "total_tokens", "max_depth"} или None,
+              если учетная запись не найдена. Каждый узел содержит depth, children_count,
+              descendants_count и вложенный список child_tokens.
+    """
     try:
-        # Находим аккаунт
-        account = await session.scalar(
-            select(WialonAccount).where(WialonAccount.username == username)
+        depth_limit = min(max_depth, TOKEN_TREE_MAX_DEPTH) if max_depth is not None else TOKEN_TREE_MAX_DEPTH
+
+        # Корни: мастер-токены аккаунта
+        roots = (
+            select(Token.path.label("path"))
+            .join(WialonAccount, WialonAccount.id == Token.account_id)
+            .where(
+                WialonAccount.username == username,
+                Token.token_type == TokenType.MASTER,
+                Token.path.isnot(None)
+            )
         )
-        
-        if not account:
-            return None
-            
-        # Получаем все мастер-токены для аккаунта
-        master_tokens = await session.scalars(
-            select(Token).where(
-                Token.account_id == account.id,
-                Token.token_type == TokenType.MASTER
+        if status is not None:
+            roots = roots.where(Token.status == status)
+        roots = roots.subquery("roots")
+
+        # Поддерево корня - диапазон [path, path без последнего '/' + '0') в порядке text_pattern_ops:
+        # в отличие от LIKE с префиксом из другой таблицы, такое условие использует ix_tokens_path
+        upper_bound = func.substr(roots.c.path, 1, func.length(roots.c.path) - 1).concat("0")
+        depth = (_path_depth(Token.path) - _path_depth(roots.c.path)).label("depth")
+        query = (
+            select(
+                Token.id,
+                Token.parent_token_id,
+                Token.token,
+                Token.created_at,
+                Token.status,
+                Token.expires_at,
+                depth
             )
+            .join(roots, and_(
+                Token.path.op("~>=~", is_comparison=True)(roots.c.path),
+                Token.path.op("~<~", is_comparison=True)(upper_bound)
+            ))
+            .where(depth <= depth_limit)
         )
-        
-        result = {
-            "username": account.username,
-            "master_tokens": []
-        }
-        
-        # Для каждого мастер-токена получаем дочерние
-        for master in master_tokens:
-            token_info = {
-                "token": master.token,
-                "created_at": master.created_at,
-                "status": master.status,
+        if status is not None:
+            query = query.where(Token.status == status)
+
+        rows = (await session.execute(
+            query.order_by(depth, Token.created_at, Token.id)
+        )).all()
+
+        if not rows:
+            # Пустое дерево - отличаем "нет токенов" от "нет аккаунта"
+            account_id = await session.scalar(
+                select(WialonAccount.id).where(WialonAccount.username == username)
+            )
+            if account_id is None:
+                return None
+
+        nodes = {}
+        master_tokens = []
+        for row in rows:
+            if row.id in nodes:
+                continue
+            node = {
+                "token": row.token,
+                "created_at": row.created_at,
+                "status": row.status,
+                "expires_at": row.expires_at,
+                "depth": row.depth,
+                "children_count": 0,
+                "descendants_count": 0,
                 "child_tokens": []
             }
-            
-            children = await session.scalars(
-                select(Token).where(
-                    Token.parent_token_id == master.id,
-                    Token.token_type == TokenType.CHILD
-                )
-            )
-            
-            token_info["child_tokens"] = [
-                {
-                    "token": child.token,
-                    "created_at": child.created_at,
-                    "status": child.status,
-                    "expires_at": child.expires_at
-                }
-                for child in children
-            ]
-            
-            result["master_tokens"].append(token_info)
-            
-        return result
+            parent = nodes.get(row.parent_token_id) if row.depth else None
+            if row.depth and parent is None:
+                # Родитель отфильтрован по статусу - поддерево отсекается
+                continue
+            nodes[row.id] = node
+            if parent is not None:
+                parent["child_tokens"].append(node)
+                parent["children_count"] += 1
+            else:
+                master_tokens.append(node)
+
+        # Строки отсортированы по depth, поэтому обратный проход считает потомков снизу вверх
+        for node in reversed(list(nodes.values())):
+            for child_node in node["child_tokens"]:
+                node["descendants_count"] += 1 + child_node["descendants_count"]
+
+        return {
+            "username": username,
+            "master_tokens": master_tokens,
+            "total_tokens": len(nodes),
+            "max_depth": max((n["depth"] for n in nodes.values()), default=0)
+        }
 
     except Exception as e:
         logger.error(f"Error getting account tokens: {e}")
@@ -622,4 +1033,5 @@ async def add_token(session, account_id, token, parent_token=None, creation_meth
     )
     session.add(new_token)
     await session.commit()
+    invalidate_token_info(token)
     return new_token
@@ -0,0 +1,199 @@
+"""
+Хранилище состояний FSM aiogram в PostgreSQL.
+
+- Чтения обслуживаются из локального LRU-кэша; в БД идем только при промахе.
+- Записи внутри обработчика накапливаются в памяти и сбрасываются одним
+  запросом после обработки апдейта (FSMFlushMiddleware).
+- Состояния, не менявшиеся дольше FSM_STATE_TTL, удаляются фоновой задачей.
+- Пароли в данных FSM зашифрованы и в БД, и в кэше (в том числе в еще не
+  записанных изменениях); расшифровываются только в get_data.
+"""
+import asyncio
+import datetime
+import logging
+import os
+from typing import Any, Dict, Optional
+
+from aiogram import BaseMiddleware
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StorageKey
+from sqlalchemy import delete, select
+from sqlalchemy.dialects.postgresql import insert
+
+from app.cache import LRUCache
+from app.crypto_pool import decrypt_password_async, encrypt_password_async
+from app.database import AsyncSessionLocal
+from app.models import FSMState
+
+logger = logging.getLogger(__name__)
+
+FSM_STATE_TTL = int(os.getenv("FSM_STATE_TTL", "86400"))
+FSM_CACHE_SIZE = int(os.getenv("FSM_CACHE_SIZE", "10000"))
+FSM_EVICT_INTERVAL = int(os.getenv("FSM_EVICT_INTERVAL", "600"))
+
+# Поля данных FSM, которые шифруются перед записью в БД
+SECRET_FIELDS = ("password",)
+
+def storage_key(key: StorageKey) -> str:
+    """Строковый ключ записи: bot_id:chat_id:user_id[:thread_id][:business_connection_id]:destiny"""
+    parts = [str(key.bot_id), str(key.chat_id), str(key.user_id)]
+    if key.thread_id:
+        parts.append(str(key.thread_id))
+    business_connection_id = getattr(key, "business_connection_id", None)
+    if business_connection_id:
+        parts.append(str(business_connection_id))
+    parts.append(key.destiny)
+    return ":".join(parts)
+
+class DBStorage(BaseStorage):
+    """FSM-хранилище с локальным кэшем и отложенной записью в fsm_states."""
+
+    def __init__(self, session_factory=AsyncSessionLocal, ttl: int = FSM_STATE_TTL, cache_size: int = FSM_CACHE_SIZE):
+        self.session_factory = session_factory
+        self.ttl = ttl
+        self._cache = LRUCache(maxsize=cache_size, ttl=ttl)
+        # Измененные, но еще не записанные состояния (не вытесняются из памяти до flush)
+        self._dirty: Dict[str, dict] = {}
+        self._flush_lock = asyncio.Lock()
+        self.db_reads = 0
+        self.writes = 0
+        self.flushes = 0
+        self.flushed_rows = 0
+        self.evicted_rows = 0
+        self.errors = 0
+
+    async def _load(self, key: StorageKey) -> dict:
+        name = storage_key(key)
+        entry = self._dirty.get(name) or self._cache.get(name)
+        if entry is not None:
+            return entry
+        self.db_reads += 1
+        async with self.session_factory() as session:
+            row = await session.scalar(select(FSMState).where(FSMState.key == name))
+        entry = {"state": None, "data": {}}
+        if row and row.updated_at > datetime.datetime.utcnow() - datetime.timedelta(seconds=self.ttl):
+            entry = {"state": row.state, "data": row.data or {}}
+        self._cache.set(name, entry)
+        return entry
+
+    def _mark_dirty(self, key: StorageKey, entry: dict) -> None:
+        name = storage_key(key)
+        self.writes += 1
+        self._dirty[name] = entry
+        self._cache.set(name, entry)
+
+    async def set_state(self, key: StorageKey, state=None) -> None:
+        entry = dict(await self._load(key))
+        entry["state"] = state.state if isinstance(state, State) else state
+        self._mark_dirty(key, entry)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return (await self._load(key))["state"]
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        entry = dict(await self._load(key))
+        # Открытый пароль не задерживается в кэше на время FSM_STATE_TTL
+        entry["data"] = await self._encrypt(data)
+        self._mark_dirty(key, entry)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return await self._decrypt((await self._load(key))["data"])
+
+    @staticmethod
+    async def _encrypt(data: dict) -> dict:
+        data = dict(data)
+        for field in SECRET_FIELDS:
+            if data.get(field):
+                data[field] = await encrypt_password_async(data[field])
+        return data
+
+    @staticmethod
+    async def _decrypt(data: dict) -> dict:
+        data = dict(data)
+        for field in SECRET_FIELDS:
+            if data.get(field):
+                data[field] = await decrypt_password_async(data[field])
+        return data
+
+    async def flush(self) -> int:
+        """Записать накопленные изменения (upsert измененных, delete очищенных). Возвращает число строк."""
+        if not self._dirty:
+            return 0
+        async with self._flush_lock:
+            pending, self._dirty = self._dirty, {}
+            if not pending:
+                return 0
+            now = datetime.datetime.utcnow()
+            cleared = [name for name, entry in pending.items() if entry["state"] is None and not entry["data"]]
+            rows = [
+                {"key": name, "state": entry["state"], "data": entry["data"], "updated_at": now}
+                for name, entry in pending.items()
+                if entry["state"] is not None or entry["data"]
+            ]
+            try:
+                async with self.session_factory() as session:
+                    if rows:
+                        stmt = insert(FSMState).values(rows)
+                        await session.execute(stmt.on_conflict_do_update(
+                            index_elements=[FSMState.key],
+                            set_={"state": stmt.excluded.state, "data": stmt.excluded.data, "updated_at": stmt.excluded.updated_at}
+                        ))
+                    if cleared:
+                        await session.execute(delete(FSMState).where(FSMState.key.in_(cleared)))
+                    await session.commit()
+            except Exception as e:
+                self.errors += 1
+                logger.error(f"FSM storage flush failed ({len(pending)} states): {e}")
+                # Более новые изменения, сделанные во время записи, не перетираем
+                self._dirty = {**pending, **self._dirty}
+                return 0
+            self.flushes += 1
+            self.flushed_rows += len(pending)
+            return len(pending)
+
+    async def evict_expired(self) -> int:
+        """Удалить из БД состояния, не менявшиеся дольше ttl."""
+        cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=self.ttl)
+        async with self.session_factory() as session:
+            result = await session.execute(delete(FSMState).where(FSMState.updated_at < cutoff))
+            await session.commit()
+        self.evicted_rows += result.rowcount
+        return result.rowcount
+
+    async def close(self) -> None:
+        await self.flush()
+
+    def stats(self) -> dict:
+        return {
+            "cache": self._cache.stats(),
+            "dirty": len(self._dirty),
+            "db_reads": self.db_reads,
+            "writes": self.writes,
+            "flushes": self.flushes,
+            "flushed_rows": self.flushed_rows,
+            "evicted_rows": self.evicted_rows,
+            "errors": self.errors
+        }
+
+class FSMFlushMiddleware(BaseMiddleware):
+    """Сбрасывает изменения FSM одним запросом после обработки апдейта."""
+
+    def __init__(self, storage: DBStorage):
+        self.storage = storage
+
+    async def __call__(self, handler, event, data):
+        try:
+            return await handler(event, data)
+        finally:
+            await self.storage.flush()
+
+async def fsm_eviction_loop(storage: DBStorage, interval: int = FSM_EVICT_INTERVAL) -> None:
+    """Фоновая задача удаления устаревших состояний FSM."""
+    while True:
+        try:
+            evicted = await storage.evict_expired()
+            if evicted:
+                logger.info(f"Evicted {evicted} idle FSM states")
+        except Exception as e:
+            logger.error(f"FSM state eviction failed: {e}")
+        await asyncio.sleep(interval)
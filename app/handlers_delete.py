@@ -1,8 +1,8 @@
 from aiogram import Router, types
-from aiogram.filters import Command
+from aiogram.filters import Command, StateFilter
 from aiogram.fsm.context import FSMContext
 from app.database import AsyncSessionLocal
-from app.db_utils import get_all_user_tokens, add_token_history
+from app.db_utils import get_all_user_tokens, add_token_history, resolve_token_short_id, invalidate_token_info, forget_token_short_id
 import logging
 
 router = Router()
@@ -15,32 +15,36 @@ async def delete_token_command(message: types.Message, state: FSMContext):
         if not tokens:
             await message.reply("У вас нет токенов для удаления.")
             return
-        keyboard = types.ReplyKeyboardMarkup(resize_keyboard=True)
-        for t in tokens:
-            preview = t["token"][:8] + '...' + t["token"][-4:]
-            keyboard.add(types.KeyboardButton(preview))
+        # В тексте кнопки short_id: по нему токен находится одним индексным запросом
+        keyboard = types.ReplyKeyboardMarkup(
+            keyboard=[
+                [types.KeyboardButton(text=f"{t['token'][:8]}...{t['token'][-4:]} #{t['short_id']}")]
+                for t in tokens
+            ],
+            resize_keyboard=True
+        )
         await message.reply("Выберите токен для удаления:", reply_markup=keyboard)
         await state.set_state("waiting_for_token_to_delete")
 
-def waiting_for_token_to_delete_filter(message: types.Message, state: FSMContext):
-    async def inner():
-        return (await state.get_state()) == "waiting_for_token_to_delete"
-    return inner
-
-@router.message(waiting_for_token_to_delete_filter)
+@router.message(StateFilter("waiting_for_token_to_delete"))
 async def process_token_to_delete(message: types.Message, state: FSMContext):
     token_preview = message.text.strip()
+    short_id = token_preview.rsplit("#", 1)[-1].strip()
     async with AsyncSessionLocal() as session:
-        tokens = await get_all_user_tokens(session)
-        token_obj = next((t for t in tokens if t["token"].startswith(token_preview[:8]) and t["token"].endswith(token_preview[-4:])), None)
-        if not token_obj:
+        token = await resolve_token_short_id(session, short_id) if "#" in token_preview else None
+        if not token:
             await message.reply("❌ Токен не найден. Попробуйте ещё раз.")
             return
-        # Удаление токена из MasterToken/ChildToken реализовать здесь, если требуется
-        # await delete_token_by_value(session, token_obj["token"])  # Функция удалена, требуется реализовать логику, если нужно
+        # await delete_token_by_value(session, token)  # Функция удалена, требуется реализовать логику, если нужно
         await add_token_history(session, {
-            "token": token_obj["token"],
+            "token": token,
             "action": "delete"
         })
-        await message.reply(f"✅ Токен удалён: <code>{token_obj['token']}</code>", parse_mode="HTML")
+        invalidate_token_info(token)
+        forget_token_short_id(token)
+        await message.reply(
+            f"✅ Токен удалён: <code>{token}</code>",
+            parse_mode="HTML",
+            reply_markup=types.ReplyKeyboardRemove()
+        )
         await state.clear()
@@ -1,40 +1,93 @@
 from aiogram import Router, types
-from aiogram.fsm.context import FSMContext
-from app.db_utils import get_all_user_tokens, add_token_history
-from app.database import AsyncSessionLocal
-import io, csv, datetime
+from aiogram.filters import Command, CommandObject
+from app.jobs import JobContext, job_runner
+from app.token_export import export_tokens, SpooledInputFile, EXPORT_FORMATS
+from app.utils import logger
+import datetime
 
 router = Router()
 
-@router.callback_query(lambda c: c.data == "export_tokens_csv")
+def _parse_date(value: str) -> datetime.datetime:
+    return datetime.datetime.strptime(value, "%Y%m%d" if value.isdigit() else "%Y-%m-%d")
+
+def _export_keyboard(options: str) -> types.InlineKeyboardMarkup:
+    return types.InlineKeyboardMarkup(inline_keyboard=[[
+        types.InlineKeyboardButton(text=fmt.upper(), callback_data=f"export_tokens:{fmt}:{options}")
+        for fmt in EXPORT_FORMATS
+    ]])
+
+@router.message(Command(commands=['export_tokens']))
+async def export_tokens_command(message: types.Message, command: CommandObject):
+    """
+    /export_tokens [status=active] [from=2026-01-01] [to=2026-10-01] [gzip]
+    Выбор формата - кнопками.
+    """
+    status, date_from, date_to, compress = "", "", "", "0"
+    try:
+        for arg in (command.args or "").split():
+            key, _, value = arg.partition("=")
+            if key == "status":
+                if not value.isalnum() or len(value) > 16:
+                    raise ValueError(arg)
+                status = value
+            elif key == "from":
+                date_from = _parse_date(value).strftime("%Y%m%d")
+            elif key == "to":
+                date_to = _parse_date(value).strftime("%Y%m%d")
+            elif key == "gzip":
+                compress = "1"
+            else:
+                raise ValueError(arg)
+    except ValueError:
+        await message.reply(
+            "Использование: /export_tokens [status=active] [from=ГГГГ-ММ-ДД] [to=ГГГГ-ММ-ДД] [gzip]"
+        )
+        return
+    await message.reply("Выберите формат экспорта:", reply_markup=_export_keyboard(f"{status}:{date_from}:{date_to}:{compress}"))
+
+@router.callback_query(lambda c: c.data == "export_tokens_csv" or c.data.startswith("export_tokens:"))
 async def export_tokens_csv_callback(callback_query: types.CallbackQuery):
-    async with AsyncSessionLocal() as session:
-        user_tokens = await get_all_user_tokens(session, str(callback_query.from_user.id))
-        if not user_tokens:
-            await callback_query.message.reply("У вас нет сохраненных токенов для экспорта.")
-            return
-
-        output = io.StringIO()
-        csv_writer = csv.writer(output)
-        headers = ["Token", "User", "Created At", "Expires At", "Created Via", "Operation Type", "Parent Token", "Status"]
-        csv_writer.writerow(headers)
-        for token_data in user_tokens:
-            csv_writer.writerow([
-                token_data["token"],
-                token_data.get("user_name", ""),
-                datetime.datetime.fromtimestamp(token_data["created_at"]).strftime('%Y-%m-%d %H:%M:%S') if token_data.get("created_at") else "",
-                datetime.datetime.fromtimestamp(token_data["expires_at"]).strftime('%Y-%m-%d %H:%M:%S') if token_data.get("expires_at") else "",
-                token_data.get("created_via", ""),
-                token_data.get("token_type", ""),
-                token_data.get("parent_token", ""),
-                token_data.get("status", "")
-            ])
-        output.seek(0)
-        current_time = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
-        filename = f"wialon_tokens_{current_time}.csv"
-        await callback_query.message.reply_document(
-            types.BufferedInputFile(output.getvalue().encode('utf-8'), filename=filename),
-            caption=f"📊 Экспортировано {len(user_tokens)} токенов"
+    if callback_query.data == "export_tokens_csv":
+        fmt, status, date_from, date_to, compress = "csv", "", "", "", "0"
+    else:
+        fmt, status, date_from, date_to, compress = callback_query.data.split(":")[1:6]
+    await callback_query.answer()
+    status_message = await callback_query.message.reply(f"⏳ Экспорт токенов ({fmt.upper()})...")
+    # Экспорт большой базы идет минутами: выполняется фоновой задачей с прогрессом и отменой
+    await job_runner.submit(
+        "export_tokens", status_message, _export_job, user_id=callback_query.from_user.id,
+        telegram_user_id=callback_query.from_user.id,
+        fmt=fmt,
+        status=status or None,
+        created_from=_parse_date(date_from) if date_from else None,
+        created_to=_parse_date(date_to) + datetime.timedelta(days=1) if date_to else None,
+        compress=compress == "1"
+    )
+
+async def _export_job(ctx: JobContext, telegram_user_id: int, fmt: str, **filters) -> dict:
+    """Фоновая задача экспорта: выгрузка во временный файл и отправка его в чат."""
+    async def progress(rows: int) -> None:
+        await ctx.progress(f"⏳ Экспорт токенов ({fmt.upper()}): {rows} строк...")
+
+    try:
+        file, filename, rows = await export_tokens(fmt, progress=progress, **filters)
+    except Exception as e:
+        logger.error(f"[export_tokens] Ошибка экспорта: {e}")
+        await ctx.finish(f"❌ Ошибка экспорта: {e}")
+        return {"ok": False, "error": str(e)}
+
+    try:
+        if not rows:
+            await ctx.finish("У вас нет сохраненных токенов для экспорта.")
+            return {"ok": True, "rows": 0}
+        await ctx.progress(f"📤 Отправляем файл ({rows} строк)...", force=True)
+        await ctx.bot.send_document(
+            ctx.chat_id,
+            SpooledInputFile(file, filename=filename),
+            caption=f"📊 Экспортировано {rows} токенов"
         )
-        await add_token_history(session, str(callback_query.from_user.id), "", "export", {"count": len(user_tokens)})
-        output.close()
+        await ctx.finish(f"✅ Экспорт завершен: {rows} строк.")
+        logger.info(f"[export_tokens] user={telegram_user_id} format={fmt} rows={rows}")
+        return {"ok": True, "rows": rows, "format": fmt}
+    finally:
+        file.close()
@@ -1,31 +1,126 @@
 from aiogram import Router, types
-from aiogram.filters import Command
+from aiogram.filters import Command, CommandObject
+from aiogram.fsm.context import FSMContext
 from app.database import AsyncSessionLocal
-from app.models import TokenHistory, User
+from app.models import User
+from app.db_utils import get_history_page, get_history_summary, resolve_history_token
 from sqlalchemy.future import select
 import datetime
+import html
+import os
 
 router = Router()
 
-@router.message(Command(commands=["history"]))
-async def history_command(message: types.Message):
+# Окно просмотра истории: ограничение по created_at отсекает старые партиции token_history
+HISTORY_LOOKBACK_DAYS = int(os.getenv("HISTORY_LOOKBACK_DAYS", "90"))
+# Сколько полей details показывать в строке истории
+HISTORY_DETAILS_FIELDS = 3
+
+HISTORY_USAGE = (
+    "Использование: /history [action=create] [token=short_id|токен] [from=ГГГГ-ММ-ДД] [to=ГГГГ-ММ-ДД]"
+)
+
+def _parse_date(value: str) -> datetime.date:
+    return datetime.datetime.strptime(value, "%Y-%m-%d").date()
+
+def _period(filters: dict) -> tuple:
+    """Границы периода по дням (стабильны в течение дня - сводка кэшируется)."""
+    today = datetime.datetime.utcnow().date()
+    date_to = datetime.date.fromisoformat(filters["to"]) if filters.get("to") else today
+    date_from = (
+        datetime.date.fromisoformat(filters["from"]) if filters.get("from")
+        else date_to - datetime.timedelta(days=HISTORY_LOOKBACK_DAYS)
+    )
+    since = datetime.datetime.combine(date_from, datetime.time.min)
+    until = datetime.datetime.combine(date_to + datetime.timedelta(days=1), datetime.time.min)
+    return since, until
+
+def _format_details(details) -> str:
+    if not details:
+        return ""
+    if not isinstance(details, dict):
+        return f" <i>{html.escape(str(details)[:60])}</i>"
+    fields = [
+        f"{html.escape(str(key))}={html.escape(str(value)[:30])}"
+        for key, value in details.items()
+        if value not in (None, "", {}, []) and key != "password"
+    ][:HISTORY_DETAILS_FIELDS]
+    return f" <i>({', '.join(fields)})</i>" if fields else ""
+
+def _pagination_keyboard(page: dict) -> types.InlineKeyboardMarkup:
+    buttons = []
+    if page["prev_cursor"]:
+        buttons.append(types.InlineKeyboardButton(text="⬅️ Новее", callback_data=f"history:prev:{page['prev_cursor']}"))
+    if page["next_cursor"]:
+        buttons.append(types.InlineKeyboardButton(text="Старше ➡️", callback_data=f"history:next:{page['next_cursor']}"))
+    return types.InlineKeyboardMarkup(inline_keyboard=[buttons]) if buttons else None
+
+async def _render_history(telegram_id: int, filters: dict, cursor: str = None, direction: str = "next") -> tuple:
+    """Текст и клавиатура страницы истории."""
+    since, until = _period(filters)
     async with AsyncSessionLocal() as session:
-        # Получаем пользователя по telegram_id
-        user = await session.execute(select(User).where(User.telegram_id == str(message.from_user.id)))
-        user = user.scalars().first()
-        if not user:
-            await message.reply("Пользователь не найден в базе данных.")
-            return
-        # Получаем последние 10 операций
-        q = select(TokenHistory).where(TokenHistory.user_id == user.id).order_by(TokenHistory.timestamp.desc()).limit(10)
-        result = await session.execute(q)
-        history = result.scalars().all()
-        if not history:
-            await message.reply("История операций пуста.")
+        user_id = await session.scalar(select(User.id).where(User.telegram_id == str(telegram_id)))
+        if not user_id:
+            return "Пользователь не найден в базе данных.", None
+        token_id = filters.get("token_id")
+        summary = await get_history_summary(session, user_id, since, until, token_id=token_id)
+        page = await get_history_page(
+            session, user_id, since, until,
+            cursor=cursor, direction=direction, action=filters.get("action"), token_id=token_id
+        )
+    if not page["items"]:
+        return "История операций пуста.", None
+
+    period = f"{since:%Y-%m-%d} — {(until - datetime.timedelta(days=1)):%Y-%m-%d}"
+    text = f"<b>История операций с токенами</b> ({period})\n"
+    if summary:
+        text += "📊 " + " · ".join(
+            f"{html.escape(action)}: {count}" for action, count in sorted(summary.items(), key=lambda item: -item[1])
+        ) + "\n"
+    if filters.get("action"):
+        text += f"🔎 Действие: {html.escape(filters['action'])}\n"
+    if filters.get("token"):
+        text += f"🔎 Токен: <code>{html.escape(filters['token'])}</code>\n"
+    for h, token in page["items"]:
+        dt = h.created_at.strftime('%Y-%m-%d %H:%M:%S')
+        token_text = f"<code>{html.escape(token[:12])}…</code>" if token else "—"
+        text += f"\n<b>{dt}</b>: {html.escape(h.action)} — {token_text}{_format_details(h.details)}"
+    return text, _pagination_keyboard(page)
+
+@router.message(Command(commands=["history"]))
+async def history_command(message: types.Message, command: CommandObject, state: FSMContext):
+    filters = {}
+    try:
+        for arg in (command.args or "").split():
+            key, _, value = arg.partition("=")
+            if key == "action" and value:
+                filters["action"] = value
+            elif key == "token" and value:
+                filters["token"] = value
+            elif key in ("from", "to"):
+                filters[key] = _parse_date(value).isoformat()
+            else:
+                raise ValueError(arg)
+    except ValueError:
+        await message.reply(HISTORY_USAGE)
+        return
+
+    if filters.get("token"):
+        async with AsyncSessionLocal() as session:
+            filters["token_id"] = await resolve_history_token(session, filters["token"])
+        if not filters["token_id"]:
+            await message.reply("Токен не найден.")
             return
-        text = "<b>История операций с токенами:</b>\n"
-        for h in history:
-            dt = h.timestamp.strftime('%Y-%m-%d %H:%M:%S')
-            details = f" ({h.details})" if h.details else ""
-            text += f"\n<b>{dt}</b>: {h.action} — <code>{h.token}</code>{details}"
-        await message.reply(text, parse_mode="HTML")
+
+    # Фильтры нужны обработчику кнопок пагинации
+    await state.update_data(history_filters=filters)
+    text, keyboard = await _render_history(message.from_user.id, filters)
+    await message.reply(text, parse_mode="HTML", reply_markup=keyboard)
+
+@router.callback_query(lambda c: c.data.startswith("history:"))
+async def history_page_callback(callback_query: types.CallbackQuery, state: FSMContext):
+    _, direction, cursor = callback_query.data.split(":", 2)
+    filters = (await state.get_data()).get("history_filters", {})
+    text, keyboard = await _render_history(callback_query.from_user.id, filters, cursor=cursor, direction=direction)
+    await callback_query.answer()
+    await callback_query.message.edit_text(text, parse_mode="HTML", reply_markup=keyboard)
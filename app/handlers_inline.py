@@ -0,0 +1,26 @@
+from aiogram import Router, types
+from app.token_search import search, INLINE_CACHE_TTL
+import html
+
+router = Router()
+
+@router.inline_query()
+async def inline_token_search(inline_query: types.InlineQuery):
+    """Поиск токенов по метке, логину или фрагменту токена: @bot <текст>."""
+    items = await search(inline_query.query)
+    results = [
+        types.InlineQueryResultArticle(
+            id=item["short_id"],
+            title=item["label"] or item["username"] or f"{item['token'][:12]}…",
+            description=" · ".join(part for part in (
+                f"{item['token'][:12]}…", item["type"], item["status"], item["username"]
+            ) if part),
+            input_message_content=types.InputTextMessageContent(
+                message_text=f"<code>{html.escape(item['token'])}</code>",
+                parse_mode="HTML"
+            )
+        )
+        for item in items
+    ]
+    # Telegram не должен отдавать этот ответ другим пользователям: доступ проверяется для каждого
+    await inline_query.answer(results, cache_time=int(INLINE_CACHE_TTL), is_personal=True)
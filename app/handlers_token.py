@@ -2,8 +2,9 @@ from aiogram import Router, types
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from app.db_utils import add_token_history, get_all_user_tokens, save_token_chain, get_all_logins, get_password_by_login
+from app.db_utils import add_token_history, get_all_user_tokens, save_token_chain, get_all_logins, get_password_by_login, resolve_token_short_id
 from app.database import AsyncSessionLocal
+from app.models import TokenType
 from app.wialon_api import create_token, update_token, wialon_login
 from app.bot_utils import get_tor_choice_keyboard
 import json
@@ -104,10 +105,8 @@ async def process_token_create_login(callback_query: types.CallbackQuery, state:
             )
             return
             
-        # Получаем все токены для этого логина
-        tokens = await get_all_user_tokens(session)
-        logger.debug(f"[process_token_create_login] all tokens={tokens}")
-        user_tokens = [t for t in tokens if t.get("user_name") == login and t.get("type") == "master"]
+        # Получаем мастер-токены этого логина (фильтрация на стороне БД)
+        user_tokens = await get_all_user_tokens(session, username=login, token_type=TokenType.MASTER)
         logger.debug(f"[process_token_create_login] user_tokens={user_tokens}")
         if not user_tokens:
             await callback_query.message.edit_text(
@@ -118,7 +117,7 @@ async def process_token_create_login(callback_query: types.CallbackQuery, state:
         keyboard = types.InlineKeyboardMarkup(inline_keyboard=[
             [types.InlineKeyboardButton(
                 text=f"🔑 {t['token'][:8]}...{t['token'][-4:]}",
-                callback_data=f"token_create_select:{t['token']}"
+                callback_data=f"token_create_select:{t['short_id']}"
             )]
             for t in user_tokens
         ])
@@ -134,7 +133,12 @@ async def process_token_create_select(callback_query: types.CallbackQuery, state
     """Обработка выбора мастер-токена."""
     await callback_query.answer()
     
-    token = callback_query.data.split(":")[1]
+    short_id = callback_query.data.split(":")[1]
+    async with AsyncSessionLocal() as session:
+        token = await resolve_token_short_id(session, short_id)
+    if not token:
+        await callback_query.message.edit_text("❌ Токен не найден. Возможно, он был удален.")
+        return
     await state.update_data(master_token=token)
     
     access_flags_table = (
@@ -276,7 +280,7 @@ async def process_label(message: types.Message, state: FSMContext):
 async def token_update_handler(message: types.Message, state: FSMContext):
     """Начать процесс обновления токена."""
     async with AsyncSessionLocal() as session:
-        user_tokens = await get_all_user_tokens(session)
+        user_tokens = await get_all_user_tokens(session, limit=5)
     
     keyboard = types.InlineKeyboardMarkup(
         inline_keyboard=[
@@ -288,7 +292,7 @@ async def token_update_handler(message: types.Message, state: FSMContext):
     )
     
     if user_tokens:
-        for i, token_data in enumerate(user_tokens[:5]):
+        for i, token_data in enumerate(user_tokens):
             token = token_data["token"]
             user_info = f" ({token_data['user_name']})" if "user_name" in token_data else ""
             keyboard.inline_keyboard.insert(i, [
@@ -309,7 +313,7 @@ async def process_token_update_choice(callback_query: types.CallbackQuery, state
     await callback_query.answer()
     index = int(callback_query.data.split(":")[1])
     async with AsyncSessionLocal() as session:
-        user_tokens = await get_all_user_tokens(session)
+        user_tokens = await get_all_user_tokens(session, limit=index + 1)
     token = user_tokens[index]["token"]
     await state.update_data(token_to_update=token)
     await callback_query.message.edit_text(
@@ -0,0 +1,180 @@
+"""
+Обслуживание помесячных партиций таблицы token_history.
+
+- ensure_history_partitions: создает партиции на текущий и следующие месяцы
+  (DEFAULT-партиции нет: с ней невозможен DETACH ... CONCURRENTLY). Поэтому
+  партиции создаются с запасом: миграцией, синхронно при старте бота до
+  начала записи истории (prepare_history_partitions) и периодически;
+- archive_history_partitions: отсоединяет партиции старше срока хранения,
+  выгружает их в сжатый CSV и удаляет;
+- history_maintenance_loop: периодически выполняет обе операции.
+
+Запуск вручную:
+    python -m app.history_partitions ensure
+    python -m app.history_partitions retention
+"""
+import asyncio
+import datetime
+import gzip
+import logging
+import os
+import re
+import sys
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncConnection
+
+from app.database import engine
+
+logger = logging.getLogger(__name__)
+
+HISTORY_TABLE = "token_history"
+PARTITIONS_AHEAD = int(os.getenv("HISTORY_PARTITIONS_AHEAD", "3"))
+RETENTION_MONTHS = int(os.getenv("HISTORY_RETENTION_MONTHS", "0"))  # 0 - хранить всё
+ARCHIVE_DIR = os.getenv("HISTORY_ARCHIVE_DIR", "data/history_archive")
+MAINTENANCE_INTERVAL = int(os.getenv("HISTORY_MAINTENANCE_INTERVAL", str(6 * 3600)))
+
+_PARTITION_RE = re.compile(rf"^{HISTORY_TABLE}_(\d{{4}})_(\d{{2}})$")
+
+def month_start(day: datetime.date) -> datetime.date:
+    return day.replace(day=1)
+
+def add_months(month: datetime.date, months: int) -> datetime.date:
+    index = month.year * 12 + month.month - 1 + months
+    return datetime.date(index // 12, index % 12 + 1, 1)
+
+def partition_name(month: datetime.date) -> str:
+    return f"{HISTORY_TABLE}_{month:%Y_%m}"
+
+async def _is_partitioned(conn: AsyncConnection) -> bool:
+    relkind = await conn.scalar(
+        text("SELECT relkind FROM pg_class WHERE oid = to_regclass(:table)"),
+        {"table": HISTORY_TABLE}
+    )
+    return relkind == "p"
+
+async def list_history_partitions(conn: AsyncConnection) -> list:
+    """Список помесячных партиций: [(имя, первый день месяца)], по возрастанию."""
+    result = await conn.execute(
+        text(
+            "SELECT c.relname FROM pg_inherits i "
+            "JOIN pg_class c ON c.oid = i.inhrelid "
+            "WHERE i.inhparent = to_regclass(:table)"
+        ),
+        {"table": HISTORY_TABLE}
+    )
+    partitions = []
+    for (name,) in result:
+        match = _PARTITION_RE.match(name)
+        if match:
+            partitions.append((name, datetime.date(int(match.group(1)), int(match.group(2)), 1)))
+    return sorted(partitions, key=lambda p: p[1])
+
+async def list_detached_partitions(conn: AsyncConnection) -> list:
+    """Таблицы-партиции, оставшиеся отсоединенными после прерванной архивации."""
+    result = await conn.execute(text(
+        "SELECT relname FROM pg_class "
+        "WHERE relkind = 'r' AND NOT relispartition AND relname ~ :pattern"
+    ), {"pattern": _PARTITION_RE.pattern})
+    partitions = []
+    for (name,) in result:
+        match = _PARTITION_RE.match(name)
+        partitions.append((name, datetime.date(int(match.group(1)), int(match.group(2)), 1)))
+    return partitions
+
+async def ensure_history_partitions(conn: AsyncConnection, months_ahead: int = PARTITIONS_AHEAD) -> list:
+    """Создать недостающие партиции с текущего месяца на months_ahead вперед. Возвращает имена созданных."""
+    if not await _is_partitioned(conn):
+        logger.warning(f"Table {HISTORY_TABLE} is not partitioned, run 'alembic upgrade head'")
+        return []
+    existing = {name for name, _ in await list_history_partitions(conn)}
+    created = []
+    current = month_start(datetime.datetime.utcnow().date())
+    for offset in range(months_ahead + 1):
+        month = add_months(current, offset)
+        name = partition_name(month)
+        if name in existing:
+            continue
+        await conn.execute(text(
+            f'CREATE TABLE IF NOT EXISTS "{name}" PARTITION OF {HISTORY_TABLE} '
+            f"FOR VALUES FROM ('{month.isoformat()}') TO ('{add_months(month, 1).isoformat()}')"
+        ))
+        created.append(name)
+    if created:
+        logger.info(f"Created history partitions: {', '.join(created)}")
+    return created
+
+async def prepare_history_partitions() -> None:
+    """Создать партиции при старте, до первой записи истории. Ошибка не мешает запуску бота."""
+    try:
+        async with engine.begin() as conn:
+            await ensure_history_partitions(conn)
+    except Exception as e:
+        logger.error(f"Cannot ensure history partitions on startup: {e}")
+
+async def _export_partition(conn: AsyncConnection, name: str, archive_dir: str) -> str:
+    os.makedirs(archive_dir, exist_ok=True)
+    path = os.path.join(archive_dir, f"{name}.csv.gz")
+    raw = await conn.get_raw_connection()
+    with gzip.open(path, "wb") as output:
+        await raw.driver_connection.copy_from_table(name, output=output, format="csv", header=True)
+    return path
+
+async def archive_history_partitions(
+    retention_months: int = RETENTION_MONTHS,
+    archive_dir: str = ARCHIVE_DIR
+) -> list:
+    """
+    Отсоединить партиции старше retention_months, выгрузить их в <archive_dir>/<партиция>.csv.gz и удалить.
+
+    Returns:
+        list: Пути к созданным архивам
+    """
+    if retention_months <= 0:
+        return []
+    cutoff = add_months(month_start(datetime.datetime.utcnow().date()), -retention_months)
+    archived = []
+    # DETACH ... CONCURRENTLY нельзя выполнять внутри транзакции
+    async with engine.connect() as conn:
+        conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+        attached = await list_history_partitions(conn)
+        detached = await list_detached_partitions(conn)
+        for name, month in attached + detached:
+            if month >= cutoff:
+                continue
+            logger.info(f"Archiving history partition {name}")
+            if (name, month) in attached:
+                await conn.execute(text(f'ALTER TABLE {HISTORY_TABLE} DETACH PARTITION "{name}" CONCURRENTLY'))
+            path = await _export_partition(conn, name, archive_dir)
+            await conn.execute(text(f'DROP TABLE "{name}"'))
+            archived.append(path)
+            logger.info(f"History partition {name} archived to {path}")
+    return archived
+
+async def history_maintenance_loop(interval: int = MAINTENANCE_INTERVAL) -> None:
+    """Фоновая задача: создание будущих партиций и применение срока хранения."""
+    while True:
+        try:
+            async with engine.begin() as conn:
+                await ensure_history_partitions(conn)
+            await archive_history_partitions()
+        except Exception as e:
+            logger.error(f"History maintenance failed: {e}")
+        await asyncio.sleep(interval)
+
+async def _main(command: str) -> None:
+    if command == "ensure":
+        async with engine.begin() as conn:
+            created = await ensure_history_partitions(conn)
+        print(f"Создано партиций: {len(created)}")
+    elif command == "retention":
+        archived = await archive_history_partitions()
+        print(f"Архивировано партиций: {len(archived)}")
+        for path in archived:
+            print(f"  {path}")
+    else:
+        raise SystemExit("Использование: python -m app.history_partitions [ensure|retention]")
+    await engine.dispose()
+
+if __name__ == "__main__":
+    asyncio.run(_main(sys.argv[1] if len(sys.argv) > 1 else "ensure"))
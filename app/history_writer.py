@@ -0,0 +1,210 @@
+"""
+Фоновая (write-behind) запись истории операций с токенами.
+
+Обработчики кладут события в ограниченную очередь и не ждут записи в БД.
+Фоновая задача сбрасывает очередь пачками (bulk INSERT) по размеру пачки
+или по таймеру. При остановке очередь сбрасывается полностью.
+Если пачка отклонена из-за данных (нарушение FK/NOT NULL в одной из строк), она делится
+пополам до отдельных строк: теряются и логируются только ошибочные записи.
+Если для строк нет партиции token_history, партиции создаются и пачка
+записывается повторно.
+"""
+import asyncio
+import datetime
+import logging
+import os
+import time
+from typing import Optional
+
+from sqlalchemy import insert
+from sqlalchemy.exc import DataError, DBAPIError, IntegrityError
+
+from app.database import AsyncSessionLocal
+from app.history_partitions import prepare_history_partitions
+from app.models import TokenHistory
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+class HistoryWriter:
+    """Очередь записей TokenHistory со сбросом пачками."""
+
+    def __init__(
+        self,
+        session_factory=AsyncSessionLocal,
+        max_queue: int = int(os.getenv("HISTORY_QUEUE_SIZE", "10000")),
+        batch_size: int = int(os.getenv("HISTORY_BATCH_SIZE", "500")),
+        flush_interval: float = float(os.getenv("HISTORY_FLUSH_INTERVAL", "1.0")),
+        put_timeout: float = float(os.getenv("HISTORY_PUT_TIMEOUT", "0.5"))
+    ):
+        """
+        Args:
+            session_factory: Фабрика асинхронных сессий
+            max_queue: Максимальная длина очереди (backpressure)
+            batch_size: Максимальный размер пачки для одного INSERT
+            flush_interval: Максимальная задержка записи в секундах
+            put_timeout: Сколько ждать места в переполненной очереди, прежде чем отбросить запись
+        """
+        self.session_factory = session_factory
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max_queue)
+        self._task: Optional[asyncio.Task] = None
+        self._metrics = {
+            "enqueued": 0,
+            "flushed": 0,
+            "batches": 0,
+            "blocked": 0,
+            "dropped": 0,
+            "failed": 0,
+            "splits": 0,
+            "missing_partition": 0,
+            "max_queue_depth": 0,
+            "last_flush_ms": 0.0
+        }
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    async def start(self) -> None:
+        """Запустить фоновую задачу записи."""
+        if self.running:
+            return
+        self._task = asyncio.create_task(self._run(), name="history-writer")
+        logger.info("History writer started")
+
+    async def stop(self) -> None:
+        """Остановить запись, предварительно сбросив всю очередь в БД."""
+        if not self.running:
+            return
+        await self._queue.put(_STOP)
+        await self._task
+        self._task = None
+        logger.info("History writer stopped")
+
+    async def record(
+        self,
+        token_id: int,
+        action: str,
+        details: dict = None,
+        user_id: int = None
+    ) -> None:
+        """Поставить запись истории в очередь."""
+        if token_id is None:
+            # token_history.token_id NOT NULL: такая строка отклонила бы всю пачку
+            self._metrics["failed"] += 1
+            logger.error(f"Dropping '{action}' history record without token_id (user_id={user_id})")
+            return
+        row = {
+            "token_id": token_id,
+            "user_id": user_id,
+            "action": action,
+            "created_at": datetime.datetime.utcnow(),
+            "details": details
+        }
+        if not self.running:
+            # Фоновая задача не запущена (скрипты, API без бота) - пишем сразу
+            await self._flush([row])
+            return
+
+        if self._queue.full():
+            self._metrics["blocked"] += 1
+            try:
+                await asyncio.wait_for(self._queue.put(row), self.put_timeout)
+            except asyncio.TimeoutError:
+                self._metrics["dropped"] += 1
+                logger.warning(f"History queue is full, dropping '{action}' record for token_id={token_id}")
+                return
+        else:
+            self._queue.put_nowait(row)
+        self._metrics["enqueued"] += 1
+        self._metrics["max_queue_depth"] = max(self._metrics["max_queue_depth"], self._queue.qsize())
+
+    async def _run(self) -> None:
+        while True:
+            item = await self._queue.get()
+            stopping = item is _STOP
+            batch = [] if stopping else [item]
+            deadline = time.monotonic() + self.flush_interval
+            while not stopping and len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if item is _STOP:
+                    stopping = True
+                else:
+                    batch.append(item)
+            if stopping:
+                # Забираем все, что успели положить в очередь
+                while not self._queue.empty():
+                    item = self._queue.get_nowait()
+                    if item is not _STOP:
+                        batch.append(item)
+            for start in range(0, len(batch), self.batch_size):
+                await self._flush(batch[start:start + self.batch_size])
+            if stopping:
+                return
+
+    async def _flush(self, rows: list) -> None:
+        if not rows:
+            return
+        started = time.perf_counter()
+        try:
+            await self._insert(rows)
+        finally:
+            self._metrics["last_flush_ms"] = round((time.perf_counter() - started) * 1000, 2)
+
+    async def _insert(self, rows: list, partitions_checked: bool = False) -> None:
+        """Записать пачку; при ошибке данных - половинами, чтобы потерять только ошибочные строки."""
+        try:
+            async with self.session_factory() as session:
+                await session.execute(insert(TokenHistory), rows)
+                await session.commit()
+            self._metrics["flushed"] += len(rows)
+            self._metrics["batches"] += 1
+            return
+        except DBAPIError as e:
+            if not partitions_checked and "no partition of relation" in str(e):
+                # Обслуживание партиций отстало (например, процесс не работал при смене месяца)
+                self._metrics["missing_partition"] += 1
+                await prepare_history_partitions()
+                await self._insert(rows, partitions_checked=True)
+                return
+            # Делим только при ошибке данных в строках; недоступность БД, таймауты и блокировки
+            # повторились бы на каждой половине (2N запросов и N записей в лог)
+            if len(rows) > 1 and isinstance(e, (IntegrityError, DataError)):
+                self._metrics["splits"] += 1
+                middle = len(rows) // 2
+                await self._insert(rows[:middle], partitions_checked=True)
+                await self._insert(rows[middle:], partitions_checked=True)
+                return
+            error = e.orig if e.orig is not None else e
+        except Exception as e:
+            error = e
+        self._metrics["failed"] += len(rows)
+        if len(rows) == 1:
+            row = rows[0]
+            logger.error(
+                f"Dropping history record token_id={row['token_id']} user_id={row['user_id']} "
+                f"action='{row['action']}' created_at={row['created_at']:%Y-%m-%d %H:%M:%S}: {error}"
+            )
+        else:
+            logger.error(f"Error flushing {len(rows)} history records: {error}")
+
+    def stats(self) -> dict:
+        """Метрики очереди: глубина, объемы записи, блокировки и потери."""
+        return {
+            **self._metrics,
+            "queue_depth": self._queue.qsize(),
+            "queue_capacity": self._queue.maxsize,
+            "running": self.running
+        }
+
+history_writer = HistoryWriter()
@@ -0,0 +1,265 @@
+"""
+Фоновые задачи бота для долгих операций (логин через браузер, цепочки API-вызовов).
+
+Обработчик создает задачу и сразу возвращается. Задачи выполняются ограниченным
+пулом воркеров, прогресс показывается правкой одного статусного сообщения,
+под которым есть кнопка отмены (callback job_cancel:<id>).
+Состояние и результат задачи хранятся в таблице jobs; задачи, не завершенные
+к моменту перезапуска, помечаются как interrupted, и пользователь видит это
+в том же статусном сообщении.
+"""
+import asyncio
+import datetime
+import logging
+import os
+import time
+from typing import Awaitable, Callable, Dict, Optional
+
+from aiogram import Bot
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup, Message
+from sqlalchemy import update
+
+from app.database import AsyncSessionLocal
+from app.models import Job
+
+logger = logging.getLogger(__name__)
+
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+JOB_QUEUE_SIZE = int(os.getenv("JOB_QUEUE_SIZE", "100"))
+JOB_PROGRESS_INTERVAL = float(os.getenv("JOB_PROGRESS_INTERVAL", "1.0"))
+
+ACTIVE_STATUSES = ("queued", "running")
+
+def cancel_keyboard(job_id: int) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(inline_keyboard=[[
+        InlineKeyboardButton(text="✖️ Отменить", callback_data=f"job_cancel:{job_id}")
+    ]])
+
+class JobContext:
+    """Контекст выполняемой задачи: прогресс и итоговое сообщение."""
+
+    def __init__(self, runner: "JobRunner", job_id: int, chat_id: int, message_id: int):
+        self.runner = runner
+        self.job_id = job_id
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self._last_text = None
+        self._last_edit = 0.0
+
+    @property
+    def bot(self) -> Bot:
+        """Бот, от имени которого выполняется задача (для отправки результатов-файлов)."""
+        return self.runner._bot
+
+    async def progress(self, text: str, parse_mode: str = None, force: bool = False) -> None:
+        """Показать прогресс в статусном сообщении (не чаще JOB_PROGRESS_INTERVAL)."""
+        now = time.monotonic()
+        if text == self._last_text or (not force and now - self._last_edit < JOB_PROGRESS_INTERVAL):
+            return
+        self._last_text, self._last_edit = text, now
+        await self.runner._edit(self.chat_id, self.message_id, text, parse_mode, cancel_keyboard(self.job_id))
+        await self.runner._update(self.job_id, progress=text)
+
+    async def finish(self, text: str, parse_mode: str = None) -> None:
+        """Итоговый текст статусного сообщения (кнопка отмены убирается)."""
+        self._last_text = text
+        await self.runner._edit(self.chat_id, self.message_id, text, parse_mode, None)
+
+JobFunc = Callable[..., Awaitable[Optional[dict]]]
+
+class JobRunner:
+    """Ограниченный пул воркеров для задач с сохранением состояния в БД."""
+
+    def __init__(self, session_factory=AsyncSessionLocal, workers: int = JOB_WORKERS, max_queue: int = JOB_QUEUE_SIZE):
+        """
+        Args:
+            session_factory: Фабрика асинхронных сессий
+            workers: Число одновременно выполняемых задач
+            max_queue: Максимальное число задач в очереди
+        """
+        self.session_factory = session_factory
+        self.workers = workers
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max_queue)
+        self._tasks = []
+        self._running: Dict[int, asyncio.Task] = {}
+        self._cancelled = set()
+        self._bot: Optional[Bot] = None
+        self._stopping = False
+        self._metrics = {
+            "submitted": 0,
+            "rejected": 0,
+            "succeeded": 0,
+            "failed": 0,
+            "cancelled": 0,
+            "interrupted": 0
+        }
+
+    @property
+    def running(self) -> bool:
+        return any(not task.done() for task in self._tasks)
+
+    async def start(self, bot: Bot) -> None:
+        """Пометить незавершенные задачи прошлого запуска и запустить воркеры."""
+        if self.running:
+            return
+        self._bot = bot
+        self._stopping = False
+        await self.mark_interrupted()
+        self._tasks = [asyncio.create_task(self._run(), name=f"job-worker-{i}") for i in range(self.workers)]
+        logger.info(f"Job runner started: {self.workers} workers")
+
+    async def stop(self) -> None:
+        """Остановить воркеры; выполняющиеся задачи отменяются и помечаются interrupted."""
+        self._stopping = True
+        # Отмена воркера отменяет и задачу, которую он ожидает
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        # Сессия бота еще открыта: пользователи узнают о прерывании сразу, а не после перезапуска
+        await self.mark_interrupted("⚠️ Задача прервана остановкой бота. Запустите операцию заново.")
+        logger.info("Job runner stopped")
+
+    async def mark_interrupted(
+        self,
+        text: str = "⚠️ Задача прервана перезапуском бота. Запустите операцию заново."
+    ) -> int:
+        """Пометить задачи queued/running как interrupted и сообщить об этом в их статусных сообщениях."""
+        async with self.session_factory() as session:
+            rows = (await session.execute(
+                update(Job)
+                .where(Job.status.in_(ACTIVE_STATUSES))
+                .values(status="interrupted", finished_at=datetime.datetime.utcnow())
+                .returning(Job.id, Job.chat_id, Job.message_id)
+            )).all()
+            await session.commit()
+        self._metrics["interrupted"] += len(rows)
+        if rows:
+            logger.warning(f"Marked {len(rows)} unfinished jobs as interrupted")
+        if self._bot:
+            for row in rows:
+                await self._edit(row.chat_id, row.message_id, text, None, None)
+        return len(rows)
+
+    async def submit(self, kind: str, status_message: Message, func: JobFunc, user_id: int = None, **params) -> Optional[int]:
+        """
+        Поставить задачу в очередь.
+
+        Args:
+            kind: Тип задачи (для истории и метрик)
+            status_message: Сообщение бота, в котором показывается прогресс
+            func: Корутина func(ctx, **params), возвращающая dict-результат
+                  (результат с "ok": False считается неудачным выполнением)
+            user_id: Telegram ID инициатора (только он может отменить задачу)
+
+        Returns:
+            id задачи или None, если очередь переполнена
+        """
+        if self._queue.full() or not self.running:
+            await self._reject(status_message)
+            return None
+        async with self.session_factory() as session:
+            job = Job(kind=kind, status="queued", user_id=user_id,
+                      chat_id=status_message.chat.id, message_id=status_message.message_id)
+            session.add(job)
+            await session.commit()
+            job_id = job.id
+        try:
+            self._queue.put_nowait((job_id, kind, user_id, status_message.chat.id, status_message.message_id, func, params))
+        except asyncio.QueueFull:
+            # Очередь заполнилась, пока создавалась строка задачи
+            await self._update(job_id, status="rejected", finished_at=datetime.datetime.utcnow())
+            await self._reject(status_message)
+            return None
+        self._metrics["submitted"] += 1
+        await self._edit(status_message.chat.id, status_message.message_id,
+                         status_message.html_text if status_message.text else "⏳ Задача в очереди...",
+                         "HTML", cancel_keyboard(job_id))
+        return job_id
+
+    async def _reject(self, status_message: Message) -> None:
+        self._metrics["rejected"] += 1
+        await self._edit(status_message.chat.id, status_message.message_id,
+                         "⏳ Сейчас выполняется слишком много задач, попробуйте позже.", None, None)
+
+    async def cancel(self, job_id: int, user_id: int = None) -> bool:
+        """Отменить задачу из очереди или выполняющуюся. False - задача не найдена или уже завершена."""
+        async with self.session_factory() as session:
+            job = await session.get(Job, job_id)
+            if not job or job.status not in ACTIVE_STATUSES:
+                return False
+            # Задачу без владельца пользователь отменить не может
+            if user_id is not None and job.user_id != user_id:
+                return False
+        task = self._running.get(job_id)
+        if task:
+            task.cancel()
+        else:
+            # Еще в очереди: воркер пропустит задачу
+            self._cancelled.add(job_id)
+            await self._finish(job_id, "cancelled")
+        return True
+
+    async def _run(self) -> None:
+        while True:
+            job_id, kind, user_id, chat_id, message_id, func, params = await self._queue.get()
+            if job_id in self._cancelled:
+                self._cancelled.discard(job_id)
+                await self._edit(chat_id, message_id, "✖️ Задача отменена.", None, None)
+                continue
+            ctx = JobContext(self, job_id, chat_id, message_id)
+            await self._update(job_id, status="running", started_at=datetime.datetime.utcnow())
+            task = asyncio.create_task(func(ctx, **params), name=f"job-{job_id}-{kind}")
+            self._running[job_id] = task
+            try:
+                result = await task
+                # Задача сама сообщила пользователю об ошибке и вернула {"ok": False}
+                failed = isinstance(result, dict) and result.get("ok") is False
+                await self._finish(job_id, "failed" if failed else "succeeded", result=result,
+                                   error=(result.get("error") or "job reported failure") if failed else None)
+            except asyncio.CancelledError:
+                if self._stopping:
+                    # Остановка бота - задача станет interrupted
+                    raise
+                await self._finish(job_id, "cancelled")
+                await ctx.finish("✖️ Задача отменена.")
+            except Exception as e:
+                logger.error(f"Job {job_id} ({kind}) failed: {e}", exc_info=True)
+                await self._finish(job_id, "failed", error=str(e))
+                await ctx.finish(f"❌ Ошибка: {e}")
+            finally:
+                self._running.pop(job_id, None)
+
+    async def _finish(self, job_id: int, status: str, result: dict = None, error: str = None) -> None:
+        self._metrics[status] += 1
+        await self._update(job_id, status=status, result=result, error=error, finished_at=datetime.datetime.utcnow())
+
+    async def _update(self, job_id: int, **values) -> None:
+        try:
+            async with self.session_factory() as session:
+                await session.execute(update(Job).where(Job.id == job_id).values(**values))
+                await session.commit()
+        except Exception as e:
+            logger.error(f"Error updating job {job_id}: {e}")
+
+    async def _edit(self, chat_id: int, message_id: int, text: str, parse_mode: Optional[str], reply_markup) -> None:
+        try:
+            await self._bot.edit_message_text(
+                text, chat_id=chat_id, message_id=message_id, parse_mode=parse_mode, reply_markup=reply_markup
+            )
+        except Exception as e:
+            # "message is not modified" и удаленные сообщения не должны ронять задачу
+            logger.debug(f"Cannot edit job status message {chat_id}/{message_id}: {e}")
+
+    def stats(self) -> dict:
+        """Метрики: очередь, выполняющиеся задачи и итоги по статусам."""
+        return {
+            **self._metrics,
+            "workers": self.workers,
+            "queue_depth": self._queue.qsize(),
+            "queue_capacity": self._queue.maxsize,
+            "in_progress": len(self._running),
+            "running": self.running
+        }
+
+job_runner = JobRunner()
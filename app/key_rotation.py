@@ -0,0 +1,153 @@
+"""
+Перешифрование сохраненных паролей основным ключом (ротация ключей).
+
+Порядок ротации:
+1. Добавить новый ключ первым в ENCRYPTION_KEYS (старые оставить за ним)
+   и перезапустить приложение - новые пароли шифруются новым ключом.
+2. Выполнить python -m app.key_rotation - все encrypted_password
+   перешифровываются пачками по id, каждая пачка в своей короткой транзакции.
+3. Убрать старые ключи из ENCRYPTION_KEYS.
+
+Значения, уже зашифрованные основным ключом, пропускаются, поэтому прерванную
+ротацию можно просто запустить повторно.
+"""
+import argparse
+import asyncio
+import logging
+import os
+import time
+from typing import Callable, Optional
+
+from cryptography.fernet import InvalidToken
+from sqlalchemy import text
+
+from app.database import AsyncSessionLocal, engine
+from app.utils import rotate_encrypted_password
+
+logger = logging.getLogger(__name__)
+
+ROTATION_CHUNK_SIZE = int(os.getenv("KEY_ROTATION_CHUNK_SIZE", "500"))
+
+# Колонки с паролями, зашифрованными encrypt_password
+ENCRYPTED_COLUMNS = [
+    ("wialon_accounts", "encrypted_password"),
+    ("wialon_credentials", "encrypted_password"),
+    ("users", "encrypted_wialon_password"),
+    ("users", "encrypted_password"),
+]
+
+async def _existing_columns(session) -> list:
+    result = await session.execute(text(
+        "SELECT table_name, column_name FROM information_schema.columns "
+        "WHERE table_schema = current_schema()"
+    ))
+    existing = {(row.table_name, row.column_name) for row in result}
+    return [column for column in ENCRYPTED_COLUMNS if column in existing]
+
+async def rotate_column(
+    table: str,
+    column: str,
+    chunk_size: int = ROTATION_CHUNK_SIZE,
+    dry_run: bool = False,
+    progress: Optional[Callable[[dict], None]] = None
+) -> dict:
+    """
+    Перешифровать одну колонку пачками по id.
+
+    Строка обновляется, только если значение не изменилось с момента чтения,
+    поэтому параллельная смена пароля не перезаписывается.
+
+    Returns:
+        dict: Статистика - total, processed, rotated, skipped, failed, conflicts
+    """
+    stats = {"table": table, "column": column, "total": 0, "processed": 0,
+             "rotated": 0, "skipped": 0, "failed": 0, "conflicts": 0}
+    select_chunk = text(
+        f"SELECT id, {column} AS value FROM {table} "
+        f"WHERE id > :last_id AND {column} IS NOT NULL ORDER BY id LIMIT :limit"
+    )
+    # Вся пачка - одним UPDATE; условие на старое значение защищает от гонки со сменой пароля
+    update_chunk = text(
+        f"UPDATE {table} t SET {column} = v.new FROM ("
+        f" SELECT unnest(CAST(:ids AS integer[])) AS id, unnest(CAST(:olds AS varchar[])) AS old,"
+        f" unnest(CAST(:news AS varchar[])) AS new"
+        f") v WHERE t.id = v.id AND t.{column} = v.old RETURNING t.id"
+    )
+
+    async with AsyncSessionLocal() as session:
+        stats["total"] = await session.scalar(text(f"SELECT count(*) FROM {table} WHERE {column} IS NOT NULL"))
+
+    started = time.perf_counter()
+    last_id = 0
+    while True:
+        async with AsyncSessionLocal() as session:
+            rows = (await session.execute(select_chunk, {"last_id": last_id, "limit": chunk_size})).all()
+            if not rows:
+                break
+            last_id = rows[-1].id
+            updates = []
+            for row in rows:
+                try:
+                    new_value = rotate_encrypted_password(row.value)
+                except (InvalidToken, ValueError):
+                    stats["failed"] += 1
+                    logger.warning(f"{table}.{column} id={row.id}: value cannot be decrypted with any key")
+                    continue
+                if new_value is None:
+                    stats["skipped"] += 1
+                else:
+                    updates.append({"id": row.id, "old": row.value, "new": new_value})
+            if updates and not dry_run:
+                updated = (await session.execute(update_chunk, {
+                    "ids": [u["id"] for u in updates],
+                    "olds": [u["old"] for u in updates],
+                    "news": [u["new"] for u in updates]
+                })).all()
+                await session.commit()
+                stats["rotated"] += len(updated)
+                stats["conflicts"] += len(updates) - len(updated)
+            elif dry_run:
+                stats["rotated"] += len(updates)
+        stats["processed"] += len(rows)
+
+        elapsed = time.perf_counter() - started
+        percent = stats["processed"] / stats["total"] * 100 if stats["total"] else 100.0
+        logger.info(
+            f"{table}.{column}: {stats['processed']}/{stats['total']} ({percent:.1f}%), "
+            f"rotated {stats['rotated']}, skipped {stats['skipped']}, failed {stats['failed']}, "
+            f"{stats['processed'] / elapsed:.0f} rows/s"
+        )
+        if progress:
+            progress(dict(stats))
+    return stats
+
+async def rotate_all(chunk_size: int = ROTATION_CHUNK_SIZE, dry_run: bool = False, progress=None) -> list:
+    """Перешифровать все колонки с паролями, существующие в текущей схеме."""
+    async with AsyncSessionLocal() as session:
+        columns = await _existing_columns(session)
+    return [
+        await rotate_column(table, column, chunk_size=chunk_size, dry_run=dry_run, progress=progress)
+        for table, column in columns
+    ]
+
+def _print_progress(stats: dict) -> None:
+    percent = stats["processed"] / stats["total"] * 100 if stats["total"] else 100.0
+    print(f"\r{stats['table']}.{stats['column']}: {stats['processed']}/{stats['total']} ({percent:.1f}%)", end="", flush=True)
+
+async def _main() -> None:
+    parser = argparse.ArgumentParser(description="Перешифрование паролей основным ключом ENCRYPTION_KEYS")
+    parser.add_argument("--chunk-size", type=int, default=ROTATION_CHUNK_SIZE)
+    parser.add_argument("--dry-run", action="store_true", help="Только посчитать, ничего не записывать")
+    args = parser.parse_args()
+
+    results = await rotate_all(args.chunk_size, args.dry_run, progress=_print_progress)
+    await engine.dispose()
+    print()
+    for stats in results:
+        print(
+            f"{stats['table']}.{stats['column']}: всего {stats['total']}, перешифровано {stats['rotated']}, "
+            f"пропущено {stats['skipped']}, ошибок {stats['failed']}, конфликтов {stats['conflicts']}"
+        )
+
+if __name__ == "__main__":
+    asyncio.run(_main())
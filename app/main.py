@@ -1,9 +1,23 @@
 import asyncio
+import io
 import logging
-from app.bot import start_telegram_bot, bot
-from fastapi import FastAPI
+import os
+import secrets
+from app.bot import start_telegram_bot, start_webhook_bot, stop_webhook_bot, bot, fsm_storage
+from aiogram.types import Update
+from fastapi import FastAPI, File, Header, HTTPException, Request, UploadFile
 import uvicorn
 from app.utils import logger
+from app.history_writer import history_writer
+from app.db_utils import cache_stats
+from app.database import pool_stats
+from app.crypto_pool import crypto_stats
+from app.bulk_import import import_records, iter_records, detect_format
+from app.webhook import update_queue, BOT_MODE, WEBHOOK_PATH, WEBHOOK_SECRET
+from app.jobs import job_runner
+from app.access_control import access_stats
+from app.send_scheduler import send_scheduler
+from app.token_search import search_stats
 
 logging.basicConfig(level=logging.DEBUG)
 
@@ -20,14 +34,78 @@ async def startup_event():
         logger.warning("aiohttp_socks is not installed, Tor SOCKS proxy support is limited")
         logger.warning("To enable full Tor support, install aiohttp_socks: pip install aiohttp_socks")
     
-    # Запускаем бота в фоновом режиме
-    asyncio.create_task(start_telegram_bot())
+    if BOT_MODE == "webhook":
+        # Апдейты приходят на WEBHOOK_PATH и обрабатываются пулом воркеров
+        await start_webhook_bot()
+    else:
+        # Запускаем бота в фоновом режиме
+        asyncio.create_task(start_telegram_bot())
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    if BOT_MODE == "webhook":
+        await stop_webhook_bot()
+    # Сбрасываем очередь истории до остановки процесса
+    await history_writer.stop()
 
 @app.get("/health")
 async def health_check():
     """Проверка здоровья приложения."""
     return {"status": "ok"}
 
+@app.get("/metrics")
+async def metrics():
+    """Внутренние метрики приложения."""
+    return {
+        "history_writer": history_writer.stats(),
+        "caches": cache_stats(),
+        "db_pool": pool_stats(),
+        "crypto": crypto_stats(),
+        "fsm_storage": fsm_storage.stats(),
+        "webhook": update_queue.stats(),
+        "jobs": job_runner.stats(),
+        "access": access_stats(),
+        "send_scheduler": send_scheduler.stats(),
+        "inline_search": search_stats()
+    }
+
+@app.post(WEBHOOK_PATH)
+async def telegram_webhook(request: Request, x_telegram_bot_api_secret_token: str = Header(None)):
+    """Прием апдейтов Telegram: апдейт ставится в очередь, ответ отправляется сразу."""
+    if BOT_MODE != "webhook" or not update_queue.running:
+        raise HTTPException(status_code=503, detail="Webhook mode is not running")
+    # Без настроенного секрета апдейты не принимаются (см. start_webhook_bot)
+    if not WEBHOOK_SECRET or not (
+        x_telegram_bot_api_secret_token and secrets.compare_digest(x_telegram_bot_api_secret_token, WEBHOOK_SECRET)
+    ):
+        raise HTTPException(status_code=403, detail="Forbidden")
+    update = Update.model_validate(await request.json(), context={"bot": bot})
+    if not update_queue.submit(update):
+        # Telegram повторит доставку позже
+        raise HTTPException(status_code=503, detail="Update queue is full")
+    return {"ok": True}
+
+@app.post("/admin/import")
+async def admin_import(
+    file: UploadFile = File(...),
+    format: str = None,
+    x_admin_token: str = Header(None)
+):
+    """Массовый импорт учетных записей и токенов из CSV/JSONL (см. app.bulk_import)."""
+    admin_token = os.getenv("ADMIN_API_TOKEN")
+    if not admin_token:
+        raise HTTPException(status_code=503, detail="ADMIN_API_TOKEN is not configured")
+    if not x_admin_token or not secrets.compare_digest(x_admin_token, admin_token):
+        raise HTTPException(status_code=403, detail="Forbidden")
+    fmt = format or detect_format(file.filename or "")
+    if fmt not in ("csv", "jsonl"):
+        raise HTTPException(status_code=400, detail=f"Unsupported format: {fmt}")
+    # Файл читается построчно в отдельном потоке (import_records), целиком в память не загружается
+    source = io.TextIOWrapper(file.file, encoding="utf-8", newline="")
+    report = await import_records(iter_records(source, fmt))
+    logger.info(f"Bulk import: {report['rows']} rows, {report['rejected']} rejected, {report['rows_per_second']} rows/s")
+    return report
+
 if __name__ == "__main__":
     # Запускаем бота напрямую без FastAPI
     asyncio.run(start_telegram_bot())
\ No newline at end of file
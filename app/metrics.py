@@ -0,0 +1,58 @@
+"""
+Простые in-process метрики для эндпоинта /metrics.
+"""
+import bisect
+import threading
+
+# Границы корзин гистограммы задержек, мс
+DEFAULT_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+class Histogram:
+    """Гистограмма с фиксированными корзинами, приближенными квантилями и максимумом."""
+
+    def __init__(self, buckets: tuple = DEFAULT_BUCKETS_MS):
+        self.buckets = tuple(buckets)
+        self._counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        """Учесть одно наблюдение."""
+        with self._lock:
+            self._counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.count += 1
+            self.sum += value
+            self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> float:
+        """Верхняя граница корзины, в которую попадает квантиль q (0..1)."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self._counts):
+            seen += count
+            if seen >= rank:
+                return float(bound)
+        return self.max
+
+    def snapshot(self) -> dict:
+        """Состояние гистограммы: накопительные корзины le_<граница>, count, sum, avg, квантили."""
+        cumulative = {}
+        seen = 0
+        for bound, count in zip(self.buckets, self._counts):
+            seen += count
+            cumulative[f"le_{bound}"] = seen
+        cumulative["le_inf"] = self.count
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 3),
+            "avg": round(self.sum / self.count, 3) if self.count else 0.0,
+            "max": round(self.max, 3),
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "p99": self.quantile(0.99),
+            "buckets": cumulative
+        }
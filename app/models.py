@@ -1,7 +1,7 @@
 from datetime import datetime
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, JSON, Enum as SQLEnum
-from sqlalchemy.orm import declarative_base, relationship, backref
-from enum import Enum
+from sqlalchemy import Column, Integer, BigInteger, String, DateTime, ForeignKey, JSON, Index, DDL, event, func, text, Enum as SQLEnum
+from sqlalchemy.orm import declarative_base, relationship, backref, column_property
+from enum import Enum, IntEnum
 
 Base = declarative_base()
 
@@ -14,6 +14,12 @@ class TokenType(Enum):
     MASTER = "master"
     CHILD = "child"
 
+class AccessLevel(IntEnum):
+    """Уровень доступа к боту (сравнимый: none < user < admin)"""
+    none = 0
+    user = 1
+    admin = 2
+
 class WialonAccount(Base):
     """Сохраненные учетные данные Wialon"""
     __tablename__ = "wialon_accounts"
@@ -36,6 +42,9 @@ class Token(Base):
     
     id = Column(Integer, primary_key=True)
     token = Column(String, unique=True, nullable=False)
+    # Короткий идентификатор для callback_data (выражение по token с индексом, см. db_utils.token_short_id).
+    # Не уникален: коллизии префикса md5 разрешает db_utils.resolve_token_short_id
+    short_id = column_property(func.substr(func.md5(token), 1, 12))
     token_type = Column(SQLEnum(TokenType), nullable=False)
     creation_method = Column(SQLEnum(TokenCreationMethod), nullable=False)
     
@@ -45,13 +54,16 @@ class Token(Base):
     
     # Для дочерних токенов - связь с родительским
     parent_token_id = Column(Integer, ForeignKey("tokens.id"), nullable=True)
+    # Материализованный путь '/<id корня>/.../<id>/', поддерживается триггерами (см. TOKEN_PATH_DDL)
+    path = Column(String, nullable=True)
     child_tokens = relationship("Token", 
                               backref=backref("parent_token", remote_side=[id]),
                               cascade="all, delete-orphan")
     
     # Общие поля
     status = Column(String, default="active")
-    created_at = Column(DateTime, default=datetime.utcnow)
+    # NOT NULL: ключ keyset-пагинации (created_at, id)
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False, server_default=text("(now() AT TIME ZONE 'utc')"))
     expires_at = Column(DateTime, nullable=True)
     last_used = Column(DateTime, nullable=True)
     access_rights = Column(String, nullable=True)  # Права доступа в формате Wialon
@@ -59,27 +71,92 @@ class Token(Base):
     # Дополнительные данные
     token_metadata = Column(JSON, nullable=True)  # Для хранения доп. информации
 
+    __table_args__ = (
+        Index("ix_tokens_short_id", func.substr(func.md5(token), 1, 12)),
+        # Дерево токенов и выборки по аккаунту
+        Index("ix_tokens_parent_token_id", parent_token_id, postgresql_where=parent_token_id.isnot(None)),
+        Index("ix_tokens_account_id_type", account_id, token_type, postgresql_where=account_id.isnot(None)),
+        # Поддеревья: диапазонный поиск по префиксу пути
+        Index("ix_tokens_path", path, postgresql_ops={"path": "text_pattern_ops"}),
+        # Keyset-пагинация /my_tokens
+        Index("ix_tokens_created_at_id", created_at, id),
+        # Поиск активных токенов с истекающим сроком
+        Index(
+            "ix_tokens_active_expires_at",
+            expires_at,
+            postgresql_where=(status == "active") & expires_at.isnot(None)
+        ),
+    )
+
+    object_links = relationship("TokenObjectAccess", back_populates="token")
+
     def __repr__(self):
         return f"<Token(id={self.id}, type={self.token_type}, method={self.creation_method})>"
 
+# Триггеры materialized path для create_all (в миграциях e4b7a9c3d210 - те же определения).
+# В DDL знак процента экранируется как %%.
+TOKEN_PATH_DDL = [
+    """
+    CREATE OR REPLACE FUNCTION tokens_set_path() RETURNS trigger AS $$
+    DECLARE
+        parent_path varchar;
+    BEGIN
+        IF NEW.parent_token_id IS NULL THEN
+            NEW.path := '/' || NEW.id || '/';
+            RETURN NEW;
+        END IF;
+        SELECT path INTO parent_path FROM tokens WHERE id = NEW.parent_token_id;
+        IF parent_path LIKE '%%/' || NEW.id || '/%%' THEN
+            RAISE EXCEPTION 'token %% cannot be a descendant of itself', NEW.id;
+        END IF;
+        NEW.path := parent_path || NEW.id || '/';
+        RETURN NEW;
+    END
+    $$ LANGUAGE plpgsql
+    """,
+    """
+    CREATE OR REPLACE FUNCTION tokens_move_subtree() RETURNS trigger AS $$
+    BEGIN
+        UPDATE tokens SET path = NEW.path || substr(path, length(OLD.path) + 1)
+        WHERE path LIKE OLD.path || '%%' AND id <> NEW.id;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql
+    """,
+    """
+    CREATE TRIGGER tokens_set_path BEFORE INSERT OR UPDATE OF parent_token_id ON tokens
+    FOR EACH ROW EXECUTE FUNCTION tokens_set_path()
+    """,
+    """
+    CREATE TRIGGER tokens_move_subtree AFTER UPDATE OF parent_token_id ON tokens
+    FOR EACH ROW WHEN (OLD.path IS DISTINCT FROM NEW.path) EXECUTE FUNCTION tokens_move_subtree()
+    """,
+]
+for _statement in TOKEN_PATH_DDL:
+    event.listen(Token.__table__, "after_create", DDL(_statement).execute_if(dialect="postgresql"))
+
 class TokenHistory(Base):
     """История операций с токенами"""
     __tablename__ = "token_history"
     
-    id = Column(Integer, primary_key=True)
+    # Таблица партиционирована по месяцам (created_at), поэтому он входит в первичный ключ
+    id = Column(Integer, primary_key=True, autoincrement=True)
     token_id = Column(Integer, ForeignKey("tokens.id"), nullable=False)
     user_id = Column(Integer, ForeignKey("users.id"), nullable=True)
-    master_token_id = Column(Integer, ForeignKey("master_tokens.id"), nullable=True)
-    child_token_id = Column(Integer, ForeignKey("child_tokens.id"), nullable=True)
     action = Column(String, nullable=False)  # create, update, check, delete, copy
-    created_at = Column(DateTime, default=datetime.utcnow)
+    created_at = Column(DateTime, primary_key=True, default=datetime.utcnow)
     details = Column(JSON, nullable=True)  # Дополнительные данные операции
+
+    __table_args__ = (
+        Index("ix_token_history_user_created", user_id, created_at),
+        Index("ix_token_history_user_action_created", user_id, action, created_at),
+        Index("ix_token_history_token_id", token_id),
+        {"postgresql_partition_by": "RANGE (created_at)"},
+    )
     
     # Relationships
     token = relationship("Token")
     user = relationship("User", back_populates="token_history")
-    master_token = relationship("MasterToken", back_populates="token_history")
-    child_token = relationship("ChildToken", back_populates="token_history")
 
     def __repr__(self):
         return f"<TokenHistory(id={self.id}, action={self.action})>"
@@ -107,13 +184,15 @@ class User(Base):
     id = Column(Integer, primary_key=True)
     username = Column(String, unique=True, nullable=False)
     wialon_username = Column(String, nullable=True)
+    wialon_password = Column(String, nullable=True)  # bcrypt-хэш (create_or_update_user)
+    hashed_password = Column(String, nullable=True)  # bcrypt-хэш (create_or_update_user_by_telegram)
     encrypted_wialon_password = Column(String, nullable=True)
     created_at = Column(DateTime, default=datetime.utcnow)
-    telegram_id = Column(String, nullable=True)
+    telegram_id = Column(String, nullable=True, index=True)
     telegram_username = Column(String, nullable=True)
+    access_level = Column(SQLEnum(AccessLevel), nullable=False, default=AccessLevel.user, server_default=AccessLevel.user.name)
     
     # Relationships
-    master_tokens = relationship("MasterToken", back_populates="user")
     token_history = relationship("TokenHistory", back_populates="user")
     saved_credentials = relationship("SavedCredentials", back_populates="user")
 
@@ -128,57 +207,10 @@ class WialonCredentials(Base):
     encrypted_password = Column(String, nullable=False)
     last_used = Column(DateTime, default=datetime.utcnow)
     created_at = Column(DateTime, default=datetime.utcnow)
-    
-    # Связь с мастер-токенами
-    master_tokens = relationship("MasterToken", back_populates="credentials")
 
     def __repr__(self):
         return f"<WialonCredentials(id={self.id}, username={self.username})>"
 
-class MasterToken(Base):
-    __tablename__ = "master_tokens"
-    
-    id = Column(Integer, primary_key=True)
-    token = Column(String, unique=True, nullable=False)
-    user_id = Column(Integer, ForeignKey("users.id"), nullable=True)
-    credentials_id = Column(Integer, ForeignKey("wialon_credentials.id"), nullable=True)
-    creation_method = Column(SQLEnum(TokenCreationMethod), nullable=False)
-    status = Column(String, default="active")
-    expires_at = Column(DateTime, nullable=True)
-    created_at = Column(DateTime, default=datetime.utcnow)
-    access_rights = Column(String, nullable=True)  # Права доступа в формате Wialon
-    
-    # Relationships
-    user = relationship("User", back_populates="master_tokens")
-    credentials = relationship("WialonCredentials", back_populates="master_tokens")
-    child_tokens = relationship("ChildToken", back_populates="master_token", cascade="all, delete-orphan")
-    token_history = relationship("TokenHistory", back_populates="master_token")
-    object_links = relationship("TokenObjectAccess", back_populates="token")
-
-    def __repr__(self):
-        return f"<MasterToken(id={self.id}, method={self.creation_method})>"
-
-class ChildToken(Base):
-    __tablename__ = "child_tokens"
-    
-    id = Column(Integer, primary_key=True)
-    master_token_id = Column(Integer, ForeignKey("master_tokens.id"), nullable=False)
-    token = Column(String, unique=True, nullable=False)
-    status = Column(String, default="active")
-    creation_method = Column(SQLEnum(TokenCreationMethod), nullable=False)
-    last_used_at = Column(DateTime, nullable=True)
-    created_at = Column(DateTime, default=datetime.utcnow)
-    expires_at = Column(DateTime, nullable=True)
-    duration = Column(Integer, nullable=True)  # Длительность в секундах
-    access_rights = Column(String, nullable=True)  # Права доступа в формате Wialon
-    
-    # Relationships
-    master_token = relationship("MasterToken", back_populates="child_tokens")
-    token_history = relationship("TokenHistory", back_populates="child_token")
-
-    def __repr__(self):
-        return f"<ChildToken(id={self.id}, master_token_id={self.master_token_id})>"
-
 class Object(Base):
     __tablename__ = "objects"
     id = Column(Integer, primary_key=True)
@@ -192,13 +224,18 @@ class Object(Base):
 class TokenObjectAccess(Base):
     __tablename__ = "token_object_access"
     id = Column(Integer, primary_key=True)
-    token_id = Column(Integer, ForeignKey("master_tokens.id"), nullable=False)
+    token_id = Column(Integer, ForeignKey("tokens.id"), nullable=False)
     object_id = Column(Integer, ForeignKey("objects.id"), nullable=False)
     uacl = Column(Integer, nullable=False, default=0)  # Маска прав доступа
     fl = Column(Integer, nullable=True)  # Дополнительные флаги
     extra_data = Column(JSON, nullable=True)
+
+    __table_args__ = (
+        Index("ix_token_object_access_token_object", token_id, object_id),
+    )
+
     # Связи
-    token = relationship("MasterToken", back_populates="object_links")
+    token = relationship("Token", back_populates="object_links")
     object = relationship("Object", back_populates="token_links")
 
 class SavedCredentials(Base):
@@ -214,4 +251,38 @@ class SavedCredentials(Base):
     user = relationship("User", back_populates="saved_credentials")
 
     def __repr__(self):
-        return f"<SavedCredentials(id={self.id}, user_id={self.user_id})>" 
\ No newline at end of file
+        return f"<SavedCredentials(id={self.id}, user_id={self.user_id})>" 
+
+class FSMState(Base):
+    """Состояние FSM aiogram (переживает перезапуск бота)"""
+    __tablename__ = "fsm_states"
+
+    key = Column(String, primary_key=True)  # bot_id:chat_id:user_id[:thread_id]:destiny
+    state = Column(String, nullable=True)
+    data = Column(JSON, nullable=False, default=dict)
+    updated_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+
+    __table_args__ = (
+        Index("ix_fsm_states_updated_at", updated_at),
+    )
+
+class Job(Base):
+    """Фоновая задача бота (логин через браузер, создание токена через API)"""
+    __tablename__ = "jobs"
+
+    id = Column(Integer, primary_key=True)
+    kind = Column(String, nullable=False)
+    status = Column(String, nullable=False, default="queued")  # queued/running/succeeded/failed/cancelled/interrupted/rejected
+    user_id = Column(BigInteger, nullable=True)  # Telegram ID инициатора
+    chat_id = Column(BigInteger, nullable=False)
+    message_id = Column(Integer, nullable=False)  # Сообщение, в котором показывается прогресс
+    progress = Column(String, nullable=True)
+    result = Column(JSON, nullable=True)
+    error = Column(String, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    started_at = Column(DateTime, nullable=True)
+    finished_at = Column(DateTime, nullable=True)
+
+    __table_args__ = (
+        Index("ix_jobs_status", status, postgresql_where=status.in_(["queued", "running"])),
+    )
@@ -30,6 +30,28 @@ import urllib.parse
 # Регулярное выражение для извлечения token и sid из URL после успешной авторизации
 URL_PATTERN = r"(?:sid|access_token)=([^&]*)"
 
+# Общий HTTP-клиент для прямых запросов к API (переиспользует соединения и DNS-кэш)
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "20"))
+HTTP_TIMEOUT = int(os.getenv("HTTP_TIMEOUT", "30"))
+_http_session: aiohttp.ClientSession = None
+
+async def get_http_session() -> aiohttp.ClientSession:
+    """Получить общий aiohttp-клиент, создав его при первом обращении."""
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        _http_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=HTTP_POOL_SIZE, ttl_dns_cache=300),
+            timeout=aiohttp.ClientTimeout(total=HTTP_TIMEOUT)
+        )
+    return _http_session
+
+async def close_http_session() -> None:
+    """Закрыть общий aiohttp-клиент."""
+    global _http_session
+    if _http_session is not None and not _http_session.closed:
+        await _http_session.close()
+    _http_session = None
+
 async def get_wialon_token() -> Dict[str, Union[bool, str, None]]:
     """
     Получает токен Wialon из переменной окружения и проверяет его
@@ -399,16 +421,16 @@ async def make_api_request(url: str, params: dict, use_tor: bool = False) -> dic
                         logger.error(f"API request failed with status {response.status}: {error_text}")
                         return {"error": f"HTTP error {response.status}"}
         else:
-            # Обычное соединение без прокси
+            # Обычное соединение без прокси, через общий пул соединений
             logger.info("Using direct connection without proxy")
-            async with aiohttp.ClientSession() as session:
-                async with session.get(url, params=params) as response:
-                    if response.status == 200:
-                        return await response.json()
-                    else:
-                        error_text = await response.text()
-                        logger.error(f"API request failed with status {response.status}: {error_text}")
-                        return {"error": f"HTTP error {response.status}"}
+            session = await get_http_session()
+            async with session.get(url, params=params) as response:
+                if response.status == 200:
+                    return await response.json()
+                else:
+                    error_text = await response.text()
+                    logger.error(f"API request failed with status {response.status}: {error_text}")
+                    return {"error": f"HTTP error {response.status}"}
     except Exception as e:
         logger.error(f"Exception during API request: {e}")
         return {"error": str(e)}
\ No newline at end of file
@@ -0,0 +1,119 @@
+"""
+Кэш расшифрованных паролей сохраненных учетных записей Wialon.
+
+Пароль хранится в bytearray и затирается нулями при вытеснении, истечении TTL
+или явной инвалидации. Строка, возвращаемая get(), - неизменяемая копия,
+которую Python затереть не позволяет; поэтому TTL короткий, а в кэше живет
+не больше maxsize паролей. Истекшие значения, которые никто не читает,
+затирает фоновая задача secret_sweep_loop.
+"""
+import asyncio
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+SECRET_CACHE_SIZE = int(os.getenv("SECRET_CACHE_SIZE", "256"))
+SECRET_CACHE_TTL = float(os.getenv("SECRET_CACHE_TTL", "120"))
+SECRET_CACHE_SWEEP_INTERVAL = float(os.getenv("SECRET_CACHE_SWEEP_INTERVAL", "30"))
+
+logger = logging.getLogger(__name__)
+
+def _wipe(buffer: bytearray) -> None:
+    buffer[:] = bytes(len(buffer))
+
+class SecretCache:
+    """LRU-кэш секретов с TTL и затиранием значений."""
+
+    def __init__(self, maxsize: int = SECRET_CACHE_SIZE, ttl: float = SECRET_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expired = 0
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            buffer, expires_at = entry
+            if expires_at <= time.monotonic():
+                self._drop(key)
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return buffer.decode()
+
+    def set(self, key: str, value: str) -> None:
+        if not value or not self.maxsize or self.ttl <= 0:
+            return
+        with self._lock:
+            if key in self._data:
+                self._drop(key)
+            self._data[key] = (bytearray(value.encode()), time.monotonic() + self.ttl)
+            while len(self._data) > self.maxsize:
+                self._drop(next(iter(self._data)))
+                self.evictions += 1
+
+    def invalidate(self, *keys: str) -> None:
+        """Удалить и затереть значения (после изменения учетных данных)."""
+        with self._lock:
+            for key in keys:
+                if key in self._data:
+                    self._drop(key)
+
+    def purge_expired(self) -> int:
+        """Затереть и удалить все значения с истекшим TTL. Возвращает их число."""
+        now = time.monotonic()
+        with self._lock:
+            expired = [key for key, (_, expires_at) in self._data.items() if expires_at <= now]
+            for key in expired:
+                self._drop(key)
+        self.expired += len(expired)
+        return len(expired)
+
+    def clear(self) -> None:
+        with self._lock:
+            for key in list(self._data):
+                self._drop(key)
+
+    def _drop(self, key: str) -> None:
+        buffer, _ = self._data.pop(key)
+        _wipe(buffer)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expired": self.expired,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0
+        }
+
+secret_cache = SecretCache()
+
+async def secret_sweep_loop(cache: SecretCache = secret_cache, interval: float = SECRET_CACHE_SWEEP_INTERVAL) -> None:
+    """Фоновая задача: затирать истекшие пароли, не дожидаясь их повторного чтения."""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            purged = cache.purge_expired()
+            if purged:
+                logger.debug(f"Wiped {purged} expired cached secrets")
+        except Exception as e:
+            logger.error(f"Secret cache sweep failed: {e}")
@@ -0,0 +1,208 @@
+"""
+Планировщик исходящих запросов к Bot API с учетом лимитов Telegram.
+
+Подключается как request-middleware сессии бота, поэтому охватывает все
+отправки и правки сообщений (reply, edit_text, send_document) без изменения
+обработчиков:
+- общий token bucket (SEND_GLOBAL_RATE сообщений/сек) и bucket на чат
+  (SEND_CHAT_RATE для личных чатов, SEND_GROUP_RATE для групп);
+- правки одного и того же сообщения, ожидающие отправки, объединяются:
+  уходит только последняя, все ожидающие получают ее результат (если
+  отправивший правку обработчик отменен, отправку берет на себя ожидающий);
+- при 429 запрос повторяется после retry_after, а чат (или весь бот)
+  приостанавливается на это время.
+"""
+import asyncio
+import logging
+import os
+import time
+from typing import Dict, Optional, Tuple
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+
+from app.cache import LRUCache
+from app.metrics import Histogram
+
+logger = logging.getLogger(__name__)
+
+SEND_GLOBAL_RATE = float(os.getenv("SEND_GLOBAL_RATE", "30"))
+SEND_CHAT_RATE = float(os.getenv("SEND_CHAT_RATE", "1"))
+SEND_CHAT_BURST = int(os.getenv("SEND_CHAT_BURST", "3"))
+SEND_GROUP_RATE = float(os.getenv("SEND_GROUP_RATE", str(20 / 60)))
+SEND_MAX_RETRIES = int(os.getenv("SEND_MAX_RETRIES", "3"))
+
+# Методы, на которые распространяются лимиты отправки
+THROTTLED_METHODS = {
+    "sendMessage", "sendDocument", "sendPhoto", "sendMediaGroup", "sendAnimation", "sendVideo",
+    "copyMessage", "forwardMessage",
+    "editMessageText", "editMessageReplyMarkup", "editMessageCaption",
+}
+# Правки, из которых имеет смысл отправлять только последнюю
+COALESCED_METHODS = {"editMessageText", "editMessageReplyMarkup", "editMessageCaption"}
+
+class TokenBucket:
+    """Token bucket с FIFO-ожиданием и возможностью приостановки (retry_after)."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float) -> None:
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
+        # Пополнение начинается только после паузы, иначе bucket выйдет из 429 с полным запасом
+        self._updated = self._paused_until
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + max(0.0, now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+class _OwnerCancelled(Exception):
+    """Запрос, отправлявший объединенную правку, отменен до ее отправки."""
+
+class _PendingEdit:
+    def __init__(self, method, future: asyncio.Future):
+        self.method = method
+        self.future = future
+
+class SendScheduler(BaseRequestMiddleware):
+    """Request-middleware: лимиты отправки, объединение правок, повтор после 429."""
+
+    def __init__(
+        self,
+        global_rate: float = SEND_GLOBAL_RATE,
+        chat_rate: float = SEND_CHAT_RATE,
+        chat_burst: int = SEND_CHAT_BURST,
+        group_rate: float = SEND_GROUP_RATE,
+        max_retries: int = SEND_MAX_RETRIES
+    ):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.max_retries = max_retries
+        self._global = TokenBucket(global_rate, global_rate)
+        # Вытесненный bucket просто создается заново полным
+        self._chats = LRUCache(maxsize=10000)
+        self._edits: Dict[Tuple, _PendingEdit] = {}
+        self.wait_ms = Histogram()
+        self._waiting = 0
+        self._metrics = {
+            "sent": 0,
+            "coalesced": 0,
+            "retry_after": 0,
+            "retry_after_seconds": 0.0,
+            "failed": 0,
+            "max_waiting": 0
+        }
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            # Отрицательные chat_id - группы и каналы (лимит в минуту)
+            is_group = isinstance(chat_id, int) and chat_id < 0
+            bucket = TokenBucket(self.group_rate, 1) if is_group else TokenBucket(self.chat_rate, self.chat_burst)
+            self._chats.set(chat_id, bucket)
+        return bucket
+
+    async def _acquire(self, chat_id) -> None:
+        started = time.perf_counter()
+        self._waiting += 1
+        self._metrics["max_waiting"] = max(self._metrics["max_waiting"], self._waiting)
+        try:
+            if chat_id is not None:
+                await self._chat_bucket(chat_id).acquire()
+            await self._global.acquire()
+        finally:
+            self._waiting -= 1
+            self.wait_ms.observe((time.perf_counter() - started) * 1000)
+
+    async def _send(self, make_request, bot, method, chat_id):
+        attempt = 0
+        while True:
+            try:
+                result = await make_request(bot, method)
+                self._metrics["sent"] += 1
+                return result
+            except TelegramRetryAfter as e:
+                attempt += 1
+                self._metrics["retry_after"] += 1
+                self._metrics["retry_after_seconds"] += e.retry_after
+                (self._chat_bucket(chat_id) if chat_id is not None else self._global).pause(e.retry_after)
+                if attempt > self.max_retries:
+                    self._metrics["failed"] += 1
+                    raise
+                logger.warning(f"Telegram flood control for {method.__api_method__} (chat {chat_id}), retry in {e.retry_after}s")
+                await self._acquire(chat_id)
+            except Exception:
+                self._metrics["failed"] += 1
+                raise
+
+    async def __call__(self, make_request, bot, method):
+        name = getattr(method, "__api_method__", None)
+        if name not in THROTTLED_METHODS:
+            return await make_request(bot, method)
+        chat_id = getattr(method, "chat_id", None)
+        message_id = getattr(method, "message_id", None)
+        if name not in COALESCED_METHODS or chat_id is None or message_id is None:
+            await self._acquire(chat_id)
+            return await self._send(make_request, bot, method, chat_id)
+
+        key = (chat_id, message_id, name)
+        pending = self._edits.get(key)
+        if pending is not None:
+            # Более ранняя правка еще ждет лимита - заменяем ее содержимое на новое
+            pending.method = method
+            self._metrics["coalesced"] += 1
+            try:
+                return await asyncio.shield(pending.future)
+            except _OwnerCancelled:
+                # Последнюю правку отправит первый из ожидающих, остальные присоединятся к нему
+                return await self(make_request, bot, pending.method)
+
+        pending = _PendingEdit(method, asyncio.get_running_loop().create_future())
+        pending.future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self._edits[key] = pending
+        try:
+            await self._acquire(chat_id)
+            # Правки, пришедшие после этого момента, пойдут следующим запросом
+            self._edits.pop(key, None)
+            result = await self._send(make_request, bot, pending.method, chat_id)
+        except BaseException as e:
+            if self._edits.get(key) is pending:
+                self._edits.pop(key, None)
+            if not pending.future.done():
+                if isinstance(e, asyncio.CancelledError):
+                    # Отмена одного обработчика не должна отменять правки других
+                    pending.future.set_exception(_OwnerCancelled())
+                else:
+                    pending.future.set_exception(e)
+            raise
+        pending.future.set_result(result)
+        return result
+
+    def stats(self) -> dict:
+        """Метрики: ожидающие лимита запросы, время ожидания, объединенные правки, 429."""
+        return {
+            **self._metrics,
+            "waiting": self._waiting,
+            "pending_edits": len(self._edits),
+            "chats_tracked": len(self._chats),
+            "wait_ms": self.wait_ms.snapshot()
+        }
+
+send_scheduler = SendScheduler()
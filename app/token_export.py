@@ -0,0 +1,154 @@
+"""
+Потоковый экспорт токенов в CSV, XLSX и JSONL.
+
+Строки читаются из БД серверным курсором пачками (db_utils.stream_tokens)
+и сразу пишутся во временный файл (SpooledTemporaryFile: в памяти до
+EXPORT_SPOOL_SIZE байт, дальше на диске), при необходимости через gzip.
+В памяти одновременно находится не больше одной пачки строк. Форматирование
+и запись пачек (и сохранение XLSX) выполняются в отдельном потоке, чтобы
+запись файла, вытесненного на диск, не блокировала event loop.
+"""
+import asyncio
+import csv
+import datetime
+import gzip
+import io
+import json
+import os
+import tempfile
+from typing import AsyncGenerator, Awaitable, Callable, Optional
+
+from aiogram.types import InputFile
+
+from app.database import AsyncSessionLocal
+from app.db_utils import stream_tokens, EXPORT_CHUNK_SIZE
+
+try:
+    from openpyxl import Workbook
+except ImportError:  # openpyxl - опциональная зависимость (только для XLSX)
+    Workbook = None
+
+EXPORT_SPOOL_SIZE = int(os.getenv("EXPORT_SPOOL_SIZE", str(8 * 1024 * 1024)))
+EXPORT_FORMATS = ("csv", "xlsx", "jsonl")
+
+HEADERS = ["Token", "User", "Created At", "Expires At", "Created Via", "Operation Type", "Parent Token", "Status", "Label"]
+
+def _format_dt(value: Optional[datetime.datetime]) -> str:
+    return value.strftime('%Y-%m-%d %H:%M:%S') if value else ""
+
+def _row_values(row) -> list:
+    metadata = row.token_metadata or {}
+    return [
+        row.token,
+        row.username or "",
+        _format_dt(row.created_at),
+        _format_dt(row.expires_at),
+        row.creation_method.value if row.creation_method else "",
+        row.token_type.value if row.token_type else "",
+        row.parent_token or "",
+        row.status or "",
+        metadata.get("label", "") if isinstance(metadata, dict) else ""
+    ]
+
+def _row_json(row) -> str:
+    return json.dumps({
+        "token": row.token,
+        "username": row.username,
+        "created_at": row.created_at.isoformat() if row.created_at else None,
+        "expires_at": row.expires_at.isoformat() if row.expires_at else None,
+        "creation_method": row.creation_method.value if row.creation_method else None,
+        "token_type": row.token_type.value if row.token_type else None,
+        "parent_token": row.parent_token,
+        "status": row.status,
+        "metadata": row.token_metadata
+    }, ensure_ascii=False, default=str)
+
+class SpooledInputFile(InputFile):
+    """Загрузка файла в Telegram кусками, без чтения его целиком в память."""
+
+    def __init__(self, file, filename: str, chunk_size: int = 64 * 1024):
+        super().__init__(filename=filename, chunk_size=chunk_size)
+        self.file = file
+
+    async def read(self, bot) -> AsyncGenerator[bytes, None]:
+        self.file.seek(0)
+        while chunk := self.file.read(self.chunk_size):
+            yield chunk
+
+async def export_tokens(
+    fmt: str = "csv",
+    status: str = None,
+    created_from: datetime.datetime = None,
+    created_to: datetime.datetime = None,
+    compress: bool = False,
+    progress: Callable[[int], Awaitable[None]] = None,
+    chunk_size: int = EXPORT_CHUNK_SIZE
+) -> tuple:
+    """
+    Выгрузить токены во временный файл.
+
+    Args:
+        fmt: csv, xlsx или jsonl
+        status: Фильтр по статусу
+        created_from: Нижняя граница created_at (включительно)
+        created_to: Верхняя граница created_at (не включительно)
+        compress: Сжать gzip (для xlsx игнорируется - формат уже сжат)
+        progress: Корутина progress(rows), вызывается после каждой пачки
+        chunk_size: Размер пачки строк
+
+    Returns:
+        tuple: (файл, открытый на чтение с начала, имя файла, число строк)
+    """
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Unsupported export format: {fmt}")
+    if fmt == "xlsx" and Workbook is None:
+        raise RuntimeError("XLSX export requires openpyxl (pip install openpyxl)")
+    compress = compress and fmt != "xlsx"
+
+    spool = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_SIZE, mode="w+b")
+    raw = gzip.GzipFile(fileobj=spool, mode="wb") if compress else spool
+    rows = 0
+    try:
+        if fmt == "xlsx":
+            # write_only: строки не хранятся в памяти книги
+            workbook = Workbook(write_only=True)
+            sheet = workbook.create_sheet("Tokens")
+            sheet.append(HEADERS)
+        else:
+            text = io.TextIOWrapper(raw, encoding="utf-8", newline="")
+            writer = csv.writer(text) if fmt == "csv" else None
+            if writer:
+                writer.writerow(HEADERS)
+
+        def write(partition: list) -> None:
+            if fmt == "xlsx":
+                for row in partition:
+                    sheet.append(_row_values(row))
+            elif fmt == "csv":
+                writer.writerows(_row_values(row) for row in partition)
+            else:
+                text.writelines(_row_json(row) + "\n" for row in partition)
+
+        async with AsyncSessionLocal() as session:
+            async for partition in stream_tokens(session, status, created_from, created_to, chunk_size):
+                await asyncio.to_thread(write, partition)
+                rows += len(partition)
+                if progress:
+                    await progress(rows)
+
+        def finish() -> None:
+            if fmt == "xlsx":
+                workbook.save(spool)
+                return
+            text.flush()
+            text.detach()
+            if compress:
+                raw.close()
+
+        await asyncio.to_thread(finish)
+    except BaseException:
+        spool.close()
+        raise
+    spool.seek(0)
+    filename = f"wialon_tokens_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.{fmt}" + (".gz" if compress else "")
+    return spool, filename, rows
@@ -0,0 +1,120 @@
+"""
+Поиск токенов для inline-запросов (@bot <текст>).
+
+- В БД поиск идет через ILIKE по GIN-индексам pg_trgm с ранжированием по
+  similarity(); если расширения pg_trgm нет, используется тот же ILIKE без
+  ранжирования (новые токены сверху).
+- Запросы короче INLINE_MIN_QUERY (по умолчанию 3 символа) не выполняются:
+  из более коротких строк не получается ни одной триграммы, и поиск
+  превращается в полный просмотр таблиц.
+- Запрос ограничен statement_timeout = INLINE_SEARCH_BUDGET_MS.
+- Результаты кэшируются по тексту запроса на INLINE_CACHE_TTL секунд. Если для
+  более короткого префикса в кэше лежит полный результат (меньше limit строк),
+  более длинный запрос фильтруется из него без обращения к БД - так
+  поглощаются серии запросов при наборе текста.
+"""
+import logging
+import os
+import time
+from typing import Optional
+
+from sqlalchemy import text
+from sqlalchemy.exc import DBAPIError
+
+from app.cache import LRUCache
+from app.database import AsyncSessionLocal
+from app.db_utils import search_tokens
+from app.metrics import Histogram
+
+logger = logging.getLogger(__name__)
+
+INLINE_RESULTS_LIMIT = int(os.getenv("INLINE_RESULTS_LIMIT", "20"))
+INLINE_MIN_QUERY = int(os.getenv("INLINE_MIN_QUERY", "3"))
+INLINE_SEARCH_BUDGET_MS = int(os.getenv("INLINE_SEARCH_BUDGET_MS", "100"))
+INLINE_CACHE_TTL = float(os.getenv("INLINE_CACHE_TTL", "5"))
+
+_results = LRUCache(maxsize=int(os.getenv("INLINE_CACHE_SIZE", "1024")), ttl=INLINE_CACHE_TTL)
+_has_trgm: Optional[bool] = None
+latency_ms = Histogram()
+_metrics = {
+    "queries": 0,
+    "prefix_hits": 0,
+    "db_queries": 0,
+    "timeouts": 0,
+    "errors": 0
+}
+
+def _row_to_result(row) -> dict:
+    metadata = row.token_metadata if isinstance(row.token_metadata, dict) else {}
+    return {
+        "token": row.token,
+        "short_id": row.short_id,
+        "label": metadata.get("label") or "",
+        "username": row.username or "",
+        "type": row.token_type.value,
+        "status": row.status or ""
+    }
+
+def _matches(item: dict, query: str) -> bool:
+    return any(query in item[field].lower() for field in ("token", "label", "username"))
+
+async def _trgm_available(session) -> bool:
+    global _has_trgm
+    if _has_trgm is None:
+        _has_trgm = bool(await session.scalar(text("SELECT EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm')")))
+        if not _has_trgm:
+            logger.warning("pg_trgm is not installed, inline search falls back to unranked ILIKE")
+    return _has_trgm
+
+def _from_prefix(query: str) -> Optional[list]:
+    for length in range(len(query) - 1, INLINE_MIN_QUERY - 1, -1):
+        entry = _results.get(query[:length])
+        if entry is not None and entry["complete"]:
+            return [item for item in entry["items"] if _matches(item, query)]
+    return None
+
+async def search(query: str, limit: int = INLINE_RESULTS_LIMIT) -> list:
+    """Найти токены по тексту inline-запроса. Возвращает список словарей (пустой при превышении бюджета)."""
+    query = query.strip().lower()
+    if len(query) < INLINE_MIN_QUERY:
+        return []
+    _metrics["queries"] += 1
+    started = time.perf_counter()
+    try:
+        entry = _results.get(query)
+        if entry is not None:
+            return entry["items"]
+        items = _from_prefix(query)
+        if items is not None:
+            _metrics["prefix_hits"] += 1
+            _results.set(query, {"items": items, "complete": True})
+            return items
+
+        _metrics["db_queries"] += 1
+        try:
+            async with AsyncSessionLocal() as session:
+                ranked = await _trgm_available(session)
+                # Бюджет на запрос: БД сама прервет слишком долгий поиск
+                await session.execute(text(f"SET LOCAL statement_timeout = {INLINE_SEARCH_BUDGET_MS}"))
+                rows = await search_tokens(session, query, limit=limit, ranked=ranked)
+        except DBAPIError as e:
+            if "statement timeout" in str(e) or "canceling statement" in str(e):
+                _metrics["timeouts"] += 1
+            else:
+                _metrics["errors"] += 1
+                logger.error(f"Inline token search failed: {e}")
+            return []
+        items = [_row_to_result(row) for row in rows]
+        _results.set(query, {"items": items, "complete": len(items) < limit})
+        return items
+    finally:
+        latency_ms.observe((time.perf_counter() - started) * 1000)
+
+def search_stats() -> dict:
+    """Метрики inline-поиска: запросы, попадания по префиксу, таймауты, задержка."""
+    return {
+        **_metrics,
+        "pg_trgm": _has_trgm,
+        "cache": _results.stats(),
+        "latency_ms": latency_ms.snapshot()
+    }
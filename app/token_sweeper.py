@@ -0,0 +1,231 @@
+"""
+Фоновая проверка сроков действия токенов.
+
+- renew_expiring_tokens: продлевает дочерние токены, срок которых скоро истечет
+  (token/update через мастер-токен, включается TOKEN_RENEW_ENABLED);
+- expire_tokens: пачками помечает истекшие активные токены статусом "expired"
+  (частичный индекс ix_tokens_active_expires_at, FOR UPDATE SKIP LOCKED);
+- token_sweeper_loop: периодически выполняет обе операции и отправляет
+  каждому пользователю бота одну сводку изменений.
+
+Запуск вручную (без отправки сводки):
+    python -m app.token_sweeper
+"""
+import asyncio
+import datetime
+import json
+import logging
+import os
+
+from sqlalchemy import select, update
+from sqlalchemy.orm import aliased
+
+from app.database import AsyncSessionLocal, engine
+from app.db_utils import invalidate_token_info
+from app.history_writer import history_writer
+from app.models import Token, TokenType
+from app.scraper import make_api_request, close_http_session
+from app.utils import get_allowed_user_ids, get_bool_env_variable, get_env_variable
+
+logger = logging.getLogger(__name__)
+
+SWEEP_INTERVAL = int(os.getenv("TOKEN_SWEEP_INTERVAL", "300"))
+SWEEP_BATCH_SIZE = int(os.getenv("TOKEN_SWEEP_BATCH_SIZE", "500"))
+RENEW_ENABLED = get_bool_env_variable("TOKEN_RENEW_ENABLED", False)
+RENEW_BEFORE = int(os.getenv("TOKEN_RENEW_BEFORE", str(24 * 3600)))  # Продлевать за N секунд до истечения
+RENEW_DURATION = int(os.getenv("TOKEN_RENEW_DURATION", str(30 * 24 * 3600)))
+RENEW_BATCH_SIZE = int(os.getenv("TOKEN_RENEW_BATCH_SIZE", "50"))
+DIGEST_MAX_ITEMS = 20
+
+# Токены, о неудачном продлении которых уже сообщалось (чтобы не повторять в каждой сводке)
+_reported_failures = set()
+
+def _short(token: str) -> str:
+    return f"{token[:8]}...{token[-4:]}"
+
+def _access_flags(access_rights: str) -> int:
+    try:
+        return int(access_rights, 0) if access_rights else -1
+    except ValueError:
+        return -1
+
+async def expire_tokens(batch_size: int = SWEEP_BATCH_SIZE) -> list:
+    """
+    Пометить истекшие активные токены статусом "expired".
+
+    Returns:
+        list: [{"token", "token_type", "expires_at"}] помеченных токенов
+    """
+    expired = []
+    while True:
+        now = datetime.datetime.utcnow()
+        batch = (
+            select(Token.id)
+            .where(Token.status == "active", Token.expires_at <= now)
+            .order_by(Token.expires_at)
+            .limit(batch_size)
+            .with_for_update(skip_locked=True)
+        )
+        async with AsyncSessionLocal() as session:
+            rows = (await session.execute(
+                update(Token)
+                .where(Token.id.in_(batch))
+                .values(status="expired")
+                .returning(Token.id, Token.token, Token.token_type, Token.expires_at)
+                .execution_options(synchronize_session=False)
+            )).all()
+            await session.commit()
+        if not rows:
+            break
+        invalidate_token_info(*(row.token for row in rows))
+        for row in rows:
+            await history_writer.record(
+                token_id=row.id,
+                action="expire",
+                details={"expires_at": row.expires_at.isoformat()}
+            )
+            expired.append({"token": row.token, "token_type": row.token_type.value, "expires_at": row.expires_at})
+        if len(rows) < batch_size:
+            break
+    if expired:
+        logger.info(f"Marked {len(expired)} tokens as expired")
+    return expired
+
+async def _renew_token(api_url: str, sid: str, user_id: int, token: Token) -> dict:
+    params = {
+        "callMode": "update",
+        "userId": int(user_id),
+        "h": token.token,
+        "app": "Wialon Hosting Custom Token",
+        "at": 0,
+        "dur": RENEW_DURATION,
+        "fl": _access_flags(token.access_rights),
+        "p": "{}",
+        "items": []
+    }
+    return await make_api_request(api_url, {"svc": "token/update", "params": json.dumps(params), "sid": sid})
+
+async def renew_expiring_tokens(limit: int = RENEW_BATCH_SIZE) -> tuple:
+    """
+    Продлить активные дочерние токены, истекающие в ближайшие RENEW_BEFORE секунд.
+
+    Для каждого мастер-токена выполняется один token/login, затем token/update
+    для всех его дочерних токенов из выборки.
+
+    Returns:
+        tuple: (продленные, непродленные) - списки {"token", "expires_at"[, "error"]}
+    """
+    now = datetime.datetime.utcnow()
+    parent = aliased(Token)
+    async with AsyncSessionLocal() as session:
+        rows = (await session.execute(
+            select(Token, parent.token)
+            .join(parent, parent.id == Token.parent_token_id)
+            .where(
+                Token.status == "active",
+                Token.token_type == TokenType.CHILD,
+                Token.expires_at > now,
+                Token.expires_at <= now + datetime.timedelta(seconds=RENEW_BEFORE)
+            )
+            .order_by(Token.expires_at)
+            .limit(limit)
+        )).all()
+    if not rows:
+        return [], []
+
+    by_master = {}
+    for token, master_token in rows:
+        by_master.setdefault(master_token, []).append(token)
+
+    api_url = get_env_variable("WIALON_API_URL", "https://hst-api.wialon.com/wialon/ajax.html")
+    renewed, failed = [], []
+    for master_token, tokens in by_master.items():
+        login = await make_api_request(api_url, {
+            "svc": "token/login",
+            "params": json.dumps({"token": master_token, "fl": 7})
+        })
+        sid = login.get("eid")
+        user_id = login.get("user", {}).get("id")
+        if "error" in login or not sid or not user_id:
+            reason = login.get("reason", login.get("error", "no session"))
+            failed.extend({"token": t.token, "expires_at": t.expires_at, "error": f"login: {reason}"} for t in tokens)
+            continue
+        for token in tokens:
+            result = await _renew_token(api_url, sid, user_id, token)
+            if "error" in result:
+                failed.append({"token": token.token, "expires_at": token.expires_at,
+                               "error": str(result.get("reason", result.get("error")))})
+                continue
+            expires_at = datetime.datetime.utcnow() + datetime.timedelta(seconds=RENEW_DURATION)
+            async with AsyncSessionLocal() as session:
+                await session.execute(
+                    update(Token).where(Token.id == token.id).values(expires_at=expires_at)
+                )
+                await session.commit()
+            invalidate_token_info(token.token)
+            await history_writer.record(
+                token_id=token.id,
+                action="renew",
+                details={"previous_expires_at": token.expires_at.isoformat(), "duration": RENEW_DURATION}
+            )
+            renewed.append({"token": token.token, "expires_at": expires_at})
+    logger.info(f"Renewed {len(renewed)} tokens, failed to renew {len(failed)}")
+    return renewed, failed
+
+async def sweep_tokens(renew: bool = RENEW_ENABLED) -> dict:
+    """Один проход: продление (если включено), затем пометка истекших."""
+    renewed, failed = await renew_expiring_tokens() if renew else ([], [])
+    expired = await expire_tokens()
+    new_failures = [item for item in failed if item["token"] not in _reported_failures]
+    _reported_failures.difference_update(item["token"] for item in renewed + expired)
+    _reported_failures.update(item["token"] for item in new_failures)
+    return {"expired": expired, "renewed": renewed, "renew_failed": new_failures}
+
+def format_digest(report: dict) -> str:
+    """Сводка изменений для Telegram (HTML) или пустая строка, если изменений нет."""
+    sections = []
+    for key, title, suffix in (
+        ("expired", "⌛ Истекли", lambda item: f"истек {item['expires_at']:%d.%m.%Y %H:%M}"),
+        ("renewed", "🔄 Продлены", lambda item: f"до {item['expires_at']:%d.%m.%Y %H:%M}"),
+        ("renew_failed", "⚠️ Не удалось продлить", lambda item: item["error"]),
+    ):
+        items = report.get(key) or []
+        if not items:
+            continue
+        lines = [f"<b>{title}: {len(items)}</b>"]
+        lines += [f"• <code>{_short(item['token'])}</code> - {suffix(item)}" for item in items[:DIGEST_MAX_ITEMS]]
+        if len(items) > DIGEST_MAX_ITEMS:
+            lines.append(f"... и еще {len(items) - DIGEST_MAX_ITEMS}")
+        sections.append("\n".join(lines))
+    return "📋 <b>Сводка по токенам</b>\n\n" + "\n\n".join(sections) if sections else ""
+
+async def send_digest(bot, report: dict) -> None:
+    """Отправить одну сводку каждому пользователю бота."""
+    text = format_digest(report)
+    if not text:
+        return
+    for user_id in get_allowed_user_ids():
+        try:
+            await bot.send_message(user_id, text, parse_mode="HTML")
+        except Exception as e:
+            logger.warning(f"Failed to send token digest to {user_id}: {e}")
+
+async def token_sweeper_loop(bot, interval: int = SWEEP_INTERVAL) -> None:
+    """Фоновая задача проверки сроков действия токенов."""
+    while True:
+        try:
+            report = await sweep_tokens()
+            await send_digest(bot, report)
+        except Exception as e:
+            logger.error(f"Token sweep failed: {e}")
+        await asyncio.sleep(interval)
+
+async def _main() -> None:
+    report = await sweep_tokens()
+    await close_http_session()
+    await engine.dispose()
+    print(f"Истекло: {len(report['expired'])}, продлено: {len(report['renewed'])}, "
+          f"не продлено: {len(report['renew_failed'])}")
+
+if __name__ == "__main__":
+    asyncio.run(_main())
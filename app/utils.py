@@ -1,7 +1,8 @@
 from loguru import logger
 import os
 from typing import Optional, List
-from cryptography.fernet import Fernet
+from cryptography.fernet import Fernet, MultiFernet, InvalidToken
+from functools import lru_cache
 from base64 import b64encode, b64decode
 
 def get_env_variable(var_name: str, default: Optional[str] = None) -> str:
@@ -41,13 +42,6 @@ def get_allowed_user_ids() -> List[int]:
     user_ids = [uid.strip() for uid in user_ids_str.replace(',', ' ').split() if uid.strip().isdigit()]
     return [int(user_id) for user_id in user_ids]
 
-def is_user_allowed(user_id: int) -> bool:
-    """
-    Checks if the given user ID is in the allowed user IDs list.
-    """
-    allowed_user_ids = get_allowed_user_ids()
-    return user_id in allowed_user_ids
-
 def get_bool_env_variable(var_name: str, default: bool = False) -> bool:
     """
     Получение булевой переменной окружения с возможностью указать значение по умолчанию.
@@ -69,19 +63,49 @@ def get_bool_env_variable(var_name: str, default: bool = False) -> bool:
     except ValueError:
         return default
 
-def get_encryption_key() -> bytes:
-    """Получить ключ шифрования из переменных окружения или создать новый."""
-    key = os.getenv("ENCRYPTION_KEY")
-    if not key:
+def get_encryption_keys() -> List[bytes]:
+    """
+    Ключи шифрования: ENCRYPTION_KEYS (через запятую, первый - основной) или ENCRYPTION_KEY.
+
+    Если ключ не задан, один ключ генерируется на процесс. Пароли, зашифрованные
+    им, после перезапуска расшифровать будет нельзя.
+    """
+    keys = [k.strip() for k in os.getenv("ENCRYPTION_KEYS", "").split(",") if k.strip()]
+    if not keys and os.getenv("ENCRYPTION_KEY"):
+        keys = [os.getenv("ENCRYPTION_KEY").strip()]
+    if not keys:
         key = Fernet.generate_key()
         logger.warning(f"Создан новый ключ шифрования: {key.decode()}. Добавьте его в .env как ENCRYPTION_KEY")
-    return key if isinstance(key, bytes) else key.encode()
+        return [key]
+    return [k.encode() for k in keys]
+
+@lru_cache(maxsize=None)
+def _keys() -> tuple:
+    return tuple(get_encryption_keys())
+
+def get_encryption_key() -> bytes:
+    """Основной ключ шифрования (которым шифруются новые пароли)."""
+    return _keys()[0]
+
+@lru_cache(maxsize=None)
+def get_cipher() -> MultiFernet:
+    """Общий для процесса шифр: шифрует основным ключом, расшифровывает любым из ключей."""
+    return MultiFernet([Fernet(key) for key in _keys()])
+
+@lru_cache(maxsize=None)
+def _primary_cipher() -> Fernet:
+    return Fernet(get_encryption_key())
+
+def reset_cipher() -> None:
+    """Сбросить кэш ключей и шифра (после изменения переменных окружения)."""
+    _keys.cache_clear()
+    get_cipher.cache_clear()
+    _primary_cipher.cache_clear()
 
 def encrypt_password(password: str) -> str:
     """Зашифровать пароль."""
     try:
-        f = Fernet(get_encryption_key())
-        return b64encode(f.encrypt(password.encode())).decode()
+        return b64encode(get_cipher().encrypt(password.encode())).decode()
     except Exception as e:
         logger.error(f"Ошибка при шифровании пароля: {e}")
         return None
@@ -89,8 +113,23 @@ def encrypt_password(password: str) -> str:
 def decrypt_password(encrypted_password: str) -> str:
     """Расшифровать пароль."""
     try:
-        f = Fernet(get_encryption_key())
-        return f.decrypt(b64decode(encrypted_password)).decode()
+        return get_cipher().decrypt(b64decode(encrypted_password)).decode()
     except Exception as e:
         logger.error(f"Ошибка при расшифровке пароля: {e}")
         return None
+
+def rotate_encrypted_password(encrypted_password: str) -> Optional[str]:
+    """
+    Перешифровать пароль основным ключом.
+
+    Returns:
+        Optional[str]: Новое значение или None, если значение уже зашифровано основным ключом
+    Raises:
+        cryptography.fernet.InvalidToken: Если значение не расшифровывается ни одним ключом
+    """
+    token = b64decode(encrypted_password)
+    try:
+        _primary_cipher().decrypt(token)
+        return None
+    except InvalidToken:
+        return b64encode(get_cipher().rotate(token)).decode()
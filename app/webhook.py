@@ -0,0 +1,149 @@
+"""
+Прием апдейтов Telegram через webhook и их обработка пулом воркеров.
+
+Эндпоинт webhook только кладет апдейт в ограниченную очередь и сразу отвечает.
+Апдейты распределяются по воркерам по chat_id: апдейты одного чата
+обрабатываются строго по порядку одним воркером, а медленный обработчик
+(логин через браузер) задерживает только свой шард, а не всех пользователей.
+Если очередь шарда заполнена, эндпоинт отвечает 503 и Telegram повторит доставку.
+"""
+import asyncio
+import logging
+import os
+import time
+from typing import Optional
+
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+
+from app.metrics import Histogram
+
+logger = logging.getLogger(__name__)
+
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "8"))
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "1000"))
+
+_STOP = object()
+
+def update_chat_id(update: Update) -> int:
+    """chat_id апдейта (для событий без чата - id пользователя, в крайнем случае update_id)."""
+    try:
+        event = update.event
+    except Exception:
+        return update.update_id
+    chat = getattr(event, "chat", None)
+    if chat is None:
+        message = getattr(event, "message", None)
+        chat = getattr(message, "chat", None)
+    if chat is not None:
+        return chat.id
+    user = getattr(event, "from_user", None)
+    if user is not None:
+        return user.id
+    return update.update_id
+
+class UpdateQueue:
+    """Шардированная по чатам очередь апдейтов с пулом воркеров."""
+
+    def __init__(self, workers: int = WEBHOOK_WORKERS, max_queue: int = WEBHOOK_QUEUE_SIZE):
+        """
+        Args:
+            workers: Число воркеров (шардов)
+            max_queue: Суммарная емкость очередей всех шардов
+        """
+        self.workers = max(1, workers)
+        self.max_queue = max_queue
+        self._queues = []
+        self._tasks = []
+        self._bot: Optional[Bot] = None
+        self._dispatcher: Optional[Dispatcher] = None
+        self.lag_ms = Histogram()
+        self.processing_ms = Histogram()
+        self._metrics = {
+            "accepted": 0,
+            "rejected": 0,
+            "processed": 0,
+            "failed": 0,
+            "max_queue_depth": 0
+        }
+
+    @property
+    def running(self) -> bool:
+        return any(not task.done() for task in self._tasks)
+
+    async def start(self, bot: Bot, dispatcher: Dispatcher) -> None:
+        """Запустить воркеры."""
+        if self.running:
+            return
+        self._bot = bot
+        self._dispatcher = dispatcher
+        shard_size = max(1, self.max_queue // self.workers)
+        self._queues = [asyncio.Queue(maxsize=shard_size) for _ in range(self.workers)]
+        self._tasks = [
+            asyncio.create_task(self._run(queue), name=f"webhook-worker-{i}")
+            for i, queue in enumerate(self._queues)
+        ]
+        logger.info(f"Webhook update queue started: {self.workers} workers, {shard_size} updates per shard")
+
+    async def stop(self) -> None:
+        """Остановить воркеры, дообработав уже принятые апдейты."""
+        if not self.running:
+            return
+        for queue in self._queues:
+            await queue.put(_STOP)
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        logger.info("Webhook update queue stopped")
+
+    def submit(self, update: Update) -> bool:
+        """Поставить апдейт в очередь его чата. False - очередь переполнена."""
+        queue = self._queues[update_chat_id(update) % self.workers]
+        try:
+            queue.put_nowait((update, time.perf_counter()))
+        except asyncio.QueueFull:
+            self._metrics["rejected"] += 1
+            logger.warning(f"Webhook queue is full, rejecting update {update.update_id}")
+            return False
+        self._metrics["accepted"] += 1
+        self._metrics["max_queue_depth"] = max(self._metrics["max_queue_depth"], self.queue_depth)
+        return True
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(queue.qsize() for queue in self._queues)
+
+    async def _run(self, queue: asyncio.Queue) -> None:
+        while True:
+            item = await queue.get()
+            if item is _STOP:
+                return
+            update, enqueued = item
+            started = time.perf_counter()
+            self.lag_ms.observe((started - enqueued) * 1000)
+            try:
+                await self._dispatcher.feed_update(self._bot, update)
+                self._metrics["processed"] += 1
+            except Exception as e:
+                self._metrics["failed"] += 1
+                logger.error(f"Error processing update {update.update_id}: {e}")
+            finally:
+                self.processing_ms.observe((time.perf_counter() - started) * 1000)
+
+    def stats(self) -> dict:
+        """Метрики: глубина очереди (всего и по шардам), задержка до обработки и время обработки."""
+        return {
+            **self._metrics,
+            "workers": self.workers,
+            "queue_depth": self.queue_depth,
+            "queue_capacity": self.max_queue,
+            "shard_depths": [queue.qsize() for queue in self._queues],
+            "lag_ms": self.lag_ms.snapshot(),
+            "processing_ms": self.processing_ms.snapshot(),
+            "running": self.running
+        }
+
+update_queue = UpdateQueue()
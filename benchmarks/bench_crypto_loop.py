@@ -0,0 +1,70 @@
+"""
+Бенчмарк задержки event loop при одновременных регистрациях.
+
+Фоновая задача "тикает" каждые 10 мс и измеряет, насколько позже срока она
+просыпается. Параллельно --signups регистраций хэшируют пароль bcrypt:
+- inline: bcrypt.hash прямо в корутине (как было в create_or_update_user);
+- pool: app.crypto_pool.hash_password (пул потоков).
+
+БД не нужна. Запуск из корня репозитория:
+    BCRYPT_ROUNDS=12 python -m benchmarks.bench_crypto_loop --signups 20
+"""
+import argparse
+import asyncio
+import json
+import time
+
+from passlib.hash import bcrypt
+
+from app.crypto_pool import BCRYPT_ROUNDS, CRYPTO_WORKERS, crypto_stats, hash_password
+from app.metrics import Histogram
+
+TICK_MS = 10
+LAG_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+
+async def _ticker(lag: Histogram, stop: asyncio.Event) -> None:
+    while not stop.is_set():
+        expected = time.perf_counter() + TICK_MS / 1000
+        await asyncio.sleep(TICK_MS / 1000)
+        lag.observe(max(time.perf_counter() - expected, 0) * 1000)
+
+async def _inline_signup(password: str) -> str:
+    return bcrypt.using(rounds=BCRYPT_ROUNDS).hash(password)
+
+async def run(name: str, signup, signups: int) -> dict:
+    lag = Histogram(LAG_BUCKETS_MS)
+    stop = asyncio.Event()
+    ticker = asyncio.create_task(_ticker(lag, stop))
+    await asyncio.sleep(TICK_MS / 1000 * 5)
+    started = time.perf_counter()
+    await asyncio.gather(*(signup(f"password-{i}") for i in range(signups)))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await ticker
+    snapshot = lag.snapshot()
+    return {
+        "mode": name,
+        "signups": signups,
+        "total_s": round(elapsed, 3),
+        "signups_per_s": round(signups / elapsed, 2),
+        "loop_lag_ms": {key: snapshot[key] for key in ("count", "avg", "p50", "p95", "p99", "max")}
+    }
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description="Задержка event loop: bcrypt inline vs пул потоков")
+    parser.add_argument("--signups", type=int, default=20)
+    args = parser.parse_args()
+
+    results = {
+        "bcrypt_rounds": BCRYPT_ROUNDS,
+        "workers": CRYPTO_WORKERS,
+        "runs": [
+            await run("inline", _inline_signup, args.signups),
+            await run("pool", hash_password, args.signups)
+        ],
+        "pool_stats": crypto_stats()
+    }
+    print(json.dumps(results, indent=2))
+
+if __name__ == "__main__":
+    asyncio.run(main())
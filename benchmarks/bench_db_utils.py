@@ -0,0 +1,298 @@
+"""
+Бенчмарк функций db_utils и списочных обработчиков бота на синтетических данных.
+
+Для каждого размера набора база очищается и заполняется через generate_series:
+аккаунты, деревья токенов (мастер -> дочерние -> внуки), история, объекты и
+права доступа к ним. Затем каждая операция выполняется --repeat раз; в отчет
+попадают задержки (avg/p50/p95/max, мс) и число SQL-запросов на вызов.
+
+Только для одноразовой БД: все таблицы приложения очищаются (TRUNCATE).
+Имя БД (DB_NAME) должно содержать "bench", иначе нужен флаг --force.
+
+    DB_NAME=wialon_bench python -m benchmarks.bench_db_utils --sizes 1000,10000,100000
+    python -m benchmarks.bench_db_utils --compare old.json new.json
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import random
+import statistics
+import subprocess
+import time
+import uuid
+
+from sqlalchemy import event, text
+
+from app.database import AsyncSessionLocal, DB_NAME, engine, init_db
+from app.db_utils import (
+    get_account_tokens,
+    get_all_user_tokens,
+    get_token_info,
+    get_tokens_page,
+    invalidate_token_info,
+    save_token_chain,
+)
+from app.history_writer import history_writer
+from app.models import Token
+
+TOKEN_TYPE_ENUM = Token.__table__.c.token_type.type.name
+CREATION_METHOD_ENUM = Token.__table__.c.creation_method.type.name
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), "results")
+BENCH_USERS = 10
+
+TABLES = "token_object_access, objects, token_history, tokens, wialon_accounts, users"
+
+def _seed_statements(size: int) -> list:
+    """SQL заполнения: size токенов (10% мастер, 80% дочерние, 10% внуки), 2*size записей истории."""
+    masters = max(size // 10, 1)
+    children = size * 8 // 10
+    grandchildren = max(size - masters - children, 0)
+    accounts = max(masters // 10, 1)
+    objects = max(size // 10, 1)
+    return [
+        f"TRUNCATE {TABLES} RESTART IDENTITY CASCADE",
+        f"""
+        INSERT INTO users (username, telegram_id, created_at)
+        SELECT 'bench_user_' || g, CAST(1000 + g AS varchar), now() AT TIME ZONE 'utc'
+        FROM generate_series(1, {BENCH_USERS}) g
+        """,
+        f"""
+        INSERT INTO wialon_accounts (username, encrypted_password, created_at, last_used)
+        SELECT 'bench_account_' || g, 'x', now() AT TIME ZONE 'utc', now() AT TIME ZONE 'utc'
+        FROM generate_series(1, {accounts}) g
+        """,
+        f"""
+        INSERT INTO tokens (token, token_type, creation_method, account_id, status, created_at, access_rights)
+        SELECT 'm' || md5(g::text), CAST('MASTER' AS {TOKEN_TYPE_ENUM}), CAST('LOGIN' AS {CREATION_METHOD_ENUM}),
+               1 + g % {accounts}, 'active', now() AT TIME ZONE 'utc' - g * interval '1 second', '-1'
+        FROM generate_series(1, {masters}) g
+        """,
+        f"""
+        INSERT INTO tokens (token, token_type, creation_method, parent_token_id, status, created_at, expires_at, token_metadata)
+        SELECT 'c' || md5(g::text), CAST('CHILD' AS {TOKEN_TYPE_ENUM}), CAST('API' AS {CREATION_METHOD_ENUM}),
+               1 + g % {masters}, CASE WHEN g % 7 = 0 THEN 'expired' ELSE 'active' END,
+               now() AT TIME ZONE 'utc' - g * interval '1 second',
+               now() AT TIME ZONE 'utc' + (g % 90 - 30) * interval '1 day',
+               json_build_object('duration', 86400)
+        FROM generate_series(1, {children}) g
+        """,
+        f"""
+        INSERT INTO tokens (token, token_type, creation_method, parent_token_id, status, created_at)
+        SELECT 'g' || md5(g::text), CAST('CHILD' AS {TOKEN_TYPE_ENUM}), CAST('API' AS {CREATION_METHOD_ENUM}),
+               {masters} + 1 + g % {max(children, 1)}, 'active', now() AT TIME ZONE 'utc' - g * interval '1 second'
+        FROM generate_series(1, {grandchildren}) g
+        """,
+        f"""
+        INSERT INTO token_history (token_id, user_id, action, created_at, details)
+        SELECT 1 + g % {size}, 1 + g % {BENCH_USERS},
+               (ARRAY['create', 'check', 'update', 'delete'])[1 + g % 4],
+               date_trunc('month', now() AT TIME ZONE 'utc')
+                   + random() * (now() AT TIME ZONE 'utc' - date_trunc('month', now() AT TIME ZONE 'utc')),
+               json_build_object('seed', g)
+        FROM generate_series(1, {size * 2}) g
+        """,
+        f"""
+        INSERT INTO objects (wialon_id, name, type)
+        SELECT 'unit-' || g, 'Unit ' || g, 'avl_unit'
+        FROM generate_series(1, {objects}) g
+        """,
+        f"""
+        INSERT INTO token_object_access (token_id, object_id, uacl)
+        SELECT 1 + g % {masters}, 1 + g % {objects}, -1
+        FROM generate_series(1, {masters * 5}) g
+        """,
+    ]
+
+class StatementCounter:
+    """Считает SQL-запросы приложения (без фоновой записи истории)."""
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, conn, cursor, statement, *args):
+        if not statement.lstrip().upper().startswith("INSERT INTO TOKEN_HISTORY"):
+            self.count += 1
+
+class FakeUser:
+    def __init__(self, user_id: int):
+        self.id = user_id
+
+class FakeMessage:
+    """Минимальное сообщение для вызова обработчиков бота без Telegram."""
+
+    def __init__(self, user_id: int):
+        self.from_user = FakeUser(user_id)
+        self.replies = []
+
+    async def reply(self, text, **kwargs):
+        self.replies.append(text)
+
+async def seed(size: int) -> float:
+    started = time.perf_counter()
+    async with engine.begin() as conn:
+        for statement in _seed_statements(size):
+            await conn.execute(text(statement))
+    async with engine.connect() as conn:
+        conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+        await conn.execute(text("ANALYZE"))
+    return time.perf_counter() - started
+
+async def _samples() -> dict:
+    """Случайные существующие значения для параметров вызовов."""
+    async with AsyncSessionLocal() as session:
+        tokens = (await session.execute(text("SELECT token FROM tokens ORDER BY random() LIMIT 100"))).scalars().all()
+        accounts = (await session.execute(text(
+            "SELECT username FROM wialon_accounts ORDER BY random() LIMIT 20"
+        ))).scalars().all()
+        page = await get_tokens_page(session)
+    return {"tokens": tokens, "accounts": accounts, "cursor": page["next_cursor"]}
+
+def _operations(samples: dict) -> dict:
+    """Операции бенчмарка: имя -> корутина-функция от сессии."""
+    def pick(key):
+        return random.choice(samples[key])
+
+    async def token_info_cold(session):
+        token = pick("tokens")
+        invalidate_token_info(token)
+        await get_token_info(session, token)
+
+    async def token_info_warm(session):
+        await get_token_info(session, samples["tokens"][0])
+
+    async def save_chain(session):
+        suffix = uuid.uuid4().hex
+        await save_token_chain(
+            session, pick("accounts"), "secret", f"bench-m-{suffix}", f"bench-c-{suffix}",
+            creation_method="API", access_rights=-1, duration=3600,
+            expires_at=datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+        )
+
+    operations = {
+        "get_all_user_tokens[limit=50]": lambda session: get_all_user_tokens(session, limit=50),
+        "get_all_user_tokens[username]": lambda session: get_all_user_tokens(session, username=pick("accounts")),
+        "get_tokens_page[first]": lambda session: get_tokens_page(session),
+        "get_tokens_page[next]": lambda session: get_tokens_page(session, cursor=samples["cursor"]),
+        "get_account_tokens": lambda session: get_account_tokens(session, pick("accounts")),
+        "get_token_info[cold]": token_info_cold,
+        "get_token_info[warm]": token_info_warm,
+        "save_token_chain": save_chain,
+    }
+
+    from aiogram.filters import CommandObject
+    from aiogram.fsm.context import FSMContext
+    from aiogram.fsm.storage.base import StorageKey
+    from aiogram.fsm.storage.memory import MemoryStorage
+    from app.handlers_history import history_command
+
+    # Фильтры /history хранятся в FSM; для бенчмарка достаточно хранилища в памяти
+    fsm_storage = MemoryStorage()
+
+    def history_handler(session, args: str = None):
+        telegram_id = 1000 + random.randint(1, BENCH_USERS)
+        state = FSMContext(storage=fsm_storage, key=StorageKey(bot_id=0, chat_id=telegram_id, user_id=telegram_id))
+        return history_command(FakeMessage(telegram_id), CommandObject(prefix="/", command="history", args=args), state)
+
+    operations["handler:/history"] = history_handler
+    operations["handler:/history action=delete"] = lambda session: history_handler(session, "action=delete")
+    try:
+        from app.bot import my_tokens_command
+        operations["handler:/my_tokens"] = lambda session: my_tokens_command(FakeMessage(1001))
+    except Exception as e:
+        print(f"Skipping /my_tokens handler: {e}")
+    return operations
+
+async def measure(name: str, operation, repeat: int) -> dict:
+    counter = StatementCounter()
+    timings = []
+    event.listen(engine.sync_engine, "before_cursor_execute", counter)
+    try:
+        for _ in range(repeat):
+            async with AsyncSessionLocal() as session:
+                started = time.perf_counter()
+                await operation(session)
+                timings.append((time.perf_counter() - started) * 1000)
+    finally:
+        event.remove(engine.sync_engine, "before_cursor_execute", counter)
+    timings.sort()
+    return {
+        "calls": repeat,
+        "statements_per_call": round(counter.count / repeat, 2),
+        "avg_ms": round(statistics.fmean(timings), 3),
+        "p50_ms": round(timings[len(timings) // 2], 3),
+        "p95_ms": round(timings[min(int(len(timings) * 0.95), len(timings) - 1)], 3),
+        "max_ms": round(timings[-1], 3)
+    }
+
+def _revision() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True).strip()
+    except Exception:
+        return "unknown"
+
+def compare(old_path: str, new_path: str) -> None:
+    """Сравнить два отчета: avg_ms и statements_per_call по каждой операции."""
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    print(f"{'size':>8} {'operation':<34} {'avg_ms old':>11} {'avg_ms new':>11} {'x':>6} {'stmts':>11}")
+    for size, run in new["sizes"].items():
+        previous = old["sizes"].get(size, {}).get("results", {})
+        for name, result in run["results"].items():
+            before = previous.get(name)
+            if not before:
+                continue
+            ratio = before["avg_ms"] / result["avg_ms"] if result["avg_ms"] else 0
+            print(f"{size:>8} {name:<34} {before['avg_ms']:>11} {result['avg_ms']:>11} {ratio:>6.2f} "
+                  f"{before['statements_per_call']:>5}->{result['statements_per_call']:<5}")
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description="Бенчмарк db_utils на синтетических данных")
+    parser.add_argument("--sizes", default="1000,10000,100000", help="Размеры наборов (число токенов), через запятую")
+    parser.add_argument("--repeat", type=int, default=50, help="Вызовов каждой операции")
+    parser.add_argument("--output", help="Файл отчета (по умолчанию benchmarks/results/db_utils-<ревизия>-<время>.json)")
+    parser.add_argument("--force", action="store_true", help="Разрешить запуск на БД без 'bench' в имени")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="Сравнить два отчета и выйти")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+    if "bench" not in DB_NAME and not args.force:
+        raise SystemExit(f"Database '{DB_NAME}' does not look disposable; set DB_NAME=*bench* or pass --force")
+
+    await init_db()
+    await history_writer.start()
+    report = {
+        "revision": _revision(),
+        "created_at": datetime.datetime.utcnow().isoformat(),
+        "repeat": args.repeat,
+        "sizes": {}
+    }
+    try:
+        for size in (int(s) for s in args.sizes.split(",")):
+            seed_seconds = await seed(size)
+            print(f"Seeded {size} tokens in {seed_seconds:.1f}s")
+            samples = await _samples()
+            results = {}
+            for name, operation in _operations(samples).items():
+                results[name] = await measure(name, operation, args.repeat)
+                print(f"  {name:<34} {results[name]['avg_ms']:>9.3f} ms  {results[name]['statements_per_call']:>5} stmts")
+            report["sizes"][str(size)] = {"seed_seconds": round(seed_seconds, 2), "results": results}
+    finally:
+        await history_writer.stop()
+        await engine.dispose()
+
+    output = args.output or os.path.join(
+        RESULTS_DIR, f"db_utils-{report['revision']}-{datetime.datetime.utcnow():%Y%m%d%H%M%S}.json"
+    )
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Report saved to {output}")
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,136 @@
+"""
+Бенчмарк save_token_chain: число запросов/round trip'ов и время на вызов
+до (прежняя ORM-реализация, воспроизведена ниже) и после (один запрос с CTE).
+
+Запускать на одноразовой БД из корня репозитория; подключение задается
+переменными DB_HOST, DB_PORT, DB_NAME, DB_USER и DB_PASSWORD (см. app/database.py):
+    DB_NAME=wialon_bench python -m benchmarks.bench_save_token_chain --calls 200
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import time
+import uuid
+
+from sqlalchemy import event, select, text
+
+from app.database import AsyncSessionLocal, engine
+from app.db_utils import save_token_chain
+from app.history_writer import history_writer
+from app.models import Token, TokenType, TokenCreationMethod, WialonAccount
+from app.utils import encrypt_password
+
+PREFIX = "bench-chain-"
+
+class RoundTripCounter:
+    """Считает выполненные запросы, BEGIN и COMMIT на движке."""
+
+    def __init__(self):
+        self.statements = 0
+        self.transactions = 0
+
+    def on_execute(self, *args):
+        self.statements += 1
+
+    def on_begin(self, *args):
+        self.transactions += 1
+
+    @property
+    def round_trips(self) -> int:
+        # BEGIN и COMMIT - по отдельному обращению к серверу
+        return self.statements + self.transactions * 2
+
+async def legacy_save_token_chain(session, username, password, master_token, child_token, access_rights, duration):
+    """Прежняя реализация: save_wialon_credentials + SELECT/INSERT мастер-токена + INSERT дочернего."""
+    account = await session.scalar(select(WialonAccount).where(WialonAccount.username == username))
+    if account:
+        account.encrypted_password = encrypt_password(password)
+        account.last_used = datetime.datetime.utcnow()
+    else:
+        account = WialonAccount(username=username, encrypted_password=encrypt_password(password))
+        session.add(account)
+    await session.commit()
+
+    parent_token = await session.scalar(select(Token).where(Token.token == master_token))
+    if not parent_token:
+        parent_token = Token(
+            token=master_token,
+            token_type=TokenType.MASTER,
+            creation_method=TokenCreationMethod.LOGIN,
+            account_id=account.id,
+            access_rights=str(access_rights)
+        )
+        session.add(parent_token)
+        await session.flush()
+    child = Token(
+        token=child_token,
+        token_type=TokenType.CHILD,
+        creation_method=TokenCreationMethod.LOGIN,
+        parent_token_id=parent_token.id,
+        access_rights=str(access_rights),
+        token_metadata={"duration": duration}
+    )
+    session.add(child)
+    await session.flush()
+    await session.commit()
+
+async def run(name: str, calls: int, func) -> dict:
+    counter = RoundTripCounter()
+    event.listen(engine.sync_engine, "before_cursor_execute", counter.on_execute)
+    event.listen(engine.sync_engine, "begin", counter.on_begin)
+    started = time.perf_counter()
+    try:
+        for i in range(calls):
+            suffix = uuid.uuid4().hex
+            async with AsyncSessionLocal() as session:
+                await func(
+                    session,
+                    username=f"{PREFIX}user-{i % 10}",
+                    password="secret",
+                    master_token=f"{PREFIX}m-{suffix}",
+                    child_token=f"{PREFIX}c-{suffix}",
+                    access_rights=-1,
+                    duration=3600
+                )
+    finally:
+        event.remove(engine.sync_engine, "before_cursor_execute", counter.on_execute)
+        event.remove(engine.sync_engine, "begin", counter.on_begin)
+    elapsed = time.perf_counter() - started
+    return {
+        "implementation": name,
+        "calls": calls,
+        "statements_per_call": round(counter.statements / calls, 2),
+        "round_trips_per_call": round(counter.round_trips / calls, 2),
+        "avg_ms": round(elapsed / calls * 1000, 3)
+    }
+
+async def cleanup() -> None:
+    async with engine.begin() as conn:
+        await conn.execute(text(
+            "DELETE FROM token_history WHERE token_id IN (SELECT id FROM tokens WHERE token LIKE :prefix)"
+        ), {"prefix": f"{PREFIX}%"})
+        await conn.execute(text("DELETE FROM tokens WHERE token LIKE :prefix AND parent_token_id IS NOT NULL"), {"prefix": f"{PREFIX}%"})
+        await conn.execute(text("DELETE FROM tokens WHERE token LIKE :prefix"), {"prefix": f"{PREFIX}%"})
+        await conn.execute(text("DELETE FROM wialon_accounts WHERE username LIKE :prefix"), {"prefix": f"{PREFIX}%"})
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--calls", type=int, default=200)
+    args = parser.parse_args()
+
+    # История пишется фоновой задачей и в подсчет не входит (одинаково для обеих реализаций)
+    await history_writer.start()
+    try:
+        results = [
+            await run("legacy_orm", args.calls, legacy_save_token_chain),
+            await run("cte_upsert", args.calls, save_token_chain)
+        ]
+    finally:
+        await history_writer.stop()
+        await cleanup()
+        await engine.dispose()
+    print(json.dumps(results, indent=2))
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,156 @@
+"""
+Проверка планов горячих запросов: каждый должен использовать свой индекс.
+
+База заполняется тем же синтетическим набором, что и в bench_db_utils, затем
+для каждого запроса выполняется EXPLAIN и проверяется, что в плане есть узел
+Index Scan / Index Only Scan / Bitmap Index Scan по ожидаемому индексу. Для
+партиционированной token_history подходят и индексы партиций, унаследованные
+от индекса родителя. Запросы повторяют выборки db_utils и token_sweeper.
+Отсутствующие в БД индексы (триграммные создаются только миграцией
+d7b2e4f6a830) пропускаются с пометкой SKIP.
+
+Только для одноразовой БД: все таблицы приложения очищаются (TRUNCATE).
+Имя БД (DB_NAME) должно содержать "bench", иначе нужен флаг --force.
+Код возврата 1, если хотя бы один запрос не использует индекс.
+
+    DB_NAME=wialon_bench python -m benchmarks.check_indexes --size 100000
+"""
+import argparse
+import asyncio
+import datetime
+import hashlib
+import re
+
+from sqlalchemy import text
+
+from app.database import DB_NAME, engine, init_db
+from app.db_utils import token_short_id
+from benchmarks.bench_db_utils import BENCH_USERS, TOKEN_TYPE_ENUM, seed
+
+# (индекс, запрос, параметры)
+CHECKS = [
+    # get_account_tokens / дерево токенов: дочерние токены по родителю
+    ("ix_tokens_parent_token_id", "SELECT id, token FROM tokens WHERE parent_token_id = :parent_id", {"parent_id": 1}),
+    # get_all_user_tokens(account_id=..., token_type=...)
+    (
+        "ix_tokens_account_id_type",
+        f"SELECT id FROM tokens WHERE account_id = :account_id AND token_type = CAST('MASTER' AS {TOKEN_TYPE_ENUM})",
+        {"account_id": 1}
+    ),
+    # get_tokens_page: первая и следующая страницы /my_tokens
+    ("ix_tokens_created_at_id", "SELECT id FROM tokens ORDER BY created_at DESC, id DESC LIMIT 11", {}),
+    (
+        "ix_tokens_created_at_id",
+        "SELECT id FROM tokens WHERE (created_at, id) < (:created_at, :id) ORDER BY created_at DESC, id DESC LIMIT 11",
+        {"created_at": datetime.datetime.utcnow() - datetime.timedelta(seconds=100), "id": 100}
+    ),
+    # resolve_token_short_id
+    (
+        "ix_tokens_short_id",
+        "SELECT token FROM tokens WHERE substr(md5(token), 1, 12) = :short_id LIMIT 2",
+        {"short_id": token_short_id("m" + hashlib.md5(b"1").hexdigest())}
+    ),
+    # search_tokens (inline-поиск): каждая ветка UNION идет по своему триграммному индексу
+    (
+        "ix_tokens_token_trgm",
+        "SELECT id FROM tokens WHERE token ILIKE :pattern ORDER BY similarity(token, :query) DESC LIMIT 20",
+        {"pattern": "%a1b2%", "query": "a1b2"}
+    ),
+    (
+        "ix_tokens_label_trgm",
+        "SELECT id FROM tokens WHERE (token_metadata ->> 'label') ILIKE :pattern "
+        "ORDER BY similarity(token_metadata ->> 'label', :query) DESC LIMIT 20",
+        {"pattern": "%fleet 12%", "query": "fleet 12"}
+    ),
+    (
+        "ix_wialon_accounts_username_trgm",
+        "SELECT t.id FROM tokens t JOIN wialon_accounts a ON a.id = t.account_id WHERE a.username ILIKE :pattern "
+        "ORDER BY similarity(a.username, :query) DESC LIMIT 20",
+        {"pattern": "%account_12%", "query": "account_12"}
+    ),
+    # token_sweeper: активные токены с истекшим сроком
+    (
+        "ix_tokens_active_expires_at",
+        "SELECT id FROM tokens WHERE status = 'active' AND expires_at IS NOT NULL AND expires_at < :until",
+        {"until": datetime.datetime.utcnow() - datetime.timedelta(days=28)}
+    ),
+    # get_history_page без фильтра по действию
+    (
+        "ix_token_history_user_created",
+        "SELECT id FROM token_history WHERE user_id = :user_id AND created_at >= :since AND created_at < :until "
+        "ORDER BY created_at DESC, id DESC LIMIT 11",
+        {"user_id": 1, "since": datetime.datetime.utcnow() - datetime.timedelta(days=90), "until": datetime.datetime.utcnow()}
+    ),
+    # get_history_page(action=...)
+    (
+        "ix_token_history_user_action_created",
+        "SELECT id FROM token_history WHERE user_id = :user_id AND action = :action "
+        "AND created_at >= :since AND created_at < :until ORDER BY created_at DESC LIMIT 11",
+        {"user_id": 1, "action": "delete", "since": datetime.datetime.utcnow() - datetime.timedelta(days=90), "until": datetime.datetime.utcnow()}
+    ),
+    # /history token=...
+    ("ix_token_history_token_id", "SELECT id FROM token_history WHERE token_id = :token_id", {"token_id": 1}),
+    # объекты, доступные токену
+    (
+        "ix_token_object_access_token_object",
+        "SELECT object_id FROM token_object_access WHERE token_id = :token_id",
+        {"token_id": 1}
+    ),
+]
+
+_SCAN_RE = re.compile(r"(?:Index Scan(?: Backward)?|Index Only Scan(?: Backward)?) using (\S+)|Bitmap Index Scan on (\S+)")
+
+async def _index_names(conn, index: str) -> set:
+    """Индекс и его копии в партициях (для партиционированных таблиц)."""
+    rows = await conn.execute(
+        text(
+            "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+            "WHERE i.inhparent = to_regclass(:index)"
+        ),
+        {"index": index}
+    )
+    return {index, *rows.scalars().all()}
+
+async def check(verbose: bool = False) -> list:
+    """Выполнить EXPLAIN для всех запросов. Возвращает список (индекс, запрос) без использования индекса."""
+    failures = []
+    async with engine.connect() as conn:
+        for index, query, params in CHECKS:
+            # Триграммные индексы создает только миграция и только при наличии pg_trgm
+            if not await conn.scalar(text("SELECT to_regclass(:index) IS NOT NULL"), {"index": index}):
+                print(f"  SKIP {index:<40} index does not exist (pg_trgm missing or migrations not applied)")
+                continue
+            plan = "\n".join((await conn.execute(text(f"EXPLAIN {query}"), params)).scalars().all())
+            used = {name for match in _SCAN_RE.finditer(plan) for name in match.groups() if name}
+            ok = bool(used & await _index_names(conn, index))
+            print(f"  {'OK  ' if ok else 'FAIL'} {index:<40} {', '.join(sorted(used)) or 'no index scans'}")
+            if verbose or not ok:
+                print("      " + plan.replace("\n", "\n      "))
+            if not ok:
+                failures.append((index, query))
+    return failures
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description="Проверка использования индексов горячими запросами (EXPLAIN)")
+    parser.add_argument("--size", type=int, default=100000, help="Размер набора (число токенов)")
+    parser.add_argument("--no-seed", action="store_true", help="Не пересоздавать данные, проверить текущую БД")
+    parser.add_argument("--verbose", action="store_true", help="Печатать планы всех запросов")
+    parser.add_argument("--force", action="store_true", help="Разрешить запуск на БД без 'bench' в имени")
+    args = parser.parse_args()
+
+    if "bench" not in DB_NAME and not args.force and not args.no_seed:
+        raise SystemExit(f"Database '{DB_NAME}' does not look disposable; set DB_NAME=*bench* or pass --force")
+    try:
+        await init_db()
+        if not args.no_seed:
+            seconds = await seed(args.size)
+            print(f"Seeded {args.size} tokens ({BENCH_USERS} users) in {seconds:.1f}s")
+        failures = await check(args.verbose)
+    finally:
+        await engine.dispose()
+    if failures:
+        raise SystemExit(f"{len(failures)} queries do not use their index")
+    print("All hot queries use their indexes")
+
+if __name__ == "__main__":
+    asyncio.run(main())